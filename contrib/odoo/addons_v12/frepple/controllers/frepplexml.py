@@ -19,6 +19,7 @@
 import base64
 import logging
 import odoo
+import zlib
 from werkzeug.exceptions import MethodNotAllowed, InternalServerError
 from werkzeug.wrappers import Response
 
@@ -61,6 +62,39 @@ class XMLController(odoo.http.Controller):
             req.session.context["lang"] = language
         return uid
 
+    def generate(self, xp, database, uid, context):
+        """
+        Runs the exporter while the response is sent to the client.
+        The cursor of the request is closed by then, so the exporter gets
+        an environment with a cursor of its own.
+        """
+        with odoo.registry(database).cursor() as cr:
+            xp.env = odoo.api.Environment(cr, uid, context)
+            try:
+                for i in xp.run():
+                    yield i
+            except Exception:
+                logger.exception("Error generating frePPLe XML data")
+                raise
+
+    def compress(self, data, chunksize=64 * 1024):
+        """
+        Compresses the output of a generator in gzip format.
+        """
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        buf = []
+        size = 0
+        for i in data:
+            buf.append(i.encode("utf-8"))
+            size += len(buf[-1])
+            if size >= chunksize:
+                out = compressor.compress(b"".join(buf))
+                buf = []
+                size = 0
+                if out:
+                    yield out
+        yield compressor.compress(b"".join(buf)) + compressor.flush()
+
     @odoo.http.route(
         "/frepple/xml", type="http", auth="none", methods=["POST", "GET"], csrf=False
     )
@@ -96,18 +130,27 @@ class XMLController(odoo.http.Controller):
                     database=database,
                     company=kwargs.get("company", None),
                     mode=int(kwargs.get("mode", 1)),
+                    since=kwargs.get("since", None),
                 )
-                # TODO Returning an iterator to stream the response back to the client and
-                # to save memory on the server side
-                return req.make_response(
-                    "".join([i for i in xp.run()]),
-                    headers=[
-                        ("Content-Type", "application/xml;charset=utf8"),
-                        ("Cache-Control", "no-cache, no-store, must-revalidate"),
-                        ("Pragma", "no-cache"),
-                        ("Expires", "0"),
-                    ],
-                )
+                # Stream the response back to the client, to save memory on the
+                # server side and allow the client to start parsing sooner
+                headers = [
+                    ("Content-Type", "application/xml;charset=utf8"),
+                    ("Cache-Control", "no-cache, no-store, must-revalidate"),
+                    ("Pragma", "no-cache"),
+                    ("Expires", "0"),
+                    (
+                        "X-Frepple-Timestamp",
+                        odoo.fields.Datetime.to_string(xp.timestamp),
+                    ),
+                ]
+                data = self.generate(xp, database, uid, dict(req.env.context))
+                if "gzip" in req.httprequest.headers.get("Accept-Encoding", ""):
+                    headers.append(("Content-Encoding", "gzip"))
+                    data = self.compress(data)
+                else:
+                    data = (i.encode("utf-8") for i in data)
+                return Response(data, headers=headers, direct_passthrough=True)
             except Exception as e:
                 logger.exception("Error generating frePPLe XML data")
                 raise InternalServerError(
@@ -15,12 +15,16 @@
 # You should have received a copy of the GNU Affero General Public
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import gzip
 import odoo
 import logging
 from xml.etree.cElementTree import iterparse
 
 logger = logging.getLogger(__name__)
 
+# Number of orders created with a single call
+batchsize = 1000
+
 
 class importer(object):
 
@@ -29,6 +33,8 @@ class importer(object):
     self.database = database
     self.company = company
     self.datafile = req.httprequest.files.get('frePPLe plan')
+    if self.datafile and self.datafile.mimetype == 'application/gzip':
+      self.datafile = gzip.GzipFile(fileobj=self.datafile.stream)
 
     # The mode argument defines different types of runs:
     #  - Mode 1:
@@ -44,7 +50,6 @@ class importer(object):
     msg = []
 
     proc_order = self.env['purchase.order']
-    proc_orderline = self.env['purchase.order.line']
     mfg_order = self.env['mrp.production']
     if self.mode == 1:
       # Cancel previous draft purchase quotations
@@ -62,9 +67,13 @@ class importer(object):
       recs.unlink()
       msg.append("Removed %s old draft manufacturing orders" % len(recs))
 
-    # Parsing the XML data file
+    # Parsing the XML data file.
+    # The orders are created in batches, which is a lot faster than creating
+    # them one by one.
     countproc = 0
     countmfg = 0
+    procs = []
+    mfgs = []
     for event, elem in iterparse(self.datafile, events=('start', 'end')):
       if event == 'end' and elem.tag == 'operationplan':
         uom_id, item_id = elem.get('item_id').split(',')
@@ -72,29 +81,30 @@ class importer(object):
           ordertype = elem.get('ordertype')
           if ordertype == 'PO':
             # Create purchase order
-            po = proc_order.create({
+            procs.append({
               'company_id': self.company.id,
               'partner_id': int(elem.get('supplier').split(" ", 1)[0]),
               # TODO Odoo has no place to store the location and criticality
               #int(elem.get('location_id')),
               #elem.get('criticality'),
-              'origin': 'frePPLe'
+              'origin': 'frePPLe',
+              'order_line': [(0, 0, {
+                'product_id': int(item_id),
+                'product_qty': elem.get("quantity"),
+                'product_uom': int(uom_id),
+                'date_planned': elem.get("end"),
+                'price_unit': 0,
+                'name': elem.get('item')
+                })]
               })
-            po_line = proc_orderline.create({
-              'order_id': po.id,
-              'product_id': int(item_id),
-              'product_qty': elem.get("quantity"),
-              'product_uom': int(uom_id),
-              'date_planned': elem.get("end"),
-              'price_unit': 0,
-              'name': elem.get('item')
-              })
-            countproc += 1
+            if len(procs) >= batchsize:
+              countproc += self.create(proc_order, procs, msg)
+              procs = []
           # TODO Create a distribution order
           # elif ????:
           else:
             # Create manufacturing order
-            mfg_order.create({
+            mfgs.append({
               'product_qty': elem.get("quantity"),
               'date_planned_start': elem.get("start"),
               'date_planned_finished': elem.get("end"),
@@ -107,7 +117,9 @@ class importer(object):
               # elem.get('criticality'),
               'origin': 'frePPLe'
               })
-            countmfg += 1
+            if len(mfgs) >= batchsize:
+              countmfg += self.create(mfg_order, mfgs, msg)
+              mfgs = []
         except Exception as e:
           logger.error("Exception %s" % e)
           msg.append(str(e))
@@ -116,8 +128,36 @@ class importer(object):
       elif event == 'start' and elem.tag == 'operationplans':
         # Remember the root element
         root = elem
+    if procs:
+      countproc += self.create(proc_order, procs, msg)
+    if mfgs:
+      countmfg += self.create(mfg_order, mfgs, msg)
 
     # Be polite, and reply to the post
     msg.append("Processed %s uploaded procurement orders" % countproc)
     msg.append("Processed %s uploaded manufacturing orders" % countmfg)
     return '\n'.join(msg)
+
+
+  def create(self, model, records, msg):
+    '''
+    Creates a batch of records, and returns the number of records created.
+    When the batch fails, the records are created one by one to find the
+    ones causing the problem.
+    '''
+    try:
+      with self.env.cr.savepoint():
+        model.create(records)
+      return len(records)
+    except Exception:
+      pass
+    count = 0
+    for rec in records:
+      try:
+        with self.env.cr.savepoint():
+          model.create(rec)
+        count += 1
+      except Exception as e:
+        logger.error("Exception %s" % e)
+        msg.append(str(e))
+    return count
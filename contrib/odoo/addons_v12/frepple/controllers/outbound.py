@@ -24,9 +24,13 @@ import odoo
 
 logger = logging.getLogger(__name__)
 
+# Incremental exports also return the records changed shortly before the
+# previous export, to catch the transactions that were still running then.
+overlap = timedelta(minutes=10)
+
 
 class exporter(object):
-    def __init__(self, req, uid, database=None, company=None, mode=1):
+    def __init__(self, req, uid, database=None, company=None, mode=1, since=None):
         self.database = database
         self.company = company
 
@@ -47,6 +51,21 @@ class exporter(object):
         # Which data elements belong to each mode can vary between implementations.
         self.mode = mode
 
+        # The since argument switches to an incremental export, which only
+        # returns the records created or updated after this moment. Records
+        # that are closed in odoo are returned with a remove action.
+        # Records that are deleted from odoo leave no trace, and are only
+        # removed from frePPLe by the next complete export.
+        # The timestamp of the export is to be passed as since argument to
+        # the next incremental export.
+        self.timestamp = odoo.fields.Datetime.now()
+        if since:
+            self.since = odoo.fields.Datetime.to_string(
+                odoo.fields.Datetime.from_string(since) - overlap
+            )
+        else:
+            self.since = None
+
         # Initialize an environment
         self.env = req.env
 
@@ -65,8 +84,13 @@ class exporter(object):
         # Header.
         # The source attribute is set to 'odoo_<mode>', such that all objects created or
         # updated from the data are also marked as from originating from odoo.
+        # Incremental exports use 'odoo_<mode>_delta' instead, which allows frePPLe
+        # to find the objects that need saving.
         yield '<?xml version="1.0" encoding="UTF-8" ?>\n'
-        yield '<plan xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" source="odoo_%s">\n' % self.mode
+        yield '<plan xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" source="odoo_%s%s">\n' % (
+            self.mode,
+            "_delta" if self.since else "",
+        )
 
         # Main content.
         # The order of the entities is important. First one needs to create the
@@ -106,6 +130,21 @@ class exporter(object):
         # Footer
         yield "</plan>\n"
 
+    def changed(self, model, field=None):
+        """
+        Returns the ids of the records of a model updated since the previous
+        export. When a field is passed, the ids referenced by this field of the
+        updated records are returned instead.
+        """
+        recs = (
+            self.env[model]
+            .with_context(active_test=False)
+            .search([("write_date", ">=", self.since)])
+        )
+        if not field:
+            return set(recs.ids)
+        return set(i[field][0] for i in recs.read([field]) if i[field])
+
     def load_company(self):
         m = self.env["res.company"]
         recs = m.search([("name", "=", self.company)])
@@ -361,9 +400,11 @@ class exporter(object):
             yield "<!-- customers -->\n"
             yield "<customers>\n"
             fields = ["name"]
+            changed = self.changed("res.partner") if self.since else None
             for i in recs.read(fields):
                 name = "%d %s" % (i["id"], i["name"])
-                yield "<customer name=%s/>\n" % quoteattr(name)
+                if changed is None or i["id"] in changed:
+                    yield "<customer name=%s/>\n" % quoteattr(name)
                 self.map_customers[i["id"]] = name
             yield "</customers>\n"
 
@@ -376,7 +417,10 @@ class exporter(object):
         res.partner.id res.partner.name -> supplier.name
         """
         m = self.env["res.partner"]
-        recs = m.search([("supplier", "=", True)])
+        if self.since:
+            recs = m.search([("supplier", "=", True), ("write_date", ">=", self.since)])
+        else:
+            recs = m.search([("supplier", "=", True)])
         if recs:
             yield "<!-- suppliers -->\n"
             yield "<suppliers>\n"
@@ -510,6 +554,11 @@ class exporter(object):
                         s["price"],
                     )
                 ]
+        if self.since:
+            changed_products = self.changed("product.product")
+            self.changed_templates = self.changed("product.template") | self.changed(
+                "product.supplierinfo", "product_tmpl_id"
+            )
         supplier = {}
         if recs:
             yield "<!-- products -->\n"
@@ -526,6 +575,12 @@ class exporter(object):
                     prod_obj = {"name": name, "template": i["product_tmpl_id"][0]}
                     self.product_product[i["id"]] = prod_obj
                     self.product_template_product[i["product_tmpl_id"][0]] = prod_obj
+                    if (
+                        self.since
+                        and i["id"] not in changed_products
+                        and i["product_tmpl_id"][0] not in self.changed_templates
+                    ):
+                        continue
                     yield '<item name=%s cost="%f" subcategory="%s,%s">\n' % (
                         quoteattr(name),
                         (tmpl["list_price"] or 0)
@@ -629,6 +684,14 @@ class exporter(object):
         except:
             subproduct_model = None
 
+        if self.since:
+            changed_boms = self.changed("mrp.bom") | self.changed(
+                "mrp.bom.line", "bom_id"
+            )
+            changed_routings = self.changed("mrp.routing") | self.changed(
+                "mrp.routing.workcenter", "routing_id"
+            )
+
         # Loop over all bom records
         bom_recs = self.env["mrp.bom"].search([])
         bom_fields = [
@@ -666,6 +729,12 @@ class exporter(object):
             )
             operation = u"%d %s @ %s" % (i["id"], product_buf["name"], location)
             self.operations.add(operation)
+            if self.since and not (
+                i["id"] in changed_boms
+                or (i["routing_id"] and i["routing_id"][0] in changed_routings)
+                or i["product_tmpl_id"][0] in self.changed_templates
+            ):
+                continue
 
             # Build operation. The operation can either be a summary operation or a detailed
             # routing.
@@ -875,7 +944,16 @@ class exporter(object):
         """
         # Get all sales order lines
         m = self.env["sale.order.line"]
-        recs = m.search([])
+        if self.since:
+            recs = m.search(
+                [
+                    "|",
+                    ("write_date", ">=", self.since),
+                    ("order_id.write_date", ">=", self.since),
+                ]
+            )
+        else:
+            recs = m.search([])
         fields = [
             "qty_delivered",
             "state",
@@ -1018,13 +1096,18 @@ class exporter(object):
         'confirmed' -> operationplan.status
         """
         m = self.env["purchase.order.line"]
-        recs = m.search(
-            [
-                "|",
-                ("order_id.state", "not in", ("draft", "sent", "bid", "confirmed")),
-                ("order_id.state", "=", False),
-            ]
-        )
+        domain = [
+            "|",
+            ("order_id.state", "not in", ("draft", "sent", "bid", "confirmed")),
+            ("order_id.state", "=", False),
+        ]
+        if self.since:
+            # All lines of the updated orders
+            changed_orders = self.changed("purchase.order") | self.changed(
+                "purchase.order.line", "order_id"
+            )
+            domain.append(("order_id", "in", list(changed_orders)))
+        recs = m.search(domain)
         fields = [
             "name",
             "date_planned",
@@ -1047,6 +1130,7 @@ class exporter(object):
         # Create purchasing operations
         yield "<!-- open purchase orders -->\n"
         yield "<operationplans>\n"
+        open_orders = set()
         for i in po_line:
             if not i["product_id"]:
                 continue
@@ -1072,6 +1156,17 @@ class exporter(object):
                     quoteattr("%d %s" % (j["partner_id"][0], j["partner_id"][1])),
                 )
                 yield "</operationplan>\n"
+                open_orders.add(j["id"])
+        if self.since:
+            # Remove the updated orders that are no longer open
+            m = self.env["purchase.order"]
+            recs = m.browse(list(changed_orders - open_orders)).filtered(
+                lambda x: x.state in ("purchase", "done", "cancel")
+            )
+            for i in recs.read(["name"]):
+                yield '<operationplan reference=%s ordertype="PO" action="R"/>\n' % quoteattr(
+                    i["name"]
+                )
         yield "</operationplans>\n"
 
     def export_manufacturingorders(self):
@@ -1091,7 +1186,10 @@ class exporter(object):
         yield "<!-- manufacturing orders in progress -->\n"
         yield "<operationplans>\n"
         m = self.env["mrp.production"]
-        recs = m.search([("state", "in", ["progress", "confirmed", "planned"])])
+        domain = [("state", "in", ["progress", "confirmed", "planned"])]
+        if self.since:
+            domain.append(("write_date", ">=", self.since))
+        recs = m.search(domain)
         fields = [
             "bom_id",
             "date_start",
@@ -1126,6 +1224,15 @@ class exporter(object):
                     else "approved",
                     quoteattr(operation),
                 )
+        if self.since:
+            # Remove the updated orders that are finished or cancelled
+            recs = m.search(
+                [("state", "in", ["done", "cancel"]), ("write_date", ">=", self.since)]
+            )
+            for i in recs.read(["name"]):
+                yield '<operationplan reference=%s ordertype="MO" action="R"/>\n' % quoteattr(
+                    i["name"]
+                )
         yield "</operationplans>\n"
 
     def export_orderpoints(self):
@@ -1142,7 +1249,10 @@ class exporter(object):
         convert stock.warehouse.orderpoint.qty_multiple -> buffer->size_multiple
         """
         m = self.env["stock.warehouse.orderpoint"]
-        recs = m.search([])
+        if self.since:
+            recs = m.search([("write_date", ">=", self.since)])
+        else:
+            recs = m.search([])
         fields = [
             "warehouse_id",
             "product_id",
@@ -1197,18 +1307,49 @@ class exporter(object):
         """
         yield "<!-- inventory -->\n"
         yield "<buffers>\n"
-        self.env.cr.execute(
-            "SELECT product_id, location_id, sum(quantity) "
-            "FROM stock_quant "
-            "WHERE quantity > 0 "
-            "GROUP BY product_id, location_id "
-            "ORDER BY location_id ASC"
-        )
         inventory = {}
+        if self.since:
+            # Only the inventory of the products and warehouses with stock
+            # movements, which can also have dropped to 0.
+            self.env.cr.execute(
+                "SELECT product_id, location_id FROM stock_quant WHERE write_date >= %s "
+                "UNION SELECT product_id, location_id FROM stock_move_line "
+                "WHERE write_date >= %s AND state = 'done' "
+                "UNION SELECT product_id, location_dest_id FROM stock_move_line "
+                "WHERE write_date >= %s AND state = 'done'",
+                (self.since, self.since, self.since),
+            )
+            products = set()
+            for i in self.env.cr.fetchall():
+                item = self.product_product.get(i[0], None)
+                location = self.map_locations.get(i[1], None)
+                if item and location:
+                    inventory[(item["name"], location)] = 0
+                    products.add(i[0])
+            self.env.cr.execute(
+                "SELECT product_id, location_id, sum(quantity) "
+                "FROM stock_quant "
+                "WHERE quantity > 0 AND product_id = ANY(%s) "
+                "GROUP BY product_id, location_id "
+                "ORDER BY location_id ASC",
+                (list(products),),
+            )
+        else:
+            self.env.cr.execute(
+                "SELECT product_id, location_id, sum(quantity) "
+                "FROM stock_quant "
+                "WHERE quantity > 0 "
+                "GROUP BY product_id, location_id "
+                "ORDER BY location_id ASC"
+            )
         for i in self.env.cr.fetchall():
             item = self.product_product.get(i[0], None)
             location = self.map_locations.get(i[1], None)
-            if item and location:
+            if (
+                item
+                and location
+                and (not self.since or (item["name"], location) in inventory)
+            ):
                 inventory[(item["name"], location)] = i[2] + inventory.get(
                     (item["name"], location), 0
                 )
@@ -6,15 +6,11 @@ A Django project implementing a web-based user interface for frePPLe.
 VERSION = "6.2.0"
 
 
-def runCommand(taskname, *args, **kwargs):
+def initDjango(database="default"):
     """
-  Auxilary method to run a django command. It is intended to be used
-  as a target for the multiprocessing module.
-
-  The code is put here, such that a child process loads only
-  a minimum of other python modules.
+  Auxilary method to initialize django in a child process. It is intended
+  to be used as the initializer of a multiprocessing pool.
   """
-    # Initialize django
     import os
 
     os.environ.setdefault("DJANGO_SETTINGS_MODULE", "freppledb.settings")
@@ -23,10 +19,9 @@ def runCommand(taskname, *args, **kwargs):
     django.setup()
 
     # Be sure to use the correct database
-    from django.db import DEFAULT_DB_ALIAS, connections
+    from django.db import connections
     from freppledb.common.middleware import _thread_locals
 
-    database = kwargs.get("database", DEFAULT_DB_ALIAS)
     setattr(_thread_locals, "database", database)
     if "FREPPLE_TEST" in os.environ:
         from django.conf import settings
@@ -35,6 +30,18 @@ def runCommand(taskname, *args, **kwargs):
             connections[db].close()
             settings.DATABASES[db]["NAME"] = settings.DATABASES[db]["TEST"]["NAME"]
 
+
+def runCommand(taskname, *args, **kwargs):
+    """
+  Auxilary method to run a django command. It is intended to be used
+  as a target for the multiprocessing module.
+
+  The code is put here, such that a child process loads only
+  a minimum of other python modules.
+  """
+    database = kwargs.get("database", "default")
+    initDjango(database)
+
     # Run the command
     try:
         from django.core import management
@@ -26,7 +26,6 @@ from django.contrib.auth.models import Permission
 from django.core.validators import validate_email
 from django.core.exceptions import ValidationError
 from django.db import DEFAULT_DB_ALIAS
-from django.db.models import Q
 from django.http import HttpResponse
 
 from freppledb.common.models import User, Scenario
@@ -119,17 +118,17 @@ class MultiDBBackend(ModelBackend):
 
             # Populate a dictionary with scenarios in which the user is active, and
             # whether he's a superuser in them.
+            # These flags are always read from the scenario databases, because
+            # any server process can change them.
             user.scenarios = []
-            for db in Scenario.objects.using(DEFAULT_DB_ALIAS).filter(
-                Q(status="In use") | Q(name=DEFAULT_DB_ALIAS)
-            ):
+            for db in Scenario.getScenarios():
                 if not db.description:
                     db.description = db.name
                 if db.name == DEFAULT_DB_ALIAS:
                     if user.is_active:
                         db.is_superuser = user.is_superuser
                         user.scenarios.append(db)
-                else:
+                elif db.status == "In use":
                     try:
                         user2 = User.objects.using(db.name).get(username=user.username)
                         if user2.is_active:
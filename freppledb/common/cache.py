@@ -0,0 +1,114 @@
+#
+# Copyright (C) 2019 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+r"""
+In-memory caches shared by the requests handled by a web server process.
+"""
+
+from collections import OrderedDict
+import sys
+from threading import Lock
+from time import monotonic
+
+
+def getSize(value):
+    """
+    Returns an estimate of the memory used by a value, in bytes.
+    Dictionaries, lists and tuples are measured with their content.
+    """
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            sys.getsizeof(k) + getSize(v) for k, v in value.items()
+        )
+    elif isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(getSize(v) for v in value)
+    else:
+        return sys.getsizeof(value)
+
+
+class LRUCache:
+    """
+    Thread-safe cache that evicts the least recently used entries when the
+    total size of the entries exceeds a limit.
+
+    Every entry is stored with a version. Reading an entry with a different
+    version removes it from the cache. Entries can also be stored with a
+    timeout in seconds.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, version=None):
+        """
+        Returns the value of a key, or None when the key isn't in the cache.
+        """
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if not entry:
+                return None
+            if entry[1] != version or (entry[3] and entry[3] < monotonic()):
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, version=None, size=None, timeout=None):
+        """
+        Stores a value in the cache.
+        Values larger than the cache size are not stored.
+        """
+        if size is None:
+            size = getSize(value)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if size > self.maxsize:
+                return
+            self.entries[key] = (
+                value,
+                version,
+                size,
+                monotonic() + timeout if timeout else None,
+            )
+            self.size += size
+            while self.size > self.maxsize:
+                self._remove(next(iter(self.entries)))
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def deleteMatching(self, test):
+        """
+        Removes all entries with a key passing a test function.
+        """
+        with self.lock:
+            for key in [k for k in self.entries if test(k)]:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key)[2]
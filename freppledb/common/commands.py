@@ -15,11 +15,13 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from datetime import datetime
+from datetime import datetime, timezone
+from decimal import Decimal
 import io
 from importlib import import_module
 from operator import attrgetter
 import os
+import struct
 import sys
 import logging
 from threading import Thread
@@ -41,9 +43,10 @@ if __name__ == "__main__":
     django.setup()
 
 from django.conf import settings
-from django.db import DEFAULT_DB_ALIAS
+from django.db import connections, DEFAULT_DB_ALIAS
 from django.utils.encoding import force_text
 
+from freppledb.common.models import Scenario
 from freppledb.execute.models import Task
 
 logger = logging.getLogger(__name__)
@@ -57,7 +60,7 @@ def clean_value(value):
     if value is None:
         return r"\N"
     elif "\n" in value or "\\" in value:
-        return value.replace("\n", "\\n").replace("\\", "\\\\")
+        return value.replace("\\", "\\\\").replace("\n", "\\n")
     else:
         return value
 
@@ -106,6 +109,255 @@ class CopyFromGenerator(io.TextIOBase):
         return "".join(line)
 
 
+class CopyFromBinaryGenerator(io.RawIOBase):
+    """
+    File-like object to handle exporting binary data to PostgreSQL over
+    a copy command.
+    """
+
+    def __init__(self, itr):
+        self._iter = itr
+        self._buff = b""
+
+    def readable(self):
+        return True
+
+    def read(self, n=None):
+        while not self._buff:
+            try:
+                self._buff = next(self._iter)
+            except StopIteration:
+                return b""
+        if n is None or n < 0:
+            n = len(self._buff)
+        ret = self._buff[:n]
+        self._buff = self._buff[n:]
+        return ret
+
+
+class CopyEncoder:
+    """
+    Reusable encoder to export the records of a table to PostgreSQL over
+    a copy command.
+
+    The columns argument is a sequence of (name, postgresql type) tuples,
+    and every record is a tuple with a value for each column.
+
+    In text mode the records are formatted with the clean_value function.
+    In binary mode the records are encoded in the binary copy format
+    directly into a preallocated buffer, which avoids all string
+    formatting and escaping.
+    """
+
+    _header = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+    _trailer = struct.pack("!h", -1)
+    _null = struct.pack("!i", -1)
+    _epoch = datetime(2000, 1, 1)
+    _epoch_utc = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+    def __init__(self, table, columns, binary=False, buffersize=65536):
+        self.table = table
+        self.columns = tuple(c[0] for c in columns)
+        self.binary = binary
+        self._types = tuple(c[1] for c in columns)
+        self._fieldcount = struct.pack("!h", len(columns))
+        self._buffer = bytearray(buffersize)
+        self._offsets = {}
+        self._timezone = None
+        if binary:
+            self._encoders = tuple(self._getEncoder(t) for t in self._types)
+        else:
+            self._encoders = tuple(
+                clean_value
+                if t in ("text", "varchar", "json", "jsonb")
+                else self._formatText
+                for t in self._types
+            )
+
+    def _getEncoder(self, pgtype):
+        if pgtype in ("text", "varchar", "json"):
+            return self._encodeText
+        elif pgtype == "jsonb":
+            return self._encodeJsonb
+        elif pgtype == "numeric":
+            return self._encodeNumeric
+        elif pgtype == "timestamptz":
+            return self._encodeTimestampTz
+        elif pgtype == "timestamp":
+            return self._encodeTimestamp
+        elif pgtype == "date":
+            return self._encodeDate
+        elif pgtype == "int4":
+            return self._encodeInt4
+        elif pgtype == "int8":
+            return self._encodeInt8
+        elif pgtype == "float8":
+            return self._encodeFloat8
+        elif pgtype == "bool":
+            return self._encodeBool
+        else:
+            raise Exception("Unsupported type for binary copy: %s" % pgtype)
+
+    @staticmethod
+    def _formatText(value):
+        return r"\N" if value is None else str(value)
+
+    @staticmethod
+    def _encodeText(value):
+        return str(value).encode("utf8")
+
+    @staticmethod
+    def _encodeJsonb(value):
+        return b"\x01" + str(value).encode("utf8")
+
+    @staticmethod
+    def _encodeNumeric(value):
+        if not isinstance(value, Decimal):
+            value = Decimal(str(value))
+        if value.is_nan():
+            return struct.pack("!hhHH", 0, 0, 0xC000, 0)
+        sign, digits, exp = value.as_tuple()
+        s = "".join(str(d) for d in digits)
+        if exp > 0:
+            s += "0" * exp
+            exp = 0
+        dscale = -exp
+        if dscale > len(s):
+            intpart = ""
+            fracpart = "0" * (dscale - len(s)) + s
+        else:
+            intpart = s[: len(s) - dscale]
+            fracpart = s[len(s) - dscale :]
+        # Align both parts on base-10000 digits
+        intpart = "0" * (-len(intpart) % 4) + intpart
+        fracpart += "0" * (-len(fracpart) % 4)
+        weight = len(intpart) // 4 - 1
+        groups = [int(intpart[i : i + 4]) for i in range(0, len(intpart), 4)]
+        groups.extend(int(fracpart[i : i + 4]) for i in range(0, len(fracpart), 4))
+        while groups and groups[0] == 0:
+            groups.pop(0)
+            weight -= 1
+        while groups and groups[-1] == 0:
+            groups.pop()
+        if not groups:
+            weight = 0
+        return struct.pack(
+            "!hhHH%dH" % len(groups),
+            len(groups),
+            weight,
+            0x4000 if sign else 0,
+            dscale,
+            *groups
+        )
+
+    def _encodeTimestamp(self, value):
+        delta = value - self._epoch
+        return struct.pack(
+            "!q", (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds,
+        )
+
+    def _encodeTimestampTz(self, value):
+        if value.tzinfo is None:
+            # Naive timestamps are interpreted in the time zone of the
+            # database connection, just like in the text format.
+            # The UTC offset is cached per hour.
+            hour = value.replace(minute=0, second=0, microsecond=0)
+            offset = self._offsets.get(hour)
+            if offset is None:
+                from django.utils.timezone import get_default_timezone, make_aware
+
+                if not self._timezone:
+                    self._timezone = get_default_timezone()
+                offset = make_aware(hour, self._timezone, is_dst=False).utcoffset()
+                self._offsets[hour] = offset
+            delta = value - offset - self._epoch
+        else:
+            delta = value - self._epoch_utc
+        return struct.pack(
+            "!q", (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds,
+        )
+
+    def _encodeDate(self, value):
+        return struct.pack("!i", (value - self._epoch.date()).days)
+
+    @staticmethod
+    def _encodeInt4(value):
+        return struct.pack("!i", value)
+
+    @staticmethod
+    def _encodeInt8(value):
+        return struct.pack("!q", value)
+
+    @staticmethod
+    def _encodeFloat8(value):
+        return struct.pack("!d", value)
+
+    @staticmethod
+    def _encodeBool(value):
+        return b"\x01" if value else b"\x00"
+
+    def text(self, records):
+        """
+        Generator of the records formatted as lines in the text copy format.
+        """
+        encoders = self._encoders
+        for rec in records:
+            yield "%s\n" % "\v".join([enc(val) for enc, val in zip(encoders, rec)])
+
+    def encode(self, records):
+        """
+        Generator of chunks of data in the binary copy format.
+        """
+        buf = self._buffer
+        size = len(buf)
+        buf[0 : len(self._header)] = self._header
+        pos = len(self._header)
+        encoders = self._encoders
+        fieldcount = self._fieldcount
+        null = self._null
+        for rec in records:
+            fields = [fieldcount]
+            for enc, val in zip(encoders, rec):
+                if val is None:
+                    fields.append(null)
+                else:
+                    data = enc(val)
+                    fields.append(struct.pack("!i", len(data)))
+                    fields.append(data)
+            row = b"".join(fields)
+            if pos + len(row) > size:
+                if pos:
+                    yield bytes(buf[0:pos])
+                    pos = 0
+                if len(row) > size:
+                    # Grow the buffer for huge records
+                    size = len(row)
+                    buf = self._buffer = bytearray(size)
+            buf[pos : pos + len(row)] = row
+            pos += len(row)
+        yield bytes(buf[0:pos]) + self._trailer
+
+    def copy(self, cursor, records):
+        """
+        Copies the records in the table.
+        """
+        if self.binary:
+            cursor.copy_expert(
+                "copy %s (%s) from stdin with (format binary)"
+                % (self.table, ",".join(self.columns)),
+                CopyFromBinaryGenerator(self.encode(records)),
+                size=len(self._buffer),
+            )
+        else:
+            cursor.copy_from(
+                CopyFromGenerator(self.text(records)),
+                self.table,
+                columns=self.columns,
+                size=1024,
+                sep="\v",
+            )
+
+
 class PlanTask:
     """
     Base class for steps in the plan generation process
@@ -129,6 +381,14 @@ class PlanTask:
     def run(cls, **kwargs):
         logger.warning("Warning: PlanTask doesn't implement the run method")
 
+    @classmethod
+    def execute(cls, **kwargs):
+        """
+        Called by the task sequence to run the task.
+        Subclasses can override it to run the task more than once.
+        """
+        cls.run(**kwargs)
+
     @classmethod
     def display(cls, indentlevel=0, **kwargs):
         logger.info(
@@ -209,7 +469,7 @@ class PlanTaskSequence(PlanTask):
                             datetime.now().strftime("%H:%M:%S"),
                         )
                     )
-                step.run(database=database, **kwargs)
+                step.execute(database=database, **kwargs)
                 logger.info(
                     "Finished '%s' at %s %s"
                     % (
@@ -234,12 +494,23 @@ class PlanTaskSequence(PlanTask):
                 self.task.save(using=database)
             raise
 
+    def execute(self, **kwargs):
+        self.run(**kwargs)
+
     def display(self, indentlevel=0, **kwargs):
         for i in self.steps:
             i.weight = i.getWeight(**kwargs)
             if i.weight is not None and i.weight >= 0:
                 i.display(indentlevel=indentlevel, **kwargs)
 
+    def __iter__(self):
+        # Iterate over all tasks, including the tasks of nested groups
+        for s in self.steps:
+            if isinstance(s, PlanTask):
+                yield from s
+            else:
+                yield s
+
     def getLabels(self, labellist):
         for t in self.steps:
             if t.label:
@@ -269,6 +540,8 @@ class PlanTaskSequence(PlanTask):
 class PlanTaskParallel(PlanTask):
     """
     Class that will execute a number of tasks in parallel groups.
+    Each group runs in its own thread, and thus uses its own database
+    connections.
     """
 
     class _PlanTaskThread(Thread):
@@ -284,6 +557,9 @@ class PlanTaskParallel(PlanTask):
                 self.seq.run(**self.kwargs)
             except Exception as e:
                 self.exception = e
+            finally:
+                # Django keeps a connection per thread
+                connections.close_all()
 
     def __init__(self):
         self.groups = {}
@@ -315,6 +591,9 @@ class PlanTaskParallel(PlanTask):
                 logger.error("Exception caught on thread %s" % t.name)
                 raise t.exception
 
+    def execute(self, **kwargs):
+        self.run(**kwargs)
+
     def display(self, indentlevel=0, **kwargs):
         for threadname, g in self.groups.items():
             g.weight = g.getWeight(**kwargs)
@@ -325,6 +604,10 @@ class PlanTaskParallel(PlanTask):
                 )
             g.display(indentlevel=indentlevel + 2, **kwargs)
 
+    def __iter__(self):
+        for g in self.groups.values():
+            yield from g
+
     def getLabels(self, labellist):
         for g in self.groups.values():
             g.getLabels(labellist)
@@ -446,6 +729,8 @@ class PlanTaskRegistry:
             cls.reg.task.status = "Cancelled"
             cls.reg.task.save(using=database)
             sys.exit(2)
+        # The parent scenarios of a delta scenario are passed to all tasks
+        kwargs.setdefault("parents", Scenario.getParents(database))
         cls.reg.run(cluster=cluster, database=database, **kwargs)
         logger.info("Finished planning at %s" % datetime.now().strftime("%H:%M:%S"))
 
@@ -463,11 +748,11 @@ if __name__ == "__main__":
     except:
         database = DEFAULT_DB_ALIAS
 
-    # Use the test database if we are running the test suite
+    # Use the test databases if we are running the test suite.
+    # A delta scenario also reads from the databases of its parent scenarios.
     if "FREPPLE_TEST" in os.environ:
-        settings.DATABASES[database]["NAME"] = settings.DATABASES[database]["TEST"][
-            "NAME"
-        ]
+        for db in settings.DATABASES:
+            settings.DATABASES[db]["NAME"] = settings.DATABASES[db]["TEST"]["NAME"]
 
     # Make sure the debug flag is not set!
     # When it is set, the Django database wrapper collects a list of all sql
@@ -502,6 +787,7 @@ if __name__ == "__main__":
 
     register.autodiscover()
     newstatus = "Done"
+    loaded = datetime.now()
     try:
         register.run(database=database)
     except Exception as e:
@@ -515,3 +801,17 @@ if __name__ == "__main__":
             task.processid = None
             task.status = newstatus
             task.save(update_fields=["processid", "status"], using=database)
+
+    # Prerender the dashboard widgets with the new plan
+    if newstatus == "Done":
+        from freppledb.common.dashboard import Dashboard
+
+        Dashboard.prerenderPlan(database)
+
+    # Keep the model in memory to serve replan requests
+    if "FREPPLE_SERVICE" in os.environ:
+        from freppledb.execute.service import PlanService
+
+        PlanService(
+            database=database, port=os.environ["FREPPLE_SERVICE"], loaded=loaded
+        ).serve()
@@ -15,17 +15,27 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import hashlib
 from importlib import import_module
 import logging
 
 from django.conf import settings
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
 from django.http import (
+    HttpRequest,
+    HttpResponse,
     HttpResponseNotAllowed,
     HttpResponseForbidden,
     HttpResponseServerError,
+    QueryDict,
 )
+from django.utils import translation
+
+from freppledb.common.models import Parameter, User, getTableVersions
+from freppledb.execute.models import Task
 
 logger = logging.getLogger(__name__)
 
@@ -50,6 +60,8 @@ class Dashboard:
       client browser.
       It should return HTML content for synchronous widgets.
       It should return a Django response object for asynchronous widgets.
+    - Class attribute 'cacheable' specifies whether the response of an
+      asynchronous widget can be shared by all users of a scenario.
   """
 
     __registry__ = {}
@@ -91,7 +103,13 @@ class Dashboard:
                 return HttpResponseServerError("This widget is synchronous")
             if not w.has_permission(request.user):
                 return HttpResponseForbidden()
-            return w.render(request)
+            if not w.cacheable:
+                return w.render(request)
+            key = cls.getCacheKey(w, request)
+            cached = cache.get(key)
+            if cached:
+                return HttpResponse(cached[0], content_type=cached[1])
+            return cls.renderCached(w, request, key)
         except Exception as e:
             logger.error("Exception rendering widget %s: %s" % (w.name, e))
             if settings.DEBUG:
@@ -99,6 +117,118 @@ class Dashboard:
             else:
                 return HttpResponseServerError("Server error")
 
+    @staticmethod
+    def getCacheKey(widget, request):
+        # The end time of the last task is part of the key: new plans and
+        # data loads make the cached widgets obsolete.
+        # The versions of the tables a widget lists are part of the key
+        # as well: interactive edits make those widgets obsolete.
+        return "widget:%s" % (
+            hashlib.md5(
+                repr(
+                    (
+                        widget.getCacheKey(request),
+                        Task.lastFinished(request.database),
+                        getTableVersions(request.database, widget.tables),
+                    )
+                ).encode("utf-8")
+            ).hexdigest()
+        )
+
+    @staticmethod
+    def renderCached(widget, request, key):
+        response = widget.render(request)
+        if response.status_code == 200 and not response.streaming:
+            cache.set(
+                key,
+                (response.content, response["Content-Type"]),
+                getattr(settings, "DASHBOARD_CACHE_TIMEOUT", 600),
+            )
+        return response
+
+    @classmethod
+    def prerenderPlan(cls, database=DEFAULT_DB_ALIAS):
+        """
+        Prerenders the dashboards after a plan generation, when the parameter
+        plan.prerenderDashboard is set to true.
+        Errors are logged and don't affect the plan generation.
+        """
+        try:
+            if (
+                Parameter.getValue("plan.prerenderDashboard", database, "false").lower()
+                == "true"
+            ):
+                cls.prerender(database)
+        except Exception as e:
+            logger.error("Error prerendering the dashboard: %s" % e)
+
+    @classmethod
+    def prerender(cls, database=DEFAULT_DB_ALIAS):
+        """
+        Renders the cacheable widgets on the dashboards of all active users
+        of a scenario, so the dashboards are displayed from the cache after
+        the plan generation.
+        This is only useful when the cache backend is shared between the
+        processes, eg the database or memcached cache backends.
+        """
+        from freppledb.common.middleware import _thread_locals
+
+        reg = cls.buildList()
+        done = set()
+        try:
+            for user in User.objects.all().using(database).filter(is_active=True):
+                mydashboard = user.getPreference(
+                    "freppledb.common.cockpit", database=database
+                )
+                if not mydashboard:
+                    mydashboard = settings.DEFAULT_DASHBOARD
+                language = user.language
+                if language == "auto":
+                    language = settings.LANGUAGE_CODE
+                with translation.override(language):
+                    for i in mydashboard:
+                        for j in i["cols"]:
+                            for k in j["widgets"]:
+                                w = reg.get(k[0], None)
+                                if (
+                                    not w
+                                    or not w.cacheable
+                                    or not w.has_permission(user)
+                                ):
+                                    continue
+                                widget = w(**k[1])
+                                args = (
+                                    widget.args()
+                                    if callable(widget.args)
+                                    else widget.args
+                                )
+                                request = HttpRequest()
+                                request.method = "GET"
+                                request.GET = QueryDict(args.lstrip("?"))
+                                request.user = user
+                                request.database = database
+                                request.prefix = (
+                                    ""
+                                    if database == DEFAULT_DB_ALIAS
+                                    else "/%s" % database
+                                )
+                                request.LANGUAGE_CODE = translation.get_language()
+                                _thread_locals.request = request
+                                key = cls.getCacheKey(w, request)
+                                if key in done:
+                                    continue
+                                done.add(key)
+                                try:
+                                    cls.renderCached(w, request, key)
+                                except Exception as e:
+                                    logger.error(
+                                        "Exception rendering widget %s: %s"
+                                        % (w.name, e)
+                                    )
+        finally:
+            _thread_locals.request = None
+        logger.info("Prerendered %d dashboard widgets" % len(done))
+
     @classmethod
     def createWidgetPermissions(cls, app):
         # Registered all permissions defined by dashboard widgets
@@ -142,6 +272,13 @@ class Widget:
       It returns a HTTPResponse object for asynchronous widgets.
     - Class attribute 'url' optionally defines a url to a report with a more
       complete content than can be displayed in the dashboard widget.
+    - Class attribute 'cacheable' can be set to true for asynchronous widgets
+      that display plan data. Their response is then cached and shared by
+      all users of a scenario, until the next task finishes or the timeout
+      in the setting DASHBOARD_CACHE_TIMEOUT expires.
+    - Class attribute 'tables' lists the tables a cacheable widget displays
+      and that users can edit interactively. An edit in any of these tables
+      also refreshes the cached response.
   """
 
     name = "Undefined"
@@ -150,6 +287,8 @@ class Widget:
     asynchronous = False  # Asynchroneous widget
     url = None  # URL opened when the header is clicked
     exporturl = False  # Enable or disable a download icon
+    cacheable = False  # Response is shared by all users of a scenario
+    tables = ()  # Edited tables that make the cached response obsolete
     args = ""  # Arguments passed in the url for asynchronous widgets
     javascript = ""  # Javascript called for rendering the widget
 
@@ -168,6 +307,20 @@ class Widget:
                 return False
         return True
 
+    @classmethod
+    def getCacheKey(cls, request):
+        """
+    Returns the values that identify a cached response of the widget.
+    Widgets with content depending on the user need to add the relevant
+    user settings.
+    """
+        return (
+            request.database,
+            cls.name,
+            translation.get_language(),
+            sorted(i for i in request.GET.lists() if i[0] != "_"),
+        )
+
     @classmethod
     def getAppLabel(cls):
         """
@@ -17,13 +17,17 @@
 
 from datetime import timedelta, datetime
 from decimal import Decimal
+import json
 from logging import INFO, ERROR, WARNING, DEBUG
+from psycopg2.extras import Json
 
 from django import forms
 from django.contrib.admin.models import LogEntry, CHANGE, ADDITION
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
 from django.core.validators import EMPTY_VALUES
-from django.db import DEFAULT_DB_ALIAS
+from django.db import connections, transaction, DatabaseError, DEFAULT_DB_ALIAS
+from django.db import models
 from django.db.models.fields import (
     IntegerField,
     AutoField,
@@ -45,6 +49,17 @@ from django.utils.translation import gettext_lazy as _
 from django.utils.encoding import force_text
 from django.utils.text import get_text_list
 
+from freppledb.common.commands import CopyEncoder
+from freppledb.common.models import (
+    AuditModel,
+    HierarchyModel,
+    Scenario,
+    updateTableVersion,
+)
+
+# Number of data rows validated and saved together in bulk mode
+BULK_CHUNKSIZE = 1000
+
 
 def parseExcelWorksheet(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False):
     class MappedRow:
@@ -256,14 +271,50 @@ def parseCSVdata(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False):
         return _parseData(model, data, MappedRow, user, database, ping)
 
 
+def _bulkUpload(model):
+    """
+    Returns True when the records of this model can be saved in bulk, ie when
+    the save method of the model doesn't add any logic we can't mimic.
+    """
+    if hasattr(model, "getModelForm") or isinstance(model._meta.pk, AutoField):
+        return False
+    for cls in model.__mro__:
+        if "save" in vars(cls) and cls not in (
+            AuditModel,
+            HierarchyModel,
+            models.Model,
+        ):
+            return False
+    return True
+
+
+def _copyValue(value):
+    """
+    Formats a value prepared for the database as a string for the text format
+    of the copy command.
+    """
+    if value is None or isinstance(value, str):
+        return value
+    elif isinstance(value, Json):
+        # A json value adapted by psycopg2 as an sql literal
+        return json.dumps(value.adapted)
+    elif isinstance(value, timedelta):
+        return "%s seconds" % value.total_seconds()
+    else:
+        return str(value)
+
+
 def _parseData(model, data, rowmapper, user, database, ping):
 
     selfReferencing = []
 
+    # A delta scenario can refer to the records of its parent scenarios
+    parents = Scenario.getParents(database)
+
     def formfieldCallback(f):
         # global selfReferencing
         if isinstance(f, RelatedField):
-            tmp = BulkForeignKeyFormField(field=f, using=database)
+            tmp = BulkForeignKeyFormField(field=f, using=database, parents=parents)
             if f.remote_field.model == model:
                 selfReferencing.append(tmp)
             return tmp
@@ -283,10 +334,210 @@ def _parseData(model, data, rowmapper, user, database, ping):
     if hasattr(model, "beforeUpload"):
         model.beforeUpload(database)
 
+    def logChange(obj, isupdate, changed_data):
+        nonlocal admin_log
+        if not user:
+            return
+        admin_log.append(
+            LogEntry(
+                user_id=user.id,
+                content_type_id=content_type_id,
+                object_id=obj.pk,
+                object_repr=force_text(obj)[:200],
+                action_flag=isupdate and CHANGE or ADDITION,
+                # . Translators: Translation included with Django
+                change_message="Changed %s." % get_text_list(changed_data, "and"),
+            )
+        )
+        if len(admin_log) > 100:
+            LogEntry.objects.all().using(database).bulk_create(admin_log)
+            admin_log = []
+
+    def formErrors(form, rownumber):
+        for error in form.non_field_errors():
+            yield (ERROR, rownumber, None, None, error)
+        for field in form:
+            for error in field.errors:
+                yield (ERROR, rownumber, field.name, rowWrapper[field.name], error)
+
+    def bulkProcess(pending):
+        """
+        Validates a chunk of data rows, using a single query to read the
+        existing records, and saves the valid rows with bulkSave.
+        """
+        nonlocal errors
+        pkfield = model._meta.pk
+        keys = {}
+        for rownum, row in pending:
+            rowWrapper.setData(row)
+            try:
+                keys[rownum] = pkfield.to_python(rowWrapper[pkfield.name])
+            except ValidationError:
+                # Reported by the form validation
+                keys[rownum] = None
+        existing = model.objects.using(database).in_bulk(
+            list({k for k in keys.values() if k is not None})
+        )
+        staged = []
+        for rownum, row in pending:
+            try:
+                rowWrapper.setData(row)
+                it = existing.get(keys[rownum])
+                if it:
+                    form = BulkUploadForm(rowWrapper, instance=it)
+                else:
+                    form = BulkUploadForm(rowWrapper)
+                if not form.has_changed():
+                    continue
+                if form.is_valid():
+                    obj = form.save(commit=False)
+                    staged.append((rownum, obj, it is not None, form.changed_data))
+                    if not it:
+                        # Later rows with the same key update the new record
+                        existing[obj.pk] = obj
+                        for x in selfReferencing:
+                            if x.cache is not None and obj.pk not in x.cache:
+                                x.cache[obj.pk] = obj
+                else:
+                    # Validation fails
+                    for error in formErrors(form, rownum):
+                        errors += 1
+                        yield error
+            except Exception as e:
+                errors += 1
+                yield (ERROR, None, None, None, "Exception during upload: %s" % e)
+        if staged:
+            yield from bulkSave(staged)
+
+    def bulkSave(staged):
+        """
+        Saves the validated records with a copy into a temporary table and a
+        single insert statement.
+        When the database refuses the data, we save the records one by one
+        to report the rows that fail.
+        """
+        nonlocal changed, added, errors
+        connection = connections[database]
+        now = datetime.now()
+        records = {}
+        moved = set()
+        for rownum, obj, isupdate, changed_data in staged:
+            # Mimic the save method of the model: only new records and
+            # records with a new owner need a new place in the hierarchy
+            if isinstance(obj, AuditModel):
+                obj.lastmodified = now
+            if isinstance(obj, HierarchyModel) and (
+                obj._state.adding or obj.owner_id != getattr(obj, "_loaded_owner", 0)
+            ):
+                obj.lft = None
+                obj.rght = None
+                obj.lvl = None
+                moved.add(obj.pk)
+            records[obj.pk] = obj
+        columns = model._meta.concrete_fields
+        updated = [
+            model._meta.get_field(f).column for f in fields if f != model._meta.pk.name
+        ]
+        if issubclass(model, AuditModel):
+            updated.append("lastmodified")
+        table = connection.ops.quote_name(model._meta.db_table)
+        collist = ",".join(connection.ops.quote_name(f.column) for f in columns)
+        if updated:
+            action = "update set %s" % ", ".join(
+                "%s = excluded.%s"
+                % (connection.ops.quote_name(c), connection.ops.quote_name(c))
+                for c in updated
+            )
+        else:
+            action = "nothing"
+        try:
+            with transaction.atomic(using=database):
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "create temporary table tmp_upload as select %s from %s limit 0"
+                        % (collist, table)
+                    )
+                    CopyEncoder(
+                        "tmp_upload", [(f.column, "text") for f in columns]
+                    ).copy(
+                        cursor,
+                        (
+                            [
+                                _copyValue(
+                                    f.get_db_prep_save(
+                                        getattr(obj, f.attname), connection
+                                    )
+                                )
+                                for f in columns
+                            ]
+                            for obj in records.values()
+                        ),
+                    )
+                    cursor.execute(
+                        """
+                        insert into %s (%s)
+                        select %s from tmp_upload
+                        on conflict (%s) do %s
+                        """
+                        % (
+                            table,
+                            collist,
+                            collist,
+                            connection.ops.quote_name(model._meta.pk.column),
+                            action,
+                        )
+                    )
+                    cursor.execute("drop table tmp_upload")
+                    if moved:
+                        cursor.execute(
+                            """
+                            update %s set lft = null, rght = null, lvl = null
+                            where %s = any(%%s)
+                            """
+                            % (
+                                table,
+                                connection.ops.quote_name(model._meta.pk.column),
+                            ),
+                            (list(moved),),
+                        )
+            # The copy doesn't send the signals of the model
+            transaction.on_commit(
+                lambda: updateTableVersion(database, model._meta.db_table),
+                using=database,
+            )
+            if moved:
+                model.updateHierarchyOnCommit(database)
+        except DatabaseError:
+            for rownum, obj, isupdate, changed_data in staged:
+                try:
+                    with transaction.atomic(using=database):
+                        if isupdate:
+                            obj.save(using=database, force_update=True)
+                        else:
+                            obj.save(using=database, force_insert=True)
+                except DatabaseError as e:
+                    errors += 1
+                    yield (ERROR, rownum, None, None, "Exception during upload: %s" % e)
+                    continue
+                if isupdate:
+                    changed += 1
+                else:
+                    added += 1
+                logChange(obj, isupdate, changed_data)
+            return
+        for rownum, obj, isupdate, changed_data in staged:
+            if isupdate:
+                changed += 1
+            else:
+                added += 1
+            logChange(obj, isupdate, changed_data)
+
     errors = 0
     warnings = 0
     has_pk_field = False
     processed_header = False
+    bulk = False
+    pending = []
     rowWrapper = rowmapper()
     for row in data:
 
@@ -407,6 +658,21 @@ def _parseData(model, data, rowmapper, user, database, ping):
                 ):
                     natural_key = model.natural_key
 
+            # Bulk mode validates and saves chunks of rows
+            bulk = has_pk_field and _bulkUpload(model)
+            if bulk:
+
+                class BulkUploadForm(UploadForm):
+                    def validate_unique(self):
+                        # The primary key is already checked when reading
+                        # the existing records.
+                        exclude = self._get_validation_exclusions()
+                        exclude.append(model._meta.pk.name)
+                        try:
+                            self.instance.validate_unique(exclude=exclude)
+                        except ValidationError as e:
+                            self._update_errors(e)
+
         # Case 3: Process a data row
         else:
             try:
@@ -417,6 +683,13 @@ def _parseData(model, data, rowmapper, user, database, ping):
                         pingcounter = 0
                         yield (DEBUG, rownumber, None, None, None)
 
+                if bulk:
+                    pending.append((rownumber, row))
+                    if len(pending) >= BULK_CHUNKSIZE:
+                        yield from bulkProcess(pending)
+                        pending = []
+                    continue
+
                 # Step 2: Fill the form with data, either updating an existing
                 # instance or creating a new one.
                 if has_pk_field:
@@ -474,44 +747,21 @@ def _parseData(model, data, rowmapper, user, database, ping):
                             for x in selfReferencing:
                                 if x.cache is not None and obj.pk not in x.cache:
                                     x.cache[obj.pk] = obj
-                        if user:
-                            admin_log.append(
-                                LogEntry(
-                                    user_id=user.id,
-                                    content_type_id=content_type_id,
-                                    object_id=obj.pk,
-                                    object_repr=force_text(obj)[:200],
-                                    action_flag=it and CHANGE or ADDITION,
-                                    # . Translators: Translation included with Django
-                                    change_message="Changed %s."
-                                    % get_text_list(form.changed_data, "and"),
-                                )
-                            )
-                            if len(admin_log) > 100:
-                                LogEntry.objects.all().using(database).bulk_create(
-                                    admin_log
-                                )
-                                admin_log = []
+                        logChange(obj, it, form.changed_data)
                     else:
                         # Validation fails
-                        for error in form.non_field_errors():
+                        for error in formErrors(form, rownumber):
                             errors += 1
-                            yield (ERROR, rownumber, None, None, error)
-                        for field in form:
-                            for error in field.errors:
-                                errors += 1
-                                yield (
-                                    ERROR,
-                                    rownumber,
-                                    field.name,
-                                    rowWrapper[field.name],
-                                    error,
-                                )
+                            yield error
 
             except Exception as e:
                 errors += 1
                 yield (ERROR, None, None, None, "Exception during upload: %s" % e)
 
+    # Save the remaining rows in bulk mode
+    if pending:
+        yield from bulkProcess(pending)
+
     # Save remaining admin log entries
     LogEntry.objects.all().using(database).bulk_create(admin_log)
 
@@ -541,6 +791,7 @@ class BulkForeignKeyFormField(forms.fields.Field):
         required=None,
         label=None,
         help_text="",
+        parents=(),
         *args,
         **kwargs
     ):
@@ -554,19 +805,29 @@ class BulkForeignKeyFormField(forms.fields.Field):
         )
 
         # Build a cache with the list of values - as long as it reasonable fits in memory
+        # The values are searched in the database and then in its parent
+        # scenarios, if any.
         self.model = field.remote_field.model
+        self.using = using
         field.remote_field.parent_link = (
             True
         )  # A trick to disable the model validation on foreign keys!
-        if field.remote_field.model._default_manager.all().using(using).count() > 20000:
-            self.queryset = field.remote_field.model._default_manager.all().using(using)
+        databases = [using] + list(parents)
+        if (
+            sum(self.model._default_manager.all().using(db).count() for db in databases)
+            > 20000
+        ):
+            self.querysets = [
+                self.model._default_manager.all().using(db) for db in databases
+            ]
             self.cache = None
         else:
-            self.queryset = None
-            self.cache = {
-                obj.pk: obj
-                for obj in field.remote_field.model._default_manager.all().using(using)
-            }
+            self.querysets = None
+            self.cache = {}
+            for db in reversed(databases):
+                for obj in self.model._default_manager.all().using(db):
+                    obj._state.db = using
+                    self.cache[obj.pk] = obj
 
     def to_python(self, value):
         if value in EMPTY_VALUES:
@@ -575,22 +836,21 @@ class BulkForeignKeyFormField(forms.fields.Field):
             try:
                 return self.cache[value]
             except KeyError:
-                # fmt: off
-                raise forms.ValidationError(
-                    # . Translators: Translation included with Django
-                    _("Select a valid choice. That choice is not one of the available choices.")
-                )
-                # fmt: on
+                pass
         else:
-            try:
-                return self.queryset.get(pk=value)
-            except self.model.DoesNotExist:
-                # fmt: off
-                raise forms.ValidationError(
-                    # . Translators: Translation included with Django
-                    _("Select a valid choice. That choice is not one of the available choices.")
-                )
-                # fmt: on
+            for qs in self.querysets:
+                try:
+                    obj = qs.get(pk=value)
+                    obj._state.db = self.using
+                    return obj
+                except self.model.DoesNotExist:
+                    pass
+        # fmt: off
+        raise forms.ValidationError(
+            # . Translators: Translation included with Django
+            _("Select a valid choice. That choice is not one of the available choices.")
+        )
+        # fmt: on
 
     def has_changed(self, initial, data):
         return initial != data
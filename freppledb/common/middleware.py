@@ -172,13 +172,18 @@ class MultiDBMiddleware:
     def __call__(self, request):
         if not hasattr(request, "user"):
             request.user = auth.get_user(request)
+        if not request.user.is_anonymous:
+            # Allows caching the user preferences across requests
+            request.user.preferenceVersion = request.session.get("preferences", 0)
         if not hasattr(request.user, "scenarios"):
             # A scenario list is not available on the request
+            scenarios = None
             for i in settings.DATABASES:
                 try:
                     if settings.DATABASES[i]["regexp"].match(request.path):
-                        scenario = Scenario.objects.using(DEFAULT_DB_ALIAS).get(name=i)
-                        if scenario.status != "In use":
+                        if scenarios is None:
+                            scenarios = {s.name: s for s in Scenario.getScenarios()}
+                        if scenarios[i].status != "In use":
                             return HttpResponseNotFound("Scenario not in use")
                         request.prefix = "/%s" % i
                         request.path_info = request.path_info[len(request.prefix) :]
@@ -14,9 +14,10 @@
 # You should have received a copy of the GNU Affero General Public
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import copy
 from datetime import datetime
 import logging
-from psycopg2.extras import execute_batch
+from threading import Lock, Thread
 
 from django.conf import settings
 from django.contrib.admin.utils import quote
@@ -24,20 +25,30 @@ from django.contrib.auth.models import AbstractUser, Group
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import PermissionDenied
-from django.db import models, DEFAULT_DB_ALIAS, connections, transaction
+from django.db import models, router, DEFAULT_DB_ALIAS, connections, transaction
 from django.db.models import Q
-from django.db.models.signals import pre_delete
+from django.db.models.signals import class_prepared, pre_delete, post_delete, post_save
 from django.dispatch.dispatcher import receiver
 from django.urls import NoReverseMatch, reverse
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.utils.text import capfirst
 
+from .cache import LRUCache
 from .fields import JSONBField
 
 
 logger = logging.getLogger(__name__)
 
+# In-process cache with the scenarios and the user preferences. Changes made
+# by other processes are only seen when the cached entries expire.
+metadataCache = LRUCache(16 * 1024 * 1024)
+metadataTimeout = 60
+
+# Hierarchies being rebuilt by a background thread
+hierarchyRebuilds = set()
+hierarchyLock = Lock()
+
 
 class HierarchyModel(models.Model):
     lft = models.PositiveIntegerField(
@@ -59,31 +70,240 @@ class HierarchyModel(models.Model):
         on_delete=models.SET_NULL,
     )
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the key and the owner to detect inserts and moves in the
+        # hierarchy
+        instance._loaded_pk = instance.pk
+        if "owner_id" in field_names:
+            instance._loaded_owner = values[field_names.index("owner_id")]
+        return instance
+
     def save(self, *args, **kwargs):
-        # Trigger recalculation of the hieracrhy.
-        # TODO this triggers the recalculation in too many cases, including a lot
-        # of changes which don't require it. Alternative solution is to use the
-        # pre-save signal which has more information.
-        self.lft = None
-        self.rght = None
-        self.lvl = None
+        if (
+            not self._state.adding
+            and not kwargs.get("force_insert", False)
+            and self.pk == getattr(self, "_loaded_pk", None)
+            and self.owner_id == getattr(self, "_loaded_owner", 0)
+        ):
+            # Changes without a new owner leave the hierarchy fields as they
+            # are in the database.
+            if not kwargs.get("update_fields", None):
+                kwargs["update_fields"] = [
+                    f.name
+                    for f in self._meta.concrete_fields
+                    if not f.primary_key and f.name not in ("lft", "rght", "lvl")
+                ]
+            super().save(*args, **kwargs)
+            return
 
-        # Call the real save() method
-        super().save(*args, **kwargs)
+        # A new record, a copy saved with a new key or a record moving to
+        # another owner: update the hierarchy fields of the affected records
+        using = kwargs.get("using", None) or router.db_for_write(
+            self.__class__, instance=self
+        )
+        with transaction.atomic(using=using):
+            interval = self.__class__._lockHierarchy(using, self.pk)
+            self.lft, self.rght, self.lvl = interval or (None, None, None)
+            super().save(*args, **kwargs)
+            interval = self.__class__._placeNode(
+                using, self.pk, self.owner_id, interval
+            )
+        self.lft, self.rght, self.lvl = interval or (None, None, None)
+        self._loaded_pk = self.pk
+        self._loaded_owner = self.owner_id
 
     def delete(self, *args, **kwargs):
-        try:
-            # Update an arbitrary other object to trigger recalculation of the hierarchy
-            obj = self.__class__.objects.using(self._state.db).exclude(pk=self.pk)[0]
-            obj.lft = None
-            obj.rght = None
-            obj.lvl = None
-            obj.save(update_fields=["lft", "rght", "lvl"], using=self._state.db)
-        except:
-            # Failure can happen when eg we delete the last record
-            pass
-        # Call the real delete() method
-        super().delete(*args, **kwargs)
+        using = kwargs.get("using", None) or router.db_for_write(
+            self.__class__, instance=self
+        )
+        with transaction.atomic(using=using):
+            interval = self.__class__._lockHierarchy(using, self.pk)
+            if interval and None not in interval:
+                # Close the gap of the deleted record, and move the children
+                # that lose their owner to the end as top-level records
+                lft, rght, lvl = interval
+                with connections[using].cursor() as cursor:
+                    cursor.execute(
+                        """
+                        update %s set
+                          lft = case
+                            when lft > %%s and lft < %%s then lft + maxrght - %%s - 1
+                            when lft > %%s then lft - %%s
+                            else lft end,
+                          rght = case
+                            when rght > %%s and rght < %%s then rght + maxrght - %%s - 1
+                            when rght > %%s then rght - %%s
+                            else rght end,
+                          lvl = case
+                            when lft > %%s and lft < %%s then lvl - %%s - 1
+                            else lvl end
+                        from (select max(rght) as maxrght from %s) m
+                        where rght > %%s
+                        """
+                        % (
+                            (connections[using].ops.quote_name(self._meta.db_table),)
+                            * 2
+                        ),
+                        (
+                            lft,
+                            rght,
+                            rght,
+                            rght,
+                            rght - lft + 1,
+                            lft,
+                            rght,
+                            rght,
+                            rght,
+                            rght - lft + 1,
+                            lft,
+                            rght,
+                            lvl,
+                            lft,
+                        ),
+                    )
+            else:
+                self.__class__.updateHierarchyOnCommit(using)
+            return super().delete(*args, **kwargs)
+
+    @classmethod
+    def _lockHierarchy(cls, database, name):
+        """
+        Locks the hierarchy till the end of the transaction, and returns the
+        current hierarchy fields of a record.
+        """
+        with connections[database].cursor() as cursor:
+            cursor.execute(
+                "select pg_advisory_xact_lock(hashtext(%s))", (cls._meta.db_table,)
+            )
+            if not name:
+                return None
+            cursor.execute(
+                "select lft, rght, lvl from %s where name = %%s"
+                % connections[database].ops.quote_name(cls._meta.db_table),
+                (name,),
+            )
+            return cursor.fetchone()
+
+    @classmethod
+    def _placeNode(cls, database, name, owner, interval):
+        """
+        Updates the hierarchy fields for a record that is added or moved, and
+        returns the new hierarchy fields of the record.
+        Only the records between the old and new position are updated.
+        When the hierarchy isn't up to date, a complete rebuild is scheduled
+        instead.
+        """
+        table = connections[database].ops.quote_name(cls._meta.db_table)
+        with connections[database].cursor() as cursor:
+            if owner:
+                cursor.execute(
+                    "select lft, rght, lvl from %s where name = %%s" % table, (owner,)
+                )
+                parent = cursor.fetchone()
+            else:
+                parent = None
+            if (owner and (not parent or None in parent)) or (
+                interval and None in interval
+            ):
+                # The hierarchy needs a complete rebuild
+                cursor.execute(
+                    "update %s set lft = null, rght = null, lvl = null where name = %%s"
+                    % table,
+                    (name,),
+                )
+                cls.updateHierarchyOnCommit(database)
+                return None
+
+            # New position of the record
+            if parent:
+                position = parent[1]
+                level = parent[2] + 1
+            else:
+                cursor.execute("select coalesce(max(rght), 0) + 1 from %s" % table)
+                position = cursor.fetchone()[0]
+                level = 0
+
+            if not interval:
+                # Insert a leaf record
+                if parent:
+                    cursor.execute(
+                        """
+                        update %s set
+                          lft = case when lft > %%s then lft + 2 else lft end,
+                          rght = rght + 2
+                        where rght >= %%s
+                        """
+                        % table,
+                        (position, position),
+                    )
+                cursor.execute(
+                    "update %s set lft = %%s, rght = %%s, lvl = %%s where name = %%s"
+                    % table,
+                    (position, position + 1, level, name),
+                )
+                return (position, position + 1, level)
+
+            # Move a record and its children
+            lft, rght, lvl = interval
+            width = rght - lft + 1
+            if parent and parent[0] >= lft and parent[0] <= rght:
+                # The new owner is a child of the record: this loop is
+                # reported by the rebuild
+                cursor.execute(
+                    "update %s set lft = null, rght = null, lvl = null where name = %%s"
+                    % table,
+                    (name,),
+                )
+                cls.updateHierarchyOnCommit(database)
+                return None
+            if position > rght:
+                # Move to the right
+                shift = position - rght - 1
+                low, high, delta = rght + 1, position - 1, -width
+            else:
+                # Move to the left
+                shift = position - lft
+                low, high, delta = position, lft - 1, width
+            cursor.execute(
+                """
+                update %s set
+                  lft = lft + case
+                    when lft between %%s and %%s then %%s
+                    when lft between %%s and %%s then %%s
+                    else 0 end,
+                  rght = rght + case
+                    when rght between %%s and %%s then %%s
+                    when rght between %%s and %%s then %%s
+                    else 0 end,
+                  lvl = lvl + case when lft between %%s and %%s then %%s else 0 end
+                where lft between %%s and %%s or rght between %%s and %%s
+                """
+                % table,
+                (
+                    lft,
+                    rght,
+                    shift,
+                    low,
+                    high,
+                    delta,
+                    lft,
+                    rght,
+                    shift,
+                    low,
+                    high,
+                    delta,
+                    lft,
+                    rght,
+                    level - lvl,
+                    min(lft, low),
+                    max(rght, high),
+                    min(lft, low),
+                    max(rght, high),
+                ),
+            )
+            return (lft + shift, rght + shift, level)
 
     class Meta:
         abstract = True
@@ -96,84 +316,117 @@ class HierarchyModel(models.Model):
         if len(cls.objects.using(database).filter(lft__isnull=True)[:1]) == 0:
             return
 
-        nodes = {}
-        children = {}
-        updates = []
-
-        def tagChildren(me, left, level):
-            right = left + 1
-            # Get all children of this node
-            for i in children.get(me, []):
-                # Recursive execution of this function for each child of this node
-                right = tagChildren(i, right, level + 1)
-
-            # After processing the children of this node now know its left and right values
-            updates.append((left, right, level, me))
-
-            # Remove from node list (to mark as processed)
-            del nodes[me]
-
-            # Return the right value of this node + 1
-            return right + 1
-
-        # Load all nodes in memory
-        for i in cls.objects.using(database).values("name", "owner"):
-            if i["name"] == i["owner"]:
-                logging.error("Data error: '%s' points to itself as owner" % i["name"])
-                nodes[i["name"]] = None
-            else:
-                nodes[i["name"]] = i["owner"]
-                if i["owner"]:
-                    if not i["owner"] in children:
-                        children[i["owner"]] = set()
-                    children[i["owner"]].add(i["name"])
-        keys = sorted(nodes.items())
-
-        # Loop over nodes without parent
-        cnt = 1
-        for i, j in keys:
-            if j is None:
-                cnt = tagChildren(i, cnt, 0)
-
-        if nodes:
-            # If the nodes dictionary isn't empty, it is an indication of an
-            # invalid hierarchy.
-            # There are loops in your hierarchy, ie parent-chains not ending
-            # at a top-level node without parent.
-            bad = nodes.copy()
-            updated = True
-            while updated:
-                updated = False
-                for i in bad.keys():
-                    ok = True
-                    for j, k in bad.items():
-                        if k == i:
-                            ok = False
-                            break
-                    if ok:
-                        # If none of the bad keys points to me as a parent, I am unguilty
-                        del bad[i]
-                        updated = True
-            logging.error("Data error: Hierarchy loops among %s" % sorted(bad.keys()))
-            for i, j in sorted(bad.items()):
-                children[j].remove(i)
-                nodes[i] = None
-
-            # Continue loop over nodes without parent
+        with transaction.atomic(using=database):
+            cls._lockHierarchy(database, None)
+            # Another process may have rebuilt the hierarchy while we waited
+            # for the lock
+            if not cls.objects.using(database).filter(lft__isnull=True).exists():
+                return
+            nodes = {}
+            children = {}
+            updates = []
+
+            def tagChildren(root, left):
+                # Depth-first traversal with an explicit stack, to handle deep
+                # hierarchies
+                lefts = {root: left}
+                right = left + 1
+                stack = [(root, iter(sorted(children.get(root, []))))]
+                while stack:
+                    me, todo = stack[-1]
+                    child = next(todo, None)
+                    if child is not None:
+                        lefts[child] = right
+                        right += 1
+                        stack.append((child, iter(sorted(children.get(child, [])))))
+                    else:
+                        # All children of this node are processed now
+                        stack.pop()
+                        updates.append((me, lefts.pop(me), right, len(stack)))
+                        # Remove from node list (to mark as processed)
+                        del nodes[me]
+                        right += 1
+                # Return the right value of the root + 1
+                return right
+
+            # Load all nodes in memory
+            for i in cls.objects.using(database).values("name", "owner"):
+                if i["name"] == i["owner"]:
+                    logging.error(
+                        "Data error: '%s' points to itself as owner" % i["name"]
+                    )
+                    nodes[i["name"]] = None
+                else:
+                    nodes[i["name"]] = i["owner"]
+                    if i["owner"]:
+                        if not i["owner"] in children:
+                            children[i["owner"]] = set()
+                        children[i["owner"]].add(i["name"])
+            # An owner stored in a parent scenario of a delta scenario makes
+            # the record a top-level node in this database
+            for i, j in nodes.items():
+                if j is not None and j not in nodes:
+                    nodes[i] = None
             keys = sorted(nodes.items())
+
+            # Loop over nodes without parent
+            cnt = 1
             for i, j in keys:
                 if j is None:
-                    cnt = tagChildren(i, cnt, 0)
-
-        # Write all results to the database
-        with transaction.atomic(using=database):
-            cursor = connections[database].cursor()
-            execute_batch(
-                cursor,
-                "update %s set lft=%%s, rght=%%s, lvl=%%s where name = %%s"
-                % connections[database].ops.quote_name(cls._meta.db_table),
-                updates,
-            )
+                    cnt = tagChildren(i, cnt)
+
+            if nodes:
+                # If the nodes dictionary isn't empty, it is an indication of an
+                # invalid hierarchy.
+                # There are loops in your hierarchy, ie parent-chains not ending
+                # at a top-level node without parent.
+                bad = nodes.copy()
+                updated = True
+                while updated:
+                    updated = False
+                    for i in list(bad.keys()):
+                        ok = True
+                        for j, k in bad.items():
+                            if k == i:
+                                ok = False
+                                break
+                        if ok:
+                            # If none of the bad keys points to me as a parent, I am unguilty
+                            del bad[i]
+                            updated = True
+                logging.error(
+                    "Data error: Hierarchy loops among %s" % sorted(bad.keys())
+                )
+                for i, j in sorted(bad.items()):
+                    children[j].remove(i)
+                    nodes[i] = None
+
+                # Continue loop over nodes without parent
+                keys = sorted(nodes.items())
+                for i, j in keys:
+                    if j is None:
+                        cnt = tagChildren(i, cnt)
+
+            # Write all changed results to the database in a single statement
+            if updates:
+                with connections[database].cursor() as cursor:
+                    cursor.execute(
+                        """
+                        update %s as t
+                        set lft = v.lft, rght = v.rght, lvl = v.lvl
+                        from unnest(%%s::text[], %%s::integer[], %%s::integer[], %%s::integer[])
+                          as v(name, lft, rght, lvl)
+                        where t.name = v.name
+                        and (t.lft, t.rght, t.lvl) is distinct from (v.lft, v.rght, v.lvl)
+                        """
+                        % connections[database].ops.quote_name(cls._meta.db_table),
+                        [list(i) for i in zip(*updates)],
+                    )
+                # Reports cached against the old hierarchy are stale now
+                transaction.on_commit(
+                    lambda: updateTableVersion(database, cls._meta.db_table),
+                    using=database,
+                )
 
     @classmethod
     def createRootObject(cls, database=DEFAULT_DB_ALIAS):
@@ -191,20 +444,57 @@ class HierarchyModel(models.Model):
             o = cls.objects.using(database).get_or_create(name=rootname)
             if o[1]:
                 o[0].description = "Automatically created root object"
-            else:
-                o[
-                    0
-                ].lft = (
-                    None
-                )  # This is to force hierarchy rebuild that may not occur as all lft values are populated.
-            o[0].save()
+                o[0].save()
+            # Moving the other root objects forces a rebuild of the hierarchy
             cls.objects.using(database).filter(owner__isnull=True).exclude(
                 name=rootname
-            ).update(owner=o[0])
+            ).update(owner=o[0], lft=None, rght=None, lvl=None)
 
             # Rebuild the hierarchy again with the new root
             cls.rebuildHierarchy(database=database)
 
+    @classmethod
+    def updateHierarchy(cls, database=DEFAULT_DB_ALIAS):
+        """
+        Rebuilds the hierarchy in a background thread, when it isn't up to date.
+        The method doesn't wait for the rebuild: until it is finished, queries
+        see the records added or moved since the previous rebuild without
+        hierarchy fields.
+        Only a single rebuild per model and database runs at the same time.
+        """
+        key = (cls, database)
+        with hierarchyLock:
+            if key in hierarchyRebuilds:
+                return
+        if not cls.objects.using(database).filter(lft__isnull=True).exists():
+            return
+        with hierarchyLock:
+            if key in hierarchyRebuilds:
+                return
+            hierarchyRebuilds.add(key)
+        Thread(target=cls._updateHierarchy, args=(database,), daemon=True).start()
+
+    @classmethod
+    def updateHierarchyOnCommit(cls, database=DEFAULT_DB_ALIAS):
+        """
+        Rebuilds the hierarchy in a background thread after the current
+        transaction is committed.
+        """
+        transaction.on_commit(lambda: cls.updateHierarchy(database), using=database)
+
+    @classmethod
+    def _updateHierarchy(cls, database):
+        try:
+            cls.rebuildHierarchy(database=database)
+        except Exception as e:
+            logger.error(
+                "Error rebuilding the hierarchy of %s: %s" % (cls._meta.db_table, e)
+            )
+        finally:
+            with hierarchyLock:
+                hierarchyRebuilds.discard((cls, database))
+            connections[database].close()
+
 
 class MultiDBManager(models.Manager):
     def get_queryset(self):
@@ -269,6 +559,48 @@ class AuditModel(models.Model):
         abstract = True
 
 
+def getTableVersions(database, tables):
+    """
+    Returns a tuple with a value for each table that changes when records of
+    the table are saved or deleted. Data cached from the tables is stale when
+    these values change.
+    The versions are stored in the database, so all web server processes
+    see the same values.
+    """
+    with connections[database].cursor() as cursor:
+        cursor.execute(
+            "select name, version from common_tableversion where name = any(%s)",
+            (list(tables),),
+        )
+        versions = dict(cursor.fetchall())
+    return tuple(versions.get(t, 0) for t in tables)
+
+
+def updateTableVersion(database, table):
+    with connections[database].cursor() as cursor:
+        cursor.execute(
+            """
+            insert into common_tableversion (name, version) values (%s, 1)
+            on conflict (name)
+            do update set version = common_tableversion.version + 1
+            """,
+            (table,),
+        )
+
+
+def tableChanged(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    table = sender._meta.db_table
+    transaction.on_commit(lambda: updateTableVersion(using, table), using=using)
+
+
+@receiver(class_prepared)
+def trackTableChanges(sender, **kwargs):
+    # Only the data models shown in the grids have a table version
+    if issubclass(sender, AuditModel) and not sender._meta.abstract:
+        post_save.connect(tableChanged, sender=sender)
+        post_delete.connect(tableChanged, sender=sender)
+
+
 class Parameter(AuditModel):
     # Database fields
     # Translators: Translation included with Django
@@ -307,6 +639,14 @@ class Scenario(models.Model):
         _("status"), max_length=10, null=False, blank=False, choices=scenarioStatus
     )
     lastrefresh = models.DateTimeField(_("last refreshed"), null=True, editable=False)
+    parent = models.CharField(
+        _("parent"),
+        max_length=300,
+        null=True,
+        blank=True,
+        editable=False,
+        help_text=_("Scenario of which this scenario only stores the changes"),
+    )
 
     def __str__(self):
         return self.name
@@ -333,6 +673,39 @@ class Scenario(models.Model):
             # Failures are acceptable - eg when the default database has not been intialized yet
             pass
 
+    @staticmethod
+    def getScenarios():
+        """
+        Returns a list with all scenarios.
+        The list is cached, and the scenarios in it are copies that can be
+        modified by the caller.
+        """
+        scenarios = metadataCache.get(("scenarios",))
+        if scenarios is None:
+            scenarios = list(Scenario.objects.using(DEFAULT_DB_ALIAS).all())
+            metadataCache.set(("scenarios",), scenarios, timeout=metadataTimeout)
+        return [copy.copy(i) for i in scenarios]
+
+    @staticmethod
+    def getParents(database):
+        """
+        Returns the list of parent scenarios of a delta scenario, starting
+        with its direct parent. The list is empty for a complete scenario.
+        """
+        scenarios = {i.name: i for i in Scenario.getScenarios()}
+        parents = []
+        sc = scenarios.get(database, None)
+        while (
+            sc
+            and sc.parent
+            and sc.parent != database
+            and sc.parent not in parents
+            and sc.parent in scenarios
+        ):
+            parents.append(sc.parent)
+            sc = scenarios[sc.parent]
+        return parents
+
     def __lt__(self, other):
         # Default database is always first in the list
         if self.name == DEFAULT_DB_ALIAS:
@@ -546,6 +919,21 @@ class User(AbstractUser):
         verbose_name_plural = _("users")
 
     def getPreference(self, prop, default=None, database=DEFAULT_DB_ALIAS):
+        # Preferences are remembered for the lifetime of this object, ie
+        # a single request. The attribute preferenceVersion is set on the
+        # user of a web request, and allows caching across requests.
+        if not hasattr(self, "_preferences"):
+            self._preferences = {}
+        if (database, prop) in self._preferences:
+            result = self._preferences[(database, prop)]
+            return copy.deepcopy(result) if result else default
+        version = getattr(self, "preferenceVersion", None)
+        key = ("preference", database, self.id, prop)
+        if version is not None:
+            result = metadataCache.get(key, version)
+            if result is not None:
+                self._preferences[(database, prop)] = result
+                return copy.deepcopy(result) if result else default
         try:
             result = None
             for p in (
@@ -560,14 +948,28 @@ class User(AbstractUser):
                     result.update(p.value)
                 else:
                     result = p.value
-            return result if result else default
         except ValueError:
             logger.error("Invalid preference '%s' of user '%s'" % (prop, self.username))
             return default
         except:
             return default
+        self._preferences[(database, prop)] = result
+        if version is not None:
+            metadataCache.set(
+                key, result if result else {}, version, timeout=metadataTimeout
+            )
+        return copy.deepcopy(result) if result else default
 
     def setPreference(self, prop, val, database=DEFAULT_DB_ALIAS):
+        if hasattr(self, "_preferences"):
+            self._preferences.pop((database, prop), None)
+        if prop in settings.GLOBAL_PREFERENCES:
+            # The global part of the preference is shared by all users
+            metadataCache.deleteMatching(
+                lambda k: k[0] == "preference" and k[1] == database and k[3] == prop
+            )
+        else:
+            metadataCache.delete(("preference", database, self.id, prop))
         if val is None:
             if prop in settings.GLOBAL_PREFERENCES and self.is_superuser:
                 # Delete global preferences
@@ -661,6 +1063,12 @@ def delete_user(sender, instance, **kwargs):
     raise PermissionDenied
 
 
+@receiver(post_save, sender=Scenario)
+@receiver(post_delete, sender=Scenario)
+def clearScenarioCache(sender, **kwargs):
+    metadataCache.delete(("scenarios",))
+
+
 class Comment(models.Model):
     id = models.AutoField(_("identifier"), primary_key=True)
     content_type = models.ForeignKey(
@@ -34,6 +34,7 @@ import csv
 from datetime import date, datetime, timedelta, time
 from decimal import Decimal
 import functools
+import hashlib
 from logging import ERROR, WARNING, DEBUG
 import math
 import operator
@@ -57,7 +58,8 @@ from django.views.decorators.csrf import csrf_protect
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.admin.utils import unquote, quote
-from django.core.exceptions import ValidationError
+from django.core.cache import cache
+from django.core.exceptions import ValidationError, EmptyResultSet
 from django.core.management.color import no_style
 from django.db import connections, transaction, models
 from django.db.models.fields import CharField, AutoField
@@ -89,8 +91,20 @@ from freppledb.common.models import (
     BucketDetail,
     Bucket,
     HierarchyModel,
+    getTableVersions,
 )
+from freppledb.common.cache import LRUCache, getSize
 from freppledb.common.dataload import parseExcelWorksheet, parseCSVdata
+from freppledb.common.spreadsheet import (
+    generateSpreadsheet,
+    anyCell,
+    boolCell,
+    dateCell,
+    dateTimeCell,
+    numberCell,
+    textCell,
+)
+from freppledb.execute.models import Task
 from freppledb.admin import data_site
 
 
@@ -98,6 +112,9 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Cache with the results of the pivot reports
+reportCache = LRUCache(getattr(settings, "MAXREPORTCACHESIZE", 200) * 1024 * 1024)
+
 
 # A list of models with some special, administrative purpose.
 # They should be excluded from bulk import, export and erasing actions.
@@ -561,6 +578,10 @@ class GridReport(View):
     # Define a list of actions
     actions = None
 
+    # Number of seconds the record count and the page boundaries of the
+    # report are cached. The cache is also refreshed when a task finishes.
+    cache_timeout = 3600
+
     _attributes_added = False
 
     @classmethod
@@ -822,17 +843,16 @@ class GridReport(View):
 
     @classmethod
     def _generate_spreadsheet_data(cls, request, output, *args, **kwargs):
-        # Create a workbook
-        wb = Workbook(write_only=True)
-        title = force_text(cls.model and cls.model._meta.verbose_name or cls.title)
-        ws = wb.create_sheet(title=title)
+        for chunk in cls._generate_spreadsheet_stream(request, *args, **kwargs):
+            output.write(chunk)
 
-        # Create a named style for the header row
-        headerstyle = NamedStyle(name="headerstyle")
-        headerstyle.fill = PatternFill(fill_type="solid", fgColor="70c4f4")
-        wb.add_named_style(headerstyle)
-
-        # Choose fields to export and write the title row
+    @classmethod
+    def _generate_spreadsheet_stream(cls, request, *args, **kwargs):
+        """
+        Returns an iterator over the spreadsheet in chunks of bytes.
+        The spreadsheet is never completely held in memory.
+        """
+        # Choose fields to export
         if not hasattr(request, "prefs"):
             request.prefs = request.user.getPreference(
                 cls.getKey(), database=request.database
@@ -853,17 +873,6 @@ class GridReport(View):
             ]
         field_names = [f.field_name for f in fields]
 
-        # Write a formatted header row
-        header = []
-        for f in fields:
-            cell = WriteOnlyCell(ws, value=force_text(f.title).title())
-            cell.style = "headerstyle"
-            header.append(cell)
-        ws.append(header)
-
-        # Add an auto-filter to the table
-        ws.auto_filter.ref = "A1:%s1048576" % get_column_letter(len(header))
-
         # Loop over all records
         if isinstance(cls.basequeryset, collections.Callable):
             query = cls._apply_sort(
@@ -877,30 +886,24 @@ class GridReport(View):
                 request,
                 cls.filter_items(request, cls.basequeryset).using(request.database),
             )
-        for row in (
-            hasattr(cls, "query")
-            and cls.query(request, query)
-            or query.values(*field_names)
-        ):
-            if hasattr(row, "__getitem__"):
-                ws.append(
-                    [
-                        _getCellValue(row[f.field_name], field=f, request=request)
-                        for f in fields
-                    ]
-                )
-            else:
-                ws.append(
-                    [
-                        _getCellValue(
-                            getattr(row, f.field_name), field=f, request=request
-                        )
-                        for f in fields
-                    ]
-                )
+        if hasattr(cls, "query"):
+            data = cls.query(request, query)
+        else:
+            data = query.values(*field_names).iterator()
 
-        # Write the spreadsheet
-        wb.save(output)
+        def rows():
+            for row in data:
+                if hasattr(row, "__getitem__"):
+                    yield [row[f] for f in field_names]
+                else:
+                    yield [getattr(row, f) for f in field_names]
+
+        return generateSpreadsheet(
+            force_text(cls.model and cls.model._meta.verbose_name or cls.title),
+            [force_text(f.title).title() for f in fields],
+            rows(),
+            [_getCellFormatter(f, request) for f in fields],
+        )
 
     @classmethod
     def _generate_csv_data(cls, request, *args, **kwargs):
@@ -1251,16 +1254,96 @@ class GridReport(View):
         else:
             return "%s asc" % sort
 
+    @staticmethod
+    def _getCacheKey(*args):
+        return "grid:%s" % hashlib.md5(repr(args).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _getDataVersion(database, query):
+        """
+        Returns a value that changes when the data of a query changes: the end
+        time of the last task and the versions of the tables used by the query.
+        """
+        tables = sorted(
+            {i.table_name for i in query.query.alias_map.values()}
+            | {query.model._meta.db_table}
+        )
+        return (Task.lastFinished(database), getTableVersions(database, tables))
+
     @classmethod
-    def count_query_elements(cls, database, query):
+    def count_query_elements(cls, database, query, version=None):
+        """
+        Counts the records of a query.
+        When a version is passed, large counts are cached for that version.
+        """
+        sql, params = query.get_compiler(database).as_sql(with_col_aliases=False)
+        key = None
+        if version is not None:
+            key = cls._getCacheKey("count", database, version, sql, params)
+            recs = cache.get(key)
+            if recs is not None:
+                return recs
         cursor = connections[database].cursor()
-        cursor.execute(
-            "select count(*) from ("
-            + query.get_compiler(database).as_sql(with_col_aliases=False)[0]
-            + ") t_subquery",
-            query.get_compiler(database).as_sql(with_col_aliases=False)[1],
-        )
-        return cursor.fetchone()[0]
+        cursor.execute("select count(*) from (" + sql + ") t_subquery", params)
+        recs = cursor.fetchone()[0]
+        if key and recs >= getattr(settings, "GRID_COUNT_CACHE_THRESHOLD", 10000):
+            cache.set(key, recs, cls.cache_timeout)
+        return recs
+
+    @staticmethod
+    def _getKeysetFields(query):
+        """
+        Returns the ordering of a query as a list of (field, descending)
+        tuples, with the primary key appended to make the ordering unique.
+        Returns None when the ordering can't be used for keyset pagination:
+        all fields must be non-nullable model fields.
+        """
+        if (
+            not query.query.order_by
+            or query.query.distinct
+            or query.query.extra_order_by
+        ):
+            return None
+        keys = []
+        haspk = False
+        for o in query.query.order_by:
+            if not isinstance(o, str):
+                return None
+            desc = o.startswith("-")
+            name = o[1:] if desc else o
+            model = query.model
+            try:
+                for step in name.split("__"):
+                    if not model:
+                        return None
+                    f = model._meta.pk if step == "pk" else model._meta.get_field(step)
+                    if f.null or f.many_to_many or f.one_to_many:
+                        return None
+                    model = f.related_model
+            except Exception:
+                return None
+            if f.is_relation:
+                # Sorting on a related model uses the ordering of that model
+                return None
+            if f == query.model._meta.pk and "__" not in name:
+                haspk = True
+            keys.append((name, desc))
+        if not haspk:
+            keys.append(("pk", False))
+        return keys
+
+    @staticmethod
+    def _getKeysetFilter(keys, values):
+        """
+        Returns a filter selecting the records sorted after the given values.
+        """
+        flt = None
+        for i, (name, desc) in enumerate(keys):
+            q = models.Q(**{"%s__%s" % (name, "lt" if desc else "gt"): values[i]})
+            for j in range(i):
+                q &= models.Q(**{keys[j][0]: values[j]})
+            flt = q if flt is None else flt | q
+        return flt
 
     @classmethod
     def _generate_json_data(cls, request, *args, **kwargs):
@@ -1274,7 +1357,8 @@ class GridReport(View):
             ).using(request.database)
         else:
             query = cls.filter_items(request, cls.basequeryset).using(request.database)
-        recs = cls.count_query_elements(request.database, query.query)
+        version = cls._getDataVersion(request.database, query)
+        recs = cls.count_query_elements(request.database, query.query, version)
         total_pages = math.ceil(float(recs) / request.pagesize)
         if page > total_pages:
             page = total_pages
@@ -1282,6 +1366,28 @@ class GridReport(View):
             page = 1
         query = cls._apply_sort(request, query)
 
+        # Keyset pagination: the first page and pages that aren't reached
+        # from the previous page are read with an offset. Reading a page
+        # stores the sort key of the first record on the next page, so the
+        # next page can be read with a filter on the sort key instead.
+        keys = cls._getKeysetFields(query)
+        boundary = None
+        if keys:
+            query = query.order_by(*[("-%s" if d else "%s") % k for k, d in keys])
+            sql, params = query.query.get_compiler(request.database).as_sql()
+            pagekey = cls._getCacheKey(
+                "page", request.database, version, sql, params, request.pagesize
+            )
+            if page > 1:
+                boundary = cache.get("%s:%s" % (pagekey, page))
+        cnt = (page - 1) * request.pagesize + 1
+        if boundary:
+            pagequery = query.filter(cls._getKeysetFilter(keys, boundary))[
+                : request.pagesize + 1
+            ]
+        else:
+            pagequery = query[cnt - 1 : cnt + request.pagesize]
+
         yield '{"total":%d,\n' % total_pages
         yield '"page":%d,\n' % page
         yield '"records":%d,\n' % recs
@@ -1291,16 +1397,23 @@ class GridReport(View):
             if tmp:
                 yield tmp
         yield '"rows":[\n'
-        cnt = (page - 1) * request.pagesize + 1
         first = True
+        nextboundary = None
 
         # GridReport
         fields = [i.field_name for i in request.rows if i.field_name]
-        for i in (
-            hasattr(cls, "query")
-            and cls.query(request, query[cnt - 1 : cnt + request.pagesize])
-            or query[cnt - 1 : cnt + request.pagesize].values(*fields)
-        ):
+        if hasattr(cls, "query"):
+            rows = cls.query(request, pagequery)
+            if keys and page < total_pages:
+                nextboundary = pagequery.values_list(*[k for k, d in keys])[
+                    request.pagesize - 1 : request.pagesize
+                ]
+                nextboundary = nextboundary[0] if nextboundary else None
+        else:
+            rows = pagequery.values(
+                *(fields + [k for k, d in keys or [] if k not in fields])
+            )
+        for idx, i in enumerate(rows):
             if first:
                 r = ["{"]
                 first = False
@@ -1318,6 +1431,17 @@ class GridReport(View):
                     r.append(', "%s":%s' % (f.name, s))
             r.append("}")
             yield "".join(r)
+            if (
+                keys
+                and idx == request.pagesize - 1
+                and not hasattr(cls, "query")
+                and page < total_pages
+            ):
+                nextboundary = tuple(i[k] for k, d in keys)
+        if nextboundary:
+            cache.set(
+                "%s:%s" % (pagekey, page + 1), tuple(nextboundary), cls.cache_timeout
+            )
         yield "\n]}\n"
 
     @classmethod
@@ -1518,11 +1642,11 @@ class GridReport(View):
             return response
         elif fmt in ("spreadsheetlist", "spreadsheettable", "spreadsheet"):
             # Return an excel spreadsheet
-            output = BytesIO()
-            cls._generate_spreadsheet_data(request, output, *args, **kwargs)
-            response = HttpResponse(
+            response = StreamingHttpResponse(
                 content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                content=output.getvalue(),
+                streaming_content=cls._generate_spreadsheet_stream(
+                    request, *args, **kwargs
+                ),
             )
             # Filename parameter is encoded as specified in rfc5987
             title = force_text(cls.model._meta.verbose_name if cls.model else cls.title)
@@ -1715,6 +1839,25 @@ class GridReport(View):
                 found.update([f.related_model])
                 GridReport.dependent_models(f.related_model, found)
 
+    @staticmethod
+    def depends_on(m1, m2):
+        """
+        Returns true when the data of the first entry must be loaded after
+        the data of the second entry. The entries are tuples in the format
+        used by the sort_models method.
+        """
+        if m1[1] == m2[1] or m1[1] not in m2[3]:
+            return False
+        m1_base = m1[1].__base__
+        if m1_base == Model or m1_base._meta.abstract:
+            m1_base = None
+        m2_base = m2[1].__base__
+        if m2_base == Model or m2_base._meta.abstract:
+            m2_base = None
+        if m1_base == m2_base and m1_base and m2_base:
+            return False
+        return m1_base != m2[1] and m2_base != m1[1]
+
     @staticmethod
     def sort_models(models):
         # Inject additional dependencies that are not reflected in database constraints
@@ -1732,19 +1875,7 @@ class GridReport(View):
             for i in range(cnt):
                 j = i + 1
                 while j < cnt and ok:
-                    if models[i][1] != models[j][1] and models[i][1] in models[j][3]:
-                        i_base = models[i][1].__base__
-                        if i_base == Model or i_base._meta.abstract:
-                            i_base = None
-                        j_base = models[j][1].__base__
-                        if j_base == Model or j_base._meta.abstract:
-                            j_base = None
-                        if i_base == j_base and i_base and j_base:
-                            j += 1
-                            continue
-                        if i_base == models[j][1] or j_base == models[i][1]:
-                            j += 1
-                            continue
+                    if GridReport.depends_on(models[i], models[j]):
                         models.append(models.pop(i))
                         j = i
                         ok = False
@@ -2276,6 +2407,10 @@ class GridPivot(GridReport):
 
     multiselect = False
 
+    # Tables read by the query of the report, besides the tables of the base
+    # query. The cached results are refreshed when their records change.
+    tables = ("common_bucketdetail",)
+
     @classmethod
     def _render_cross(cls, request):
         result = []
@@ -2366,6 +2501,71 @@ class GridPivot(GridReport):
             )
         return ",\n".join(result)
 
+    @classmethod
+    def getCacheParameters(cls, request):
+        """
+        Returns the values of the parameters read by the query of the report.
+        They are part of the key of the cached results.
+        """
+        return ()
+
+    @classmethod
+    def _cachedQuery(cls, request, basequery, sortsql="1 asc"):
+        """
+        Runs the query of the report.
+        The result is cached until the next task finishes, for instance the
+        plan generation and export, or until records of the tables read by
+        the report change.
+        """
+        if not reportCache.maxsize:
+            return cls.query(request, basequery, sortsql=sortsql)
+        try:
+            sql, params = basequery.query.get_compiler(basequery.db).as_sql()
+        except EmptyResultSet:
+            return cls.query(request, basequery, sortsql=sortsql)
+        key = cls._getCacheKey(
+            "pivot",
+            request.database,
+            cls.getKey(),
+            sql,
+            params,
+            sortsql,
+            request.report_bucket,
+            request.report_startdate,
+            request.report_enddate,
+            cls.getCacheParameters(request),
+        )
+        tables = sorted(
+            {i.table_name for i in basequery.query.alias_map.values()} | set(cls.tables)
+        )
+        version = (
+            Task.lastFinished(request.database),
+            getTableVersions(request.database, tables),
+        )
+        rows = reportCache.get(key, version)
+        if rows is not None:
+            return rows
+        return cls._storeQuery(
+            key, version, cls.query(request, basequery, sortsql=sortsql)
+        )
+
+    @staticmethod
+    def _storeQuery(key, version, rows):
+        # Rows are passed on while they are read. The result is stored when
+        # it fits in the cache.
+        result = []
+        size = 0
+        for i in rows:
+            yield i
+            if result is not None:
+                size += getSize(i)
+                if size > reportCache.maxsize:
+                    result = None
+                else:
+                    result.append(i)
+        if result is not None:
+            reportCache.set(key, result, version, size)
+
     @classmethod
     def _generate_json_data(cls, request, *args, **kwargs):
         # Prepare the query
@@ -2377,13 +2577,13 @@ class GridPivot(GridReport):
             recs = 1
             total_pages = 1
             if isinstance(cls.basequeryset, collections.Callable):
-                query = cls.query(
+                query = cls._cachedQuery(
                     request,
                     cls.basequeryset(request, *args, **kwargs).using(request.database),
                     sortsql="1 asc",
                 )
             else:
-                query = cls.query(
+                query = cls._cachedQuery(
                     request,
                     cls.basequeryset.filter(pk__exact=args[0]).using(request.database),
                     sortsql="1 asc",
@@ -2411,7 +2611,7 @@ class GridPivot(GridReport):
                 page = 1
             cnt = (page - 1) * request.pagesize + 1
             if isinstance(cls.basequeryset, collections.Callable):
-                query = cls.query(
+                query = cls._cachedQuery(
                     request,
                     cls._apply_sort(
                         request,
@@ -2422,7 +2622,7 @@ class GridPivot(GridReport):
                     sortsql=cls._apply_sort_index(request),
                 )
             else:
-                query = cls.query(
+                query = cls._cachedQuery(
                     request,
                     cls._apply_sort(
                         request, cls.filter_items(request, cls.basequeryset)
@@ -2499,7 +2699,7 @@ class GridPivot(GridReport):
             )
         if args and args[0]:
             if isinstance(cls.basequeryset, collections.Callable):
-                query = cls.query(
+                query = cls._cachedQuery(
                     request,
                     cls.basequeryset(request, *args, **kwargs)
                     .filter(pk__exact=args[0])
@@ -2507,13 +2707,13 @@ class GridPivot(GridReport):
                     sortsql="1 asc",
                 )
             else:
-                query = cls.query(
+                query = cls._cachedQuery(
                     request,
                     cls.basequeryset.filter(pk__exact=args[0]).using(request.database),
                     sortsql="1 asc",
                 )
         elif isinstance(cls.basequeryset, collections.Callable):
-            query = cls.query(
+            query = cls._cachedQuery(
                 request,
                 cls.filter_items(
                     request, cls.basequeryset(request, *args, **kwargs), False
@@ -2521,7 +2721,7 @@ class GridPivot(GridReport):
                 sortsql=cls._apply_sort_index(request),
             )
         else:
-            query = cls.query(
+            query = cls._cachedQuery(
                 request,
                 cls.filter_items(request, cls.basequeryset).using(request.database),
                 sortsql=cls._apply_sort_index(request),
@@ -2793,6 +2993,12 @@ class GridPivot(GridReport):
                 writer.writerow(fields)
                 yield sf.getvalue()
 
+    @classmethod
+    def _generate_spreadsheet_stream(cls, request, *args, **kwargs):
+        output = BytesIO()
+        cls._generate_spreadsheet_data(request, output, *args, **kwargs)
+        yield output.getvalue()
+
     @classmethod
     def _generate_spreadsheet_data(cls, request, output, *args, **kwargs):
         # Create a workbook
@@ -2812,7 +3018,7 @@ class GridPivot(GridReport):
         listformat = request.GET.get("format", "spreadsheetlist") == "spreadsheetlist"
         if args and args[0]:
             if isinstance(cls.basequeryset, collections.Callable):
-                query = cls.query(
+                query = cls._cachedQuery(
                     request,
                     cls.basequeryset(request, *args, **kwargs)
                     .filter(pk__exact=args[0])
@@ -2820,13 +3026,13 @@ class GridPivot(GridReport):
                     sortsql="1 asc",
                 )
             else:
-                query = cls.query(
+                query = cls._cachedQuery(
                     request,
                     cls.basequeryset.filter(pk__exact=args[0]).using(request.database),
                     sortsql="1 asc",
                 )
         elif isinstance(cls.basequeryset, collections.Callable):
-            query = cls.query(
+            query = cls._cachedQuery(
                 request,
                 cls.filter_items(
                     request, cls.basequeryset(request, *args, **kwargs), False
@@ -2834,7 +3040,7 @@ class GridPivot(GridReport):
                 sortsql=cls._apply_sort_index(request),
             )
         else:
-            query = cls.query(
+            query = cls._cachedQuery(
                 request,
                 cls.filter_items(request, cls.basequeryset).using(request.database),
                 sortsql=cls._apply_sort_index(request),
@@ -3069,6 +3275,51 @@ def _parseSeconds(data):
     )
 
 
+def _getCellFormatter(field, request):
+    """
+    Returns a function to format the cells of a field in a spreadsheet.
+    The choice of the formatting function depends only on the field type,
+    and values of an unexpected type are formatted like _getCellValue does.
+    """
+
+    def default(data):
+        return anyCell(_getCellValue(data, field=field, request=request))
+
+    if isinstance(field, (GridFieldLastModified, GridFieldLocalDateTime)):
+        if not hasattr(request, "tzoffset"):
+            request.tzoffset = GridReport.getTimezoneOffset(request)
+        tzoffset = request.tzoffset
+
+        def formatter(data):
+            if isinstance(data, datetime):
+                return dateTimeCell(data + tzoffset)
+            return default(data)
+
+    elif isinstance(field, GridFieldDateTime):
+        formatter = dateTimeCell
+    elif isinstance(field, GridFieldDate):
+        formatter = dateCell
+    elif isinstance(field, (GridFieldInteger, GridFieldNumber, GridFieldCurrency)):
+        formatter = numberCell
+    elif isinstance(field, GridFieldBool):
+        formatter = boolCell
+    elif isinstance(field, GridFieldDuration):
+
+        def formatter(data):
+            if isinstance(data, timedelta):
+                return textCell(_parseSeconds(data))
+            return default(data)
+
+    else:
+
+        def formatter(data):
+            if isinstance(data, str):
+                return textCell(data)
+            return default(data)
+
+    return formatter
+
+
 def _getCellValue(data, field=None, exportConfig=None, request=None):
     if data is None:
         return ""
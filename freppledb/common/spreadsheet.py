@@ -0,0 +1,410 @@
+#
+# Copyright (C) 2019 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+r"""
+Incremental writer for spreadsheets in the XLSX format.
+
+The workbook is generated as a stream of bytes: the rows are converted to
+XML and compressed as they are read, and the compressed data is returned
+in chunks. Memory usage is thus independent of the size of the spreadsheet.
+
+The generated workbook has a single sheet, with a formatted header row
+and an auto-filter. Strings are stored inline in the cells rather than
+in a shared string table.
+"""
+
+from datetime import date, datetime
+from decimal import Decimal
+import math
+import re
+import struct
+import time
+from xml.sax.saxutils import escape, quoteattr
+import zlib
+
+from openpyxl.utils import get_column_letter
+
+
+# Characters that are not allowed in an XML document
+_illegalCharacters = re.compile(r"[\000-\010]|[\013-\014]|[\016-\037]")
+
+_epoch = datetime(1899, 12, 30)
+
+# Style indices in the cellXfs list of the styles part
+_styleHeader = 1
+_styleDateTime = 2
+_styleDate = 3
+
+_contentTypes = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    "</Types>"
+)
+
+_rootRelations = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+    "</Relationships>"
+)
+
+_workbookRelations = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+    '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+    "</Relationships>"
+)
+
+_workbook = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name=%s sheetId="1" r:id="rId1"/></sheets>'
+    "<definedNames>"
+    '<definedName name="_xlnm._FilterDatabase" localSheetId="0" hidden="1">%s</definedName>'
+    "</definedNames>"
+    "</workbook>"
+)
+
+_styles = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<numFmts count="2">'
+    '<numFmt numFmtId="164" formatCode="yyyy-mm-dd h:mm:ss"/>'
+    '<numFmt numFmtId="165" formatCode="yyyy-mm-dd"/>'
+    "</numFmts>"
+    '<fonts count="1"><font><sz val="11"/><name val="Calibri"/><family val="2"/></font></fonts>'
+    '<fills count="3">'
+    '<fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill>'
+    '<fill><patternFill patternType="solid"><fgColor rgb="0070C4F4"/></patternFill></fill>'
+    "</fills>"
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="2">'
+    '<xf numFmtId="0" fontId="0" fillId="0" borderId="0"/>'
+    '<xf numFmtId="0" fontId="0" fillId="2" borderId="0" applyFill="1"/>'
+    "</cellStyleXfs>"
+    '<cellXfs count="4">'
+    '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="0" fontId="0" fillId="2" borderId="0" xfId="1" applyFill="1"/>'
+    '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="165" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    "</cellXfs>"
+    '<cellStyles count="2">'
+    '<cellStyle name="Normal" xfId="0" builtinId="0"/>'
+    '<cellStyle name="headerstyle" xfId="1"/>'
+    "</cellStyles>"
+    "</styleSheet>"
+)
+
+_sheetStart = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    "<sheetData>"
+)
+
+_sheetEnd = '</sheetData><autoFilter ref="A1:%s1048576"/></worksheet>'
+
+
+def textCell(value):
+    """
+    Formats a cell with a string value.
+    The return value is the XML of the cell, after the cell reference.
+    """
+    if not isinstance(value, str):
+        return anyCell(value)
+    if not value:
+        return None
+    value = escape(_illegalCharacters.sub("", value))
+    if value[0].isspace() or value[-1].isspace():
+        return ' t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % value
+    return ' t="inlineStr"><is><t>%s</t></is></c>' % value
+
+
+def numberCell(value):
+    """
+    Formats a cell with a numeric value.
+    """
+    if isinstance(value, int) and not isinstance(value, bool):
+        return "><v>%d</v></c>" % value
+    elif isinstance(value, float):
+        if not math.isfinite(value):
+            return textCell(str(value))
+        return "><v>%r</v></c>" % value
+    elif isinstance(value, Decimal):
+        if not value.is_finite():
+            return textCell(str(value))
+        return "><v>%s</v></c>" % value
+    return anyCell(value)
+
+
+def dateTimeCell(value):
+    """
+    Formats a cell with a datetime value.
+    """
+    if isinstance(value, datetime):
+        delta = value.replace(tzinfo=None) - _epoch
+        return ' s="%d"><v>%r</v></c>' % (
+            _styleDateTime,
+            delta.days + delta.seconds / 86400 + delta.microseconds / 86400e6,
+        )
+    return anyCell(value)
+
+
+def dateCell(value):
+    """
+    Formats a cell with a date value.
+    """
+    if isinstance(value, date) and not isinstance(value, datetime):
+        return ' s="%d"><v>%d</v></c>' % (_styleDate, (value - _epoch.date()).days,)
+    return anyCell(value)
+
+
+def boolCell(value):
+    """
+    Formats a cell with a boolean value.
+    """
+    if isinstance(value, bool):
+        return ' t="b"><v>%d</v></c>' % value
+    return anyCell(value)
+
+
+def anyCell(value):
+    """
+    Formats a cell of any type.
+    This is the fallback for values that don't match the format of the column.
+    """
+    if value is None:
+        return None
+    elif isinstance(value, str):
+        return textCell(value)
+    elif isinstance(value, bool):
+        return boolCell(value)
+    elif isinstance(value, (int, float, Decimal)):
+        return numberCell(value)
+    elif isinstance(value, datetime):
+        return dateTimeCell(value)
+    elif isinstance(value, date):
+        return dateCell(value)
+    else:
+        return textCell(str(value))
+
+
+class _ZipStream:
+    """
+    Writes a zip archive to a stream of bytes.
+
+    The sizes and checksum of each file are only known after its content
+    is compressed. They are written in a data descriptor after the file
+    data, which removes the need to seek back in the output.
+    """
+
+    chunksize = 65536
+
+    def __init__(self):
+        self.offset = 0
+        self.files = []
+        now = time.localtime()
+        self.dostime = now.tm_hour << 11 | now.tm_min << 5 | now.tm_sec // 2
+        self.dosdate = (now.tm_year - 1980) << 9 | now.tm_mon << 5 | now.tm_mday
+
+    def _write(self, data):
+        self.offset += len(data)
+        if self.offset > 0xFFFFFFFF:
+            raise Exception("Spreadsheet exceeds the maximum size of 4GB")
+        return data
+
+    def writeFile(self, name, content):
+        """
+        Generator that compresses a file in the archive.
+        The content is an iterable of strings.
+        """
+        name = name.encode("utf-8")
+        header_offset = self.offset
+        yield self._write(
+            struct.pack(
+                "<IHHHHHIIIHH",
+                0x04034B50,
+                20,
+                0x08,
+                8,
+                self.dostime,
+                self.dosdate,
+                0,
+                0,
+                0,
+                len(name),
+                0,
+            )
+            + name
+        )
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        crc = 0
+        size = 0
+        compressed_size = 0
+        buffer = []
+        buffered = 0
+        for data in content:
+            buffer.append(data)
+            buffered += len(data)
+            if buffered < self.chunksize:
+                continue
+            data = "".join(buffer).encode("utf-8")
+            buffer = []
+            buffered = 0
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            data = compressor.compress(data)
+            if data:
+                compressed_size += len(data)
+                yield self._write(data)
+        data = "".join(buffer).encode("utf-8")
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+        data = compressor.compress(data) + compressor.flush()
+        compressed_size += len(data)
+        if size > 0xFFFFFFFF:
+            raise Exception("Spreadsheet exceeds the maximum size of 4GB")
+        yield self._write(data)
+        yield self._write(struct.pack("<IIII", 0x08074B50, crc, compressed_size, size))
+        self.files.append((name, header_offset, crc, compressed_size, size))
+
+    def close(self):
+        """
+        Returns the central directory that ends the archive.
+        """
+        start = self.offset
+        directory = []
+        for name, header_offset, crc, compressed_size, size in self.files:
+            directory.append(
+                struct.pack(
+                    "<IHHHHHHIIIHHHHHII",
+                    0x02014B50,
+                    20,
+                    20,
+                    0x08,
+                    8,
+                    self.dostime,
+                    self.dosdate,
+                    crc,
+                    compressed_size,
+                    size,
+                    len(name),
+                    0,
+                    0,
+                    0,
+                    0,
+                    0,
+                    header_offset,
+                )
+                + name
+            )
+        directory = b"".join(directory)
+        return self._write(
+            directory
+            + struct.pack(
+                "<IHHHHIIH",
+                0x06054B50,
+                0,
+                0,
+                len(self.files),
+                len(self.files),
+                len(directory),
+                start,
+                0,
+            )
+        )
+
+
+def sheetTitle(title):
+    """
+    Returns a valid sheet title: maximum 31 characters, and none of the
+    characters that excel doesn't allow.
+    """
+    title = re.sub(r"[\\*?:/\[\]]", "", title).strip("'")[:31]
+    return title or "Sheet"
+
+
+def generateSpreadsheet(title, header, rows, formatters=None):
+    """
+    Generator that returns a spreadsheet in chunks of bytes.
+
+    Arguments:
+      - title: title of the sheet
+      - header: list of column titles
+      - rows: iterable of lists with the cell values
+      - formatters: list with a formatting function per column, eg
+        numberCell or dateCell. The function is computed once for each
+        column, which avoids checking the type of every cell value.
+    """
+    ncolumns = len(header)
+    if not formatters:
+        formatters = [anyCell] * ncolumns
+    columns = [get_column_letter(i + 1) for i in range(ncolumns)]
+    title = sheetTitle(title)
+
+    def sheet():
+        yield _sheetStart
+        yield '<row r="1">'
+        for col, value in zip(columns, header):
+            yield '<c r="%s1" s="%d" t="inlineStr"><is><t>%s</t></is></c>' % (
+                col,
+                _styleHeader,
+                escape(_illegalCharacters.sub("", str(value))),
+            )
+        yield "</row>"
+        rownumber = 1
+        for row in rows:
+            rownumber += 1
+            r = str(rownumber)
+            cells = ['<row r="%s">' % r]
+            for col, fmt, value in zip(columns, formatters, row):
+                if value is None:
+                    continue
+                cell = fmt(value)
+                if cell:
+                    cells.append('<c r="%s%s"%s' % (col, r, cell))
+            cells.append("</row>")
+            yield "".join(cells)
+        yield _sheetEnd % (columns[-1] if columns else "A")
+
+    zipstream = _ZipStream()
+    yield from zipstream.writeFile("[Content_Types].xml", [_contentTypes])
+    yield from zipstream.writeFile("_rels/.rels", [_rootRelations])
+    yield from zipstream.writeFile(
+        "xl/workbook.xml",
+        [
+            _workbook
+            % (
+                quoteattr(title),
+                escape(
+                    "'%s'!$A$1:$%s$1048576"
+                    % (title.replace("'", "''"), columns[-1] if columns else "A")
+                ),
+            )
+        ],
+    )
+    yield from zipstream.writeFile("xl/_rels/workbook.xml.rels", [_workbookRelations])
+    yield from zipstream.writeFile("xl/styles.xml", [_styles])
+    yield from zipstream.writeFile("xl/worksheets/sheet1.xml", sheet())
+    yield zipstream.close()
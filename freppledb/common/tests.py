@@ -15,10 +15,25 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from datetime import date, datetime
+from io import BytesIO
+from openpyxl import load_workbook
+import struct
+
+from django.db import DEFAULT_DB_ALIAS
 from django.http.response import StreamingHttpResponse
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
 
-from freppledb.common.models import User
+from freppledb.common.cache import LRUCache
+from freppledb.common.commands import CopyEncoder
+from freppledb.common.models import Parameter, Scenario, User, getTableVersions
+from freppledb.common.spreadsheet import (
+    generateSpreadsheet,
+    anyCell,
+    dateCell,
+    numberCell,
+    textCell,
+)
 
 
 class DataLoadTest(TestCase):
@@ -44,3 +59,134 @@ class UserPreferenceTest(TestCase):
         user.setPreference("test", {"a": 1, "b": "c"})
         after = user.getPreference("test")
         self.assertEqual(after, {"a": 1, "b": "c"})
+
+    def test_cached_preferences(self):
+        user = User.objects.all().get(username="admin")
+        user.preferenceVersion = 0
+        self.assertIsNone(user.getPreference("test"))
+        user.setPreference("test", {"a": 1})
+        self.assertEqual(user.getPreference("test"), {"a": 1})
+        # Changing the returned value doesn't affect the cache
+        user.getPreference("test")["a"] = 2
+        user2 = User.objects.all().get(username="admin")
+        user2.preferenceVersion = 0
+        self.assertEqual(user2.getPreference("test"), {"a": 1})
+
+
+class CopyEncoderTest(SimpleTestCase):
+    columns = (
+        ("name", "varchar"),
+        ("quantity", "numeric"),
+        ("startdate", "timestamp"),
+    )
+
+    def test_text(self):
+        enc = CopyEncoder("mytable", self.columns)
+        lines = list(
+            enc.text([("a\\b\nc", 12.5, datetime(2020, 1, 1)), (None, 1, None)])
+        )
+        self.assertEqual(
+            lines, ["a\\\\b\\nc\v12.5\v2020-01-01 00:00:00\n", "\\N\v1\v\\N\n"],
+        )
+
+    def test_binary(self):
+        enc = CopyEncoder("mytable", self.columns, binary=True, buffersize=32)
+        data = b"".join(
+            enc.encode(
+                [("abc", -12345.678, datetime(2000, 1, 2)), (None, 0.05, None)] * 5
+            )
+        )
+        self.assertTrue(data.startswith(b"PGCOPY\n\xff\r\n\x00"))
+        self.assertTrue(data.endswith(struct.pack("!h", -1)))
+        row = (
+            struct.pack("!h", 3)
+            + struct.pack("!i", 3)
+            + b"abc"
+            + struct.pack("!i", 14)
+            + struct.pack("!hhHHHHH", 3, 1, 0x4000, 3, 1, 2345, 6780)
+            + struct.pack("!i", 8)
+            + struct.pack("!q", 86400000000)
+        )
+        self.assertEqual(data.count(row), 5)
+        row = (
+            struct.pack("!h", 3)
+            + struct.pack("!i", -1)
+            + struct.pack("!i", 10)
+            + struct.pack("!hhHHH", 1, -1, 0, 2, 500)
+            + struct.pack("!i", -1)
+        )
+        self.assertEqual(data.count(row), 5)
+
+
+class SpreadsheetTest(SimpleTestCase):
+    def test_generate(self):
+        rows = [
+            ["a & <b>", 12.5, date(2020, 1, 2), datetime(2020, 1, 2, 3, 4, 5)],
+            [None, 3, "not a date", None],
+        ] * 1000
+        data = b"".join(
+            generateSpreadsheet(
+                "my sheet",
+                ["Name", "Quantity", "Date", "Timestamp"],
+                rows,
+                [textCell, numberCell, dateCell, anyCell],
+            )
+        )
+        ws = load_workbook(BytesIO(data), read_only=True)["my sheet"]
+        content = [[c.value for c in r] for r in ws.iter_rows()]
+        self.assertEqual(content[0], ["Name", "Quantity", "Date", "Timestamp"])
+        self.assertEqual(len(content), 2001)
+        self.assertEqual(content[1][0], "a & <b>")
+        self.assertEqual(content[1][1], 12.5)
+        self.assertEqual(content[1][2].date(), date(2020, 1, 2))
+        self.assertEqual(content[1][3], datetime(2020, 1, 2, 3, 4, 5))
+        self.assertEqual(content[2][1:3], [3, "not a date"])
+
+
+class LRUCacheTest(SimpleTestCase):
+    def test_eviction(self):
+        c = LRUCache(100)
+        c.set("a", 1, size=40)
+        c.set("b", 2, size=40)
+        self.assertEqual(c.get("a"), 1)
+        c.set("c", 3, size=40)
+        # The least recently used entry is evicted
+        self.assertIsNone(c.get("b"))
+        self.assertEqual(c.get("a"), 1)
+        self.assertEqual(c.get("c"), 3)
+        self.assertEqual(c.size, 80)
+        c.set("d", 4, size=200)
+        self.assertIsNone(c.get("d"))
+
+    def test_version(self):
+        c = LRUCache(100)
+        c.set("a", [1, 2, 3], version=1)
+        self.assertEqual(c.get("a", version=1), [1, 2, 3])
+        self.assertIsNone(c.get("a", version=2))
+        self.assertIsNone(c.get("a", version=1))
+        self.assertEqual(c.size, 0)
+
+    def test_timeout(self):
+        c = LRUCache(100)
+        c.set("a", 1, size=10, timeout=-1)
+        c.set("b", 2, size=10, timeout=60)
+        self.assertIsNone(c.get("a"))
+        self.assertEqual(c.get("b"), 2)
+        c.deleteMatching(lambda k: k == "b")
+        self.assertIsNone(c.get("b"))
+
+
+class TableVersionTest(TransactionTestCase):
+    def test_save_delete(self):
+        tables = ["common_parameter", "common_bucket"]
+        version = getTableVersions(DEFAULT_DB_ALIAS, tables)
+        self.assertEqual(getTableVersions(DEFAULT_DB_ALIAS, tables), version)
+        param = Parameter.objects.create(name="test.version", value="1")
+        version2 = getTableVersions(DEFAULT_DB_ALIAS, tables)
+        self.assertNotEqual(version2[0], version[0])
+        self.assertEqual(version2[1], version[1])
+        param.delete()
+        self.assertNotEqual(getTableVersions(DEFAULT_DB_ALIAS, tables), version2)
+        # Models that aren't shown in the grids don't have a version
+        Scenario(name="test.version", status="Free").save()
+        self.assertEqual(getTableVersions(DEFAULT_DB_ALIAS, ["common_scenario"]), (0,))
@@ -300,6 +300,8 @@ def saveSettings(request):
         data = json.loads(request.body.decode(request.encoding))
         for key, value in data.items():
             request.user.setPreference(key, value, database=request.database)
+        # Invalidates the preferences cached by other processes
+        request.session["preferences"] = request.session.get("preferences", 0) + 1
         return HttpResponse(content="OK")
     except Exception as e:
         logger.error("Error saving report settings: %s" % e)
@@ -23,73 +23,25 @@ The code in this file is executed NOT by the Django web application, but by the
 embedded Python interpreter from the frePPLe engine.
 """
 from datetime import timedelta, datetime, date
-import io
 import json
 import logging
 import os
-from psycopg2.extensions import adapt
-from psycopg2.extras import execute_batch
+from queue import Queue
 from time import time
 from threading import Thread
 
 from django.db import connections, DEFAULT_DB_ALIAS, transaction
 from django.conf import settings
 
+from freppledb.common.commands import CopyEncoder
+from freppledb.common.models import Parameter
+from freppledb.output.commands import ExportInventoryPlans
+
 import frepple
 
 logger = logging.getLogger(__name__)
 
 
-def clean_value(value):
-    if value is None:
-        return r"\N"
-    elif "\n" in value:
-        return value.replace("\n", "\\n")
-    else:
-        return value
-
-
-class CopyFromGenerator(io.TextIOBase):
-    """
-    Inspired on and copied from:
-      https://hakibenita.com/fast-load-data-python-postgresql
-    """
-
-    def __init__(self, itr):
-        self._iter = itr
-        self._buff = ""
-
-    def readable(self):
-        return True
-
-    def _read1(self, n=None):
-        while not self._buff:
-            try:
-                self._buff = next(self._iter)
-            except StopIteration:
-                break
-        ret = self._buff[:n]
-        self._buff = self._buff[len(ret) :]
-        return ret
-
-    def read(self, n=None):
-        line = []
-        if n is None or n < 0:
-            while True:
-                m = self._read1()
-                if not m:
-                    break
-                line.append(m)
-        else:
-            while n > 0:
-                m = self._read1(n)
-                if not m:
-                    break
-                n -= len(m)
-                line.append(m)
-        return "".join(line)
-
-
 class DatabasePipe(Thread):
     """
   An auxiliary class that allows us to run a function with its own
@@ -110,8 +62,50 @@ class DatabasePipe(Thread):
             pass
 
 
+class ShardPipe(Thread):
+    """
+  An auxiliary class that runs a function consuming one shard of a data
+  stream on its own PostgreSQL connection.
+  The producer feeds chunks of records through a bounded queue.
+  """
+
+    def __init__(self, owner, function):
+        self.owner = owner
+        super().__init__()
+        self.function = function
+        self.queue = Queue(maxsize=8)
+        self.exception = None
+
+    def records(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            for rec in chunk:
+                yield rec
+
+    def run(self):
+        try:
+            self.function(self.owner, self.records())
+        except Exception as e:
+            self.exception = e
+            # Keep draining the queue to avoid blocking the producer
+            for rec in self.records():
+                pass
+        finally:
+            connections[self.owner.database].close()
+
+
 class export:
-    def __init__(self, cluster=-1, verbosity=1, database=None):
+    def __init__(
+        self,
+        cluster=-1,
+        verbosity=1,
+        database=None,
+        workers=None,
+        binary=None,
+        incremental=None,
+    ):
         self.cluster = cluster
         self.verbosity = verbosity
         if database:
@@ -121,8 +115,64 @@ class export:
                 self.database = os.environ["FREPPLE_DATABASE"]
             else:
                 self.database = DEFAULT_DB_ALIAS
+        if workers:
+            self.workers = workers
+        else:
+            try:
+                self.workers = int(os.environ["FREPPLE_EXPORT_WORKERS"])
+            except Exception:
+                self.workers = 1
+        if self.workers < 1:
+            self.workers = 1
+        if binary is None:
+            self.binary = (
+                Parameter.getValue("plan.binaryExport", self.database, "false").lower()
+                == "true"
+            )
+        else:
+            self.binary = binary
+        if cluster != -1:
+            # A partial export for a single cluster is never incremental
+            self.incremental = False
+        elif incremental is None:
+            self.incremental = (
+                Parameter.getValue(
+                    "plan.incrementalExport", self.database, "false"
+                ).lower()
+                == "true"
+            )
+        else:
+            self.incremental = incremental
         self.encoding = "UTF8"
-        self.timestamp = str(datetime.now())
+        self.timestamp = datetime.now()
+
+    def shard(self, data, function, chunksize=1000):
+        """
+        Splits a stream of (key, record) tuples over a number of parallel
+        worker threads, each with its own database connection.
+        Records with the same key always end up in the same shard.
+        """
+        pipes = [ShardPipe(self, function) for i in range(self.workers)]
+        chunks = [[] for i in range(self.workers)]
+        for p in pipes:
+            p.start()
+        try:
+            for key, rec in data:
+                idx = hash(key) % self.workers
+                chunks[idx].append(rec)
+                if len(chunks[idx]) >= chunksize:
+                    pipes[idx].queue.put(chunks[idx])
+                    chunks[idx] = []
+        finally:
+            for idx, p in enumerate(pipes):
+                if chunks[idx]:
+                    p.queue.put(chunks[idx])
+                p.queue.put(None)
+            for p in pipes:
+                p.join()
+        for p in pipes:
+            if p.exception:
+                raise p.exception
 
     def getPegging(self, opplan, buffer=None):
         unavail = opplan.unavailable
@@ -151,19 +201,23 @@ class export:
                 pln["item"] = buffer.item.name
             if buffer.location:
                 pln["location"] = buffer.location.name
-        # We need to double any backslash to assure that the string remains
-        # valid when passing it through postgresql (which eats them away)
-        return json.dumps(pln).replace("\\", "\\\\")
+        return json.dumps(pln)
 
     def truncate(self):
         cursor = connections[self.database].cursor()
         if self.verbosity:
             logger.info("Emptying database plan tables...")
         starttime = time()
-        if self.cluster == -1:
+        if self.incremental:
+            # Incremental export for the complete model.
+            # The operationplan tables are merged by the export steps.
+            cursor.execute(
+                "truncate table out_problem, out_resourceplan, out_constraint, out_inventoryplan, out_pegging"
+            )
+        elif self.cluster == -1:
             # Complete export for the complete model
             cursor.execute(
-                "truncate table out_problem, out_resourceplan, out_constraint"
+                "truncate table out_problem, out_resourceplan, out_constraint, out_inventoryplan, out_pegging"
             )
             cursor.execute(
                 """
@@ -194,110 +248,104 @@ class export:
             cursor.execute(
                 "create temporary table cluster_keys (name character varying(300), constraint cluster_key_pkey primary key (name))"
             )
-            for i in frepple.items():
-                if i.cluster == self.cluster:
-                    cursor.execute(
-                        (
-                            "insert into cluster_keys (name) values (%s);\n"
-                            % adapt(i.name).getquoted().decode(self.encoding)
-                        )
-                    )
+
+            def loadKeys(keys):
+                # All keys are loaded with a single copy statement
+                cursor.execute("truncate table cluster_keys")
+                CopyEncoder("cluster_keys", (("name", "varchar"),)).copy(
+                    cursor, ((k,) for k in keys)
+                )
+                cursor.execute("analyze cluster_keys")
+
+            loadKeys(i.name for i in frepple.items() if i.cluster == self.cluster)
             cursor.execute(
-                "delete from out_constraint where demand in (select demand.name from demand inner join cluster_keys on cluster_keys.name = demand.item_id)"
+                "delete from out_inventoryplan using cluster_keys where item = cluster_keys.name"
             )
             cursor.execute(
                 """
-        delete from operationplanmaterial
-        using cluster_keys
-        where operationplan_id in (
-          select reference from operationplan
-          inner join cluster_keys on cluster_keys.name = operationplan.item_id
-          union
-          select reference from operationplan where owner_id in (
-            select reference from operationplan parent_opplan
-            inner join cluster_keys on cluster_keys.name = parent_opplan.item_id
-            )
-          )
-        """
-            )
-            cursor.execute(
+                delete from operationplanmaterial
+                where operationplan_id in (
+                  select operationplan.reference
+                  from operationplan
+                  inner join cluster_keys on cluster_keys.name = operationplan.item_id
+                  union
+                  select child.reference
+                  from operationplan as child
+                  inner join operationplan as parent_opplan
+                    on parent_opplan.reference = child.owner_id
+                  inner join cluster_keys on cluster_keys.name = parent_opplan.item_id
+                  )
                 """
-        delete from out_problem
-        where entity = 'demand' and owner in (
-          select demand.name from demand inner join cluster_keys on cluster_keys.name = demand.item_id
-          )
-        """
             )
             cursor.execute(
                 """
-        delete from out_problem
-        where entity = 'material'
-        and owner in (
-           select buffer.item_id || ' @ ' || buffer.location_id
-           from buffer
-           inner join cluster_keys on cluster_keys.name = buffer.item_id
-           )
-        """
+                delete from out_problem
+                where entity = 'material'
+                and owner in (
+                   select buffer.item_id || ' @ ' || buffer.location_id
+                   from buffer
+                   inner join cluster_keys on cluster_keys.name = buffer.item_id
+                   )
+                """
             )
             cursor.execute(
                 """
-        delete from operationplanresource
-        where operationplan_id in (
-          select reference
-          from operationplan
-          inner join cluster_keys on cluster_keys.name = operationplan.item_id
-          where status = 'proposed' or status is null or type='STCK'
-          union
-          select reference
-          from operationplan
-          where owner_id in (
-            select reference
-            from operationplan parent_opplan
-            inner join cluster_keys on cluster_keys.name = parent_opplan.item_id
-            )
-          and (status = 'proposed' or status is null)
-          )
-        """
+                delete from operationplanresource
+                where operationplan_id in (
+                  select operationplan.reference
+                  from operationplan
+                  inner join cluster_keys on cluster_keys.name = operationplan.item_id
+                  where status = 'proposed' or status is null or type='STCK'
+                  union
+                  select child.reference
+                  from operationplan as child
+                  inner join operationplan as parent_opplan
+                    on parent_opplan.reference = child.owner_id
+                  inner join cluster_keys on cluster_keys.name = parent_opplan.item_id
+                  where child.status = 'proposed' or child.status is null
+                  )
+                """
             )
             cursor.execute(
                 """
-        delete from operationplan
-        using cluster_keys
-        where owner_id in (
-          select oplan_parent.reference
-          from operationplan as oplan_parent
-          where (oplan_parent.status='proposed' or oplan_parent.status is null or oplan_parent.type='STCK')
-          and oplan_parent.item_id = cluster_keys.name
-          )
-        """
+                delete from operationplan
+                using operationplan as oplan_parent, cluster_keys
+                where operationplan.owner_id = oplan_parent.reference
+                and (oplan_parent.status='proposed' or oplan_parent.status is null or oplan_parent.type='STCK')
+                and oplan_parent.item_id = cluster_keys.name
+                """
             )
             cursor.execute(
                 """
-        delete from operationplan
-        using cluster_keys
-        where (status='proposed' or status is null or type='STCK')
-        and item_id = cluster_keys.name
-        """
+                delete from operationplan
+                using cluster_keys
+                where (status='proposed' or status is null or type='STCK')
+                and item_id = cluster_keys.name
+                """
             )
-            # TODO next subqueries are not efficient - the exists condition triggers a sequential scan
+
+            # The demands of the cluster include the demands generated from
+            # forecasts, which allows an indexed join on the demand name.
+            loadKeys(i.name for i in frepple.demands() if i.cluster == self.cluster)
             cursor.execute(
-                "delete from out_constraint where exists (select 1 from forecast inner join cluster_keys on cluster_keys.name = forecast.item_id and out_constraint.demand like forecast.name || ' - %')"
+                """
+                delete from out_constraint
+                using cluster_keys
+                where out_constraint.demand = cluster_keys.name
+                """
             )
             cursor.execute(
-                "delete from out_problem where entity = 'demand' and exists (select 1 from forecast inner join cluster_keys on cluster_keys.name = forecast.item_id and out_problem.owner like forecast.name || ' - %')"
+                "delete from out_pegging using cluster_keys where demand = cluster_keys.name"
             )
-            cursor.execute("truncate table cluster_keys")
-            for i in frepple.resources():
-                if i.cluster == self.cluster:
-                    cursor.execute(
-                        (
-                            "insert into cluster_keys (name) values (%s)"
-                            % adapt(i.name).getquoted().decode(self.encoding)
-                        )
-                    )
             cursor.execute(
-                "delete from out_problem where entity = 'demand' and owner in (select demand.name from demand inner join cluster_keys on cluster_keys.name = demand.item_id)"
+                """
+                delete from out_problem
+                using cluster_keys
+                where entity = 'demand' and owner = cluster_keys.name
+                """
             )
+
+            loadKeys(i.name for i in frepple.resources() if i.cluster == self.cluster)
             cursor.execute(
                 "delete from operationplanresource using cluster_keys where resource_id = cluster_keys.name"
             )
@@ -307,20 +355,22 @@ class export:
             cursor.execute(
                 "delete from out_problem using cluster_keys where entity = 'capacity' and owner = cluster_keys.name"
             )
-            cursor.execute("truncate table cluster_keys")
-            for i in frepple.operations():
-                if i.cluster == self.cluster:
-                    cursor.execute(
-                        (
-                            "insert into cluster_keys (name) values (%s)"
-                            % adapt(i.name).getquoted().decode(self.encoding)
-                        )
-                    )
+
+            loadKeys(i.name for i in frepple.operations() if i.cluster == self.cluster)
             cursor.execute(
-                "delete from out_problem using cluster_keys where entity = 'operation' and owner = cluster_keys.name"
+                """
+                delete from out_problem
+                using cluster_keys
+                where entity = 'operation' and owner = cluster_keys.name
+                """
             )
             cursor.execute(
-                "delete from operationplan using cluster_keys where (status='proposed' or status is null) and operationplan.name = cluster_keys.name"
+                """
+                delete from operationplan
+                using cluster_keys
+                where (status='proposed' or status is null)
+                and operationplan.name = cluster_keys.name
+                """
             )
             cursor.execute("drop table cluster_keys")
         if self.verbosity:
@@ -335,13 +385,13 @@ class export:
                     owner = i.owner
                 if self.cluster != -1 and owner.cluster != self.cluster:
                     continue
-                yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                    clean_value(i.entity),
-                    clean_value(i.name),
-                    clean_value(owner.name),
-                    clean_value(i.description),
-                    str(i.start),
-                    str(i.end),
+                yield (
+                    i.entity,
+                    i.name,
+                    owner.name,
+                    i.description,
+                    i.start,
+                    i.end,
                     round(i.weight, 8),
                 )
 
@@ -349,21 +399,19 @@ class export:
             logger.info("Exporting problems...")
         starttime = time()
         cursor = connections[self.database].cursor()
-        cursor.copy_from(
-            CopyFromGenerator(getData()),
+        CopyEncoder(
             "out_problem",
-            columns=(
-                "entity",
-                "name",
-                "owner",
-                "description",
-                "startdate",
-                "enddate",
-                "weight",
+            (
+                ("entity", "varchar"),
+                ("name", "varchar"),
+                ("owner", "varchar"),
+                ("description", "varchar"),
+                ("startdate", "timestamptz"),
+                ("enddate", "timestamptz"),
+                ("weight", "numeric"),
             ),
-            size=1024,
-            sep="\v",
-        )
+            binary=self.binary,
+        ).copy(cursor, getData())
         if self.verbosity:
             logger.info("Exported problems in %.2f seconds" % (time() - starttime))
 
@@ -373,16 +421,16 @@ class export:
                 if self.cluster != -1 and self.cluster != d.cluster:
                     continue
                 for i in d.constraints:
-                    yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                        clean_value(d.name),
-                        clean_value(i.entity),
-                        clean_value(i.name),
+                    yield (
+                        d.name,
+                        i.entity,
+                        i.name,
                         isinstance(i.owner, frepple.operationplan)
-                        and clean_value(i.owner.operation.name)
-                        or clean_value(i.owner.name),
-                        clean_value(i.description),
-                        str(i.start),
-                        str(i.end),
+                        and i.owner.operation.name
+                        or i.owner.name,
+                        i.description,
+                        i.start,
+                        i.end,
                         round(i.weight, 8),
                     )
 
@@ -390,26 +438,166 @@ class export:
             logger.info("Exporting constraints...")
         starttime = time()
         cursor = connections[self.database].cursor()
-        cursor.copy_from(
-            CopyFromGenerator(getData()),
+        CopyEncoder(
             "out_constraint",
-            columns=(
-                "demand",
-                "entity",
-                "name",
-                "owner",
-                "description",
-                "startdate",
-                "enddate",
-                "weight",
+            (
+                ("demand", "varchar"),
+                ("entity", "varchar"),
+                ("name", "varchar"),
+                ("owner", "varchar"),
+                ("description", "varchar"),
+                ("startdate", "timestamptz"),
+                ("enddate", "timestamptz"),
+                ("weight", "numeric"),
             ),
-            size=1024,
-            sep="\v",
-        )
+            binary=self.binary,
+        ).copy(cursor, getData())
 
         if self.verbosity:
             logger.info("Exported constraints in %.2f seconds" % (time() - starttime))
 
+    def copyOperationplans(self, data, cursor=None):
+        """
+        Copies a stream of operationplan records into a temporary table, and
+        merges it into the operationplan table.
+        """
+        if not cursor:
+            cursor = connections[self.database].cursor()
+        # Export operationplans to a temporary table
+        cursor.execute(
+            """
+            create temporary table tmp_operationplan (
+                name character varying(1000),
+                type character varying(5) NOT NULL,
+                status character varying(20),
+                quantity numeric(20,8) NOT NULL,
+                startdate timestamp with time zone,
+                enddate timestamp with time zone,
+                criticality numeric(20,8),
+                delay numeric,
+                plan json,
+                source character varying(300),
+                lastmodified timestamp with time zone NOT NULL,
+                operation_id character varying(300),
+                owner_id character varying(300),
+                item_id character varying(300),
+                destination_id character varying(300),
+                origin_id character varying(300),
+                location_id character varying(300),
+                supplier_id character varying(300),
+                demand_id character varying(300),
+                due timestamp with time zone,
+                color numeric(20,8),
+                reference character varying(300) NOT NULL
+            );
+            """
+        )
+        CopyEncoder(
+            "tmp_operationplan",
+            (
+                ("name", "varchar"),
+                ("type", "varchar"),
+                ("status", "varchar"),
+                ("quantity", "numeric"),
+                ("startdate", "timestamptz"),
+                ("enddate", "timestamptz"),
+                ("criticality", "numeric"),
+                ("delay", "numeric"),
+                ("plan", "json"),
+                ("source", "varchar"),
+                ("lastmodified", "timestamptz"),
+                ("operation_id", "varchar"),
+                ("owner_id", "varchar"),
+                ("item_id", "varchar"),
+                ("destination_id", "varchar"),
+                ("origin_id", "varchar"),
+                ("location_id", "varchar"),
+                ("supplier_id", "varchar"),
+                ("demand_id", "varchar"),
+                ("due", "timestamptz"),
+                ("color", "numeric"),
+                ("reference", "varchar"),
+            ),
+            binary=self.binary,
+        ).copy(cursor, data)
+
+        # Merge temp table into the actual table
+        if self.incremental:
+            # Only the records that really changed are updated
+            cursor.execute("create index on tmp_operationplan (reference)")
+            cursor.execute("analyze tmp_operationplan")
+            cursor.execute(
+                """
+                update operationplan
+                    set name=tmp.name, type=tmp.type, status=tmp.status,
+                    quantity=tmp.quantity, startdate=tmp.startdate, enddate=tmp.enddate,
+                    criticality=tmp.criticality, delay=tmp.delay * interval '1 second',
+                    plan=tmp.plan, source=tmp.source,
+                    lastmodified=tmp.lastmodified, operation_id=tmp.operation_id, owner_id=tmp.owner_id,
+                    item_id=tmp.item_id, destination_id=tmp.destination_id, origin_id=tmp.origin_id,
+                    location_id=tmp.location_id, supplier_id=tmp.supplier_id, demand_id=tmp.demand_id,
+                    due=tmp.due, color=tmp.color
+                from tmp_operationplan as tmp
+                where operationplan.reference = tmp.reference
+                and (
+                  operationplan.name, operationplan.type, operationplan.status,
+                  operationplan.quantity, operationplan.startdate, operationplan.enddate,
+                  operationplan.criticality, operationplan.delay, operationplan.plan,
+                  operationplan.source, operationplan.operation_id, operationplan.owner_id,
+                  operationplan.item_id, operationplan.destination_id, operationplan.origin_id,
+                  operationplan.location_id, operationplan.supplier_id, operationplan.demand_id,
+                  operationplan.due, operationplan.color
+                  ) is distinct from (
+                  tmp.name, tmp.type, tmp.status,
+                  tmp.quantity, tmp.startdate, tmp.enddate,
+                  tmp.criticality, tmp.delay * interval '1 second', tmp.plan::jsonb,
+                  tmp.source, tmp.operation_id, tmp.owner_id,
+                  tmp.item_id, tmp.destination_id, tmp.origin_id,
+                  tmp.location_id, tmp.supplier_id, tmp.demand_id,
+                  tmp.due, tmp.color
+                  );
+                """
+            )
+        else:
+            cursor.execute(
+                """
+                update operationplan
+                    set name=tmp.name, type=tmp.type, status=tmp.status,
+                    quantity=tmp.quantity, startdate=tmp.startdate, enddate=tmp.enddate,
+                    criticality=tmp.criticality, delay=tmp.delay * interval '1 second',
+                    plan=tmp.plan, source=tmp.source,
+                    lastmodified=tmp.lastmodified, operation_id=tmp.operation_id, owner_id=tmp.owner_id,
+                    item_id=tmp.item_id, destination_id=tmp.destination_id, origin_id=tmp.origin_id,
+                    location_id=tmp.location_id, supplier_id=tmp.supplier_id, demand_id=tmp.demand_id,
+                    due=tmp.due, color=tmp.color
+                from tmp_operationplan as tmp
+                where operationplan.reference = tmp.reference;
+                """
+            )
+        cursor.execute(
+            """
+            insert into operationplan
+              (name,type,status,quantity,startdate,enddate,
+              criticality,delay,plan,source,lastmodified,
+              operation_id,owner_id,
+              item_id,destination_id,origin_id,
+              location_id,supplier_id,
+              demand_id,due,color,reference)
+            select name,type,status,quantity,startdate,enddate,
+              criticality,delay * interval '1 second',plan,source,lastmodified,
+              operation_id,owner_id,
+              item_id,destination_id,origin_id,
+              location_id,supplier_id,
+              demand_id,due,color,reference
+            from tmp_operationplan
+            where not exists (
+              select 1
+              from operationplan
+              where operationplan.reference = tmp_operationplan.reference
+              );
+            """
+        )
+
     def exportOperationplans(self):
         def getData():
             for i in frepple.operations():
@@ -419,191 +607,197 @@ class export:
                     delay = j.delay
                     color = 100 - delay / 86400
 
+                    # Child operationplans are sharded with their top owner,
+                    # such that the owner_id foreign key is always satisfied.
+                    top = j
+                    while top.owner:
+                        top = top.owner
+
                     if isinstance(i, frepple.operation_inventory):
                         # Export inventory
-                        yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                            clean_value(i.name),
+                        yield top.reference, (
+                            i.name,
                             "STCK",
                             j.status,
                             round(j.quantity, 8),
-                            str(j.start),
-                            str(j.end),
+                            j.start,
+                            j.end,
                             round(j.criticality, 8),
                             j.delay,
                             self.getPegging(j),
-                            clean_value(j.source),
+                            j.source,
                             self.timestamp,
-                            "\\N",
-                            clean_value(j.owner.reference)
+                            None,
+                            j.owner.reference
                             if j.owner and not j.owner.operation.hidden
-                            else "\\N",
-                            clean_value(j.operation.buffer.item.name),
-                            clean_value(j.operation.buffer.location.name),
-                            "\\N",
-                            "\\N",
-                            "\\N",
-                            clean_value(j.demand.name)
+                            else None,
+                            j.operation.buffer.item.name,
+                            j.operation.buffer.location.name,
+                            None,
+                            None,
+                            None,
+                            j.demand.name
                             if j.demand
-                            else clean_value(j.owner.demand.name)
+                            else j.owner.demand.name
                             if j.owner and j.owner.demand
-                            else "\\N",
+                            else None,
                             j.demand.due
                             if j.demand
                             else j.owner.demand.due
                             if j.owner and j.owner.demand
-                            else "\\N",
+                            else None,
                             color,
-                            clean_value(j.reference),
+                            j.reference,
                         )
                     elif isinstance(i, frepple.operation_itemdistribution):
                         # Export DO
-                        yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                            clean_value(i.name),
+                        yield top.reference, (
+                            i.name,
                             "DO",
                             j.status,
                             round(j.quantity, 8),
-                            str(j.start),
-                            str(j.end),
+                            j.start,
+                            j.end,
                             round(j.criticality, 8),
                             j.delay,
                             self.getPegging(j),
-                            clean_value(j.source),
+                            j.source,
                             self.timestamp,
-                            "\\N",
-                            clean_value(j.owner.reference)
+                            None,
+                            j.owner.reference
                             if j.owner and not j.owner.operation.hidden
-                            else "\\N",
-                            clean_value(j.operation.destination.item.name)
+                            else None,
+                            j.operation.destination.item.name
                             if j.operation.destination
                             else j.operation.origin.item.name,
-                            clean_value(j.operation.destination.location.name)
+                            j.operation.destination.location.name
                             if j.operation.destination
-                            else "\\N",
-                            clean_value(j.operation.origin.location.name)
+                            else None,
+                            j.operation.origin.location.name
                             if j.operation.origin
-                            else "\\N",
-                            "\\N",
-                            "\\N",
-                            clean_value(j.demand.name)
+                            else None,
+                            None,
+                            None,
+                            j.demand.name
                             if j.demand
-                            else clean_value(j.owner.demand.name)
+                            else j.owner.demand.name
                             if j.owner and j.owner.demand
-                            else "\\N",
+                            else None,
                             j.demand.due
                             if j.demand
                             else j.owner.demand.due
                             if j.owner and j.owner.demand
-                            else "\\N",
+                            else None,
                             color,
-                            clean_value(j.reference),
+                            j.reference,
                         )
                     elif isinstance(i, frepple.operation_itemsupplier):
                         # Export PO
-                        yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                            clean_value(i.name),
+                        yield top.reference, (
+                            i.name,
                             "PO",
                             j.status,
                             round(j.quantity, 8),
-                            str(j.start),
-                            str(j.end),
+                            j.start,
+                            j.end,
                             round(j.criticality, 8),
                             j.delay,
                             self.getPegging(j),
-                            clean_value(j.source),
+                            j.source,
                             self.timestamp,
-                            "\\N",
-                            clean_value(j.owner.reference)
+                            None,
+                            j.owner.reference
                             if j.owner and not j.owner.operation.hidden
-                            else "\\N",
-                            clean_value(j.operation.buffer.item.name),
-                            "\\N",
-                            "\\N",
-                            clean_value(j.operation.buffer.location.name),
-                            clean_value(j.operation.itemsupplier.supplier.name),
-                            clean_value(j.demand.name)
+                            else None,
+                            j.operation.buffer.item.name,
+                            None,
+                            None,
+                            j.operation.buffer.location.name,
+                            j.operation.itemsupplier.supplier.name,
+                            j.demand.name
                             if j.demand
-                            else clean_value(j.owner.demand.name)
+                            else j.owner.demand.name
                             if j.owner and j.owner.demand
-                            else "\\N",
+                            else None,
                             j.demand.due
                             if j.demand
                             else j.owner.demand.due
                             if j.owner and j.owner.demand
-                            else "\\N",
+                            else None,
                             color,
-                            clean_value(j.reference),
+                            j.reference,
                         )
                     elif not i.hidden:
                         # Export MO
-                        yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                            clean_value(i.name),
+                        yield top.reference, (
+                            i.name,
                             "MO",
                             j.status,
                             round(j.quantity, 8),
-                            str(j.start),
-                            str(j.end),
+                            j.start,
+                            j.end,
                             round(j.criticality, 8),
                             j.delay,
                             self.getPegging(j),
-                            clean_value(j.source),
+                            j.source,
                             self.timestamp,
-                            clean_value(i.name),
-                            clean_value(j.owner.reference)
+                            i.name,
+                            j.owner.reference
                             if j.owner and not j.owner.operation.hidden
-                            else "\\N",
-                            clean_value(i.item.name) if i.item else "\\N",
-                            "\\N",
-                            "\\N",
-                            clean_value(i.location.name) if i.location else "\\N",
-                            "\\N",
-                            clean_value(j.demand.name)
+                            else None,
+                            i.item.name if i.item else None,
+                            None,
+                            None,
+                            i.location.name if i.location else None,
+                            None,
+                            j.demand.name
                             if j.demand
-                            else clean_value(j.owner.demand.name)
+                            else j.owner.demand.name
                             if j.owner and j.owner.demand
-                            else "\\N",
+                            else None,
                             j.demand.due
                             if j.demand
                             else j.owner.demand.due
                             if j.owner and j.owner.demand
-                            else "\\N",
+                            else None,
                             color,
-                            clean_value(j.reference),
+                            j.reference,
                         )
                     elif j.demand or (j.owner and j.owner.demand):
                         # Export shipments (with automatically created delivery operations)
-                        yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                            clean_value(i.name),
+                        yield top.reference, (
+                            i.name,
                             "DLVR",
                             j.status,
                             round(j.quantity, 8),
-                            str(j.start),
-                            str(j.end),
+                            j.start,
+                            j.end,
                             round(j.criticality, 8),
                             j.delay,
                             self.getPegging(j),
-                            clean_value(j.source),
+                            j.source,
                             self.timestamp,
-                            "\\N",
-                            clean_value(j.owner.reference)
+                            None,
+                            j.owner.reference
                             if j.owner and not j.owner.operation.hidden
-                            else "\\N",
-                            clean_value(j.operation.buffer.item.name),
-                            "\\N",
-                            "\\N",
-                            clean_value(j.operation.buffer.location.name),
-                            "\\N",
-                            clean_value(j.demand.name)
+                            else None,
+                            j.operation.buffer.item.name,
+                            None,
+                            None,
+                            j.operation.buffer.location.name,
+                            None,
+                            j.demand.name
                             if j.demand
-                            else clean_value(j.owner.demand.name)
+                            else j.owner.demand.name
                             if j.owner and j.owner.demand
-                            else "\\N",
+                            else None,
                             j.demand.due
                             if j.demand
                             else j.owner.demand.due
                             if j.owner and j.owner.demand
-                            else "\\N",
+                            else None,
                             color,
-                            clean_value(j.reference),
+                            j.reference,
                         )
 
         if self.verbosity:
@@ -611,149 +805,132 @@ class export:
         starttime = time()
         cursor = connections[self.database].cursor()
 
-        # Export operationplans to a temporary table
-        cursor.execute(
-            """
-            create temporary table tmp_operationplan (
-                name character varying(1000),
-                type character varying(5) NOT NULL,
-                status character varying(20),
-                quantity numeric(20,8) NOT NULL,
-                startdate timestamp with time zone,
-                enddate timestamp with time zone,
-                criticality numeric(20,8),
-                delay numeric,
-                plan json,
-                source character varying(300),
-                lastmodified timestamp with time zone NOT NULL,
-                operation_id character varying(300),
-                owner_id character varying(300),
-                item_id character varying(300),
-                destination_id character varying(300),
-                origin_id character varying(300),
-                location_id character varying(300),
-                supplier_id character varying(300),
-                demand_id character varying(300),
-                due timestamp with time zone,
-                color numeric(20,8),
-                reference character varying(300) NOT NULL
-            );
-            """
-        )
-        cursor.copy_from(
-            CopyFromGenerator(getData()), table="tmp_operationplan", size=1024, sep="\v"
-        )
+        if self.workers > 1 and not self.incremental:
+            # Each shard is copied and merged over its own connection
+            self.shard(getData(), export.copyOperationplans)
 
-        # Merge temp table into the actual table
-        cursor.execute(
-            """
-            update operationplan
-                set name=tmp.name, type=tmp.type, status=tmp.status,
-                quantity=tmp.quantity, startdate=tmp.startdate, enddate=tmp.enddate,
-                criticality=tmp.criticality, delay=tmp.delay * interval '1 second',
-                plan=tmp.plan, source=tmp.source,
-                lastmodified=tmp.lastmodified, operation_id=tmp.operation_id, owner_id=tmp.owner_id,
-                item_id=tmp.item_id, destination_id=tmp.destination_id, origin_id=tmp.origin_id,
-                location_id=tmp.location_id, supplier_id=tmp.supplier_id, demand_id=tmp.demand_id,
-                due=tmp.due, color=tmp.color
-            from tmp_operationplan as tmp
-            where operationplan.reference = tmp.reference;
-            """
-        )
-        cursor.execute(
-            """
-            with cte as (
-              select reference
-              from operationplan
-              where status in ('confirmed','approved','completed')
-              and type = 'MO'
-              and not exists (select 1 from tmp_operationplan where reference = operationplan.reference)
-              )
-            delete from operationplanmaterial
-            where exists (select 1 from cte where cte.reference = operationplan_id)
-            """
-        )
-        cursor.execute(
-            """
-            with cte as (
-              select reference
-              from operationplan
-              where status in ('confirmed','approved','completed')
-              and type = 'MO'
-              and not exists (select 1 from tmp_operationplan where reference = operationplan.reference)
-              )
-            delete from operationplanresource
-            where exists (select 1 from cte where cte.reference = operationplan_id)
-            """
-        )
-        cursor.execute(
-            """
-            delete from operationplan
-            where status in ('confirmed','approved','completed')
-            and type = 'MO'
-            and not exists (select 1 from tmp_operationplan where reference = operationplan.reference)
-            """
-        )
-
-        cursor.execute(
-            """
-            with cte as (
-              select reference
-              from operationplan
-              where status in ('confirmed','approved','completed')
-              and type = 'MO'
-              and not exists (select 1 from tmp_operationplan where reference = operationplan.reference)
-              )
-            delete from operationplanmaterial
-            where exists (select 1 from cte where cte.reference = operationplan_id)
-            """
-        )
-        cursor.execute(
-            """
-            with cte as (
-              select reference
-              from operationplan
-              where status in ('confirmed','approved','completed')
-              and type = 'MO'
-              and not exists (select 1 from tmp_operationplan where reference = operationplan.reference)
-              )
-            delete from operationplanresource
-            where exists (select 1 from cte where cte.reference = operationplan_id)
-            """
-        )
-        cursor.execute(
-            """
-            delete
-            from operationplan
-            where status in ('confirmed','approved','completed')
-            and type = 'MO'
-            and not exists (select 1 from tmp_operationplan where reference = operationplan.reference)
-            """
-        )
+            # The temporary tables of the shards are gone by now. All exported
+            # records carry the timestamp of this export, which allows us to
+            # find the confirmed manufacturing orders that weren't exported.
+            cursor.execute(
+                """
+                with cte as (
+                  select reference
+                  from operationplan
+                  where status in ('confirmed','approved','completed')
+                  and type = 'MO'
+                  and lastmodified <> %s
+                  )
+                delete from operationplanmaterial
+                where exists (select 1 from cte where cte.reference = operationplan_id)
+                """,
+                (self.timestamp,),
+            )
+            cursor.execute(
+                """
+                with cte as (
+                  select reference
+                  from operationplan
+                  where status in ('confirmed','approved','completed')
+                  and type = 'MO'
+                  and lastmodified <> %s
+                  )
+                delete from operationplanresource
+                where exists (select 1 from cte where cte.reference = operationplan_id)
+                """,
+                (self.timestamp,),
+            )
+            cursor.execute(
+                """
+                delete from operationplan
+                where status in ('confirmed','approved','completed')
+                and type = 'MO'
+                and lastmodified <> %s
+                """,
+                (self.timestamp,),
+            )
+        else:
+            with transaction.atomic(using=self.database):
+                self.copyOperationplans((rec for key, rec in getData()), cursor=cursor)
+                cursor.execute(
+                    """
+                    with cte as (
+                      select reference
+                      from operationplan
+                      where status in ('confirmed','approved','completed')
+                      and type = 'MO'
+                      and not exists (select 1 from tmp_operationplan where reference = operationplan.reference)
+                      )
+                    delete from operationplanmaterial
+                    where exists (select 1 from cte where cte.reference = operationplan_id)
+                    """
+                )
+                cursor.execute(
+                    """
+                    with cte as (
+                      select reference
+                      from operationplan
+                      where status in ('confirmed','approved','completed')
+                      and type = 'MO'
+                      and not exists (select 1 from tmp_operationplan where reference = operationplan.reference)
+                      )
+                    delete from operationplanresource
+                    where exists (select 1 from cte where cte.reference = operationplan_id)
+                    """
+                )
+                cursor.execute(
+                    """
+                    delete from operationplan
+                    where status in ('confirmed','approved','completed')
+                    and type = 'MO'
+                    and not exists (select 1 from tmp_operationplan where reference = operationplan.reference)
+                    """
+                )
 
-        cursor.execute(
-            """
-            insert into operationplan
-              (name,type,status,quantity,startdate,enddate,
-              criticality,delay,plan,source,lastmodified,
-              operation_id,owner_id,
-              item_id,destination_id,origin_id,
-              location_id,supplier_id,
-              demand_id,due,color,reference)
-            select name,type,status,quantity,startdate,enddate,
-              criticality,delay * interval '1 second',plan,source,lastmodified,
-              operation_id,owner_id,
-              item_id,destination_id,origin_id,
-              location_id,supplier_id,
-              demand_id,due,color,reference
-            from tmp_operationplan
-            where not exists (
-              select 1
-              from operationplan
-              where operationplan.reference = tmp_operationplan.reference
-              );
-            """
-        )
+                if self.incremental:
+                    # Remove the proposed operationplans that are no longer in the plan
+                    cursor.execute(
+                        """
+                        create temporary table tmp_stale_operationplan as
+                        select reference
+                        from operationplan
+                        where (status = 'proposed' or status is null or type = 'STCK')
+                        and not exists (
+                          select 1 from tmp_operationplan
+                          where tmp_operationplan.reference = operationplan.reference
+                          )
+                        """
+                    )
+                    cursor.execute(
+                        """
+                        delete from operationplanmaterial
+                        using tmp_stale_operationplan as stale
+                        where operationplanmaterial.operationplan_id = stale.reference
+                        """
+                    )
+                    cursor.execute(
+                        """
+                        delete from operationplanresource
+                        using tmp_stale_operationplan as stale
+                        where operationplanresource.operationplan_id = stale.reference
+                        """
+                    )
+                    cursor.execute(
+                        """
+                        update operationplan
+                        set owner_id = null
+                        from tmp_stale_operationplan as stale
+                        where operationplan.owner_id = stale.reference
+                        """
+                    )
+                    cursor.execute(
+                        """
+                        delete from operationplan
+                        using tmp_stale_operationplan as stale
+                        where operationplan.reference = stale.reference
+                        """
+                    )
+                    cursor.execute("drop table tmp_stale_operationplan")
 
         # update demand table specific fields
         cursor.execute(
@@ -770,6 +947,8 @@ class export:
               deliverydate = cte.deliverydate
             from cte
             where cte.demand_id = demand.name
+            and (demand.delay, demand.plannedquantity, demand.deliverydate)
+              is distinct from (cte.delay, cte.plannedquantity, cte.deliverydate)
             """
         )
         cursor.execute(
@@ -813,12 +992,12 @@ class export:
                             j.operationplan.end,
                         )
                     else:
-                        yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                            clean_value(j.operationplan.id),
-                            clean_value(j.buffer.item.name),
-                            clean_value(j.buffer.location.name),
+                        yield j.operationplan.reference, (
+                            j.operationplan.id,
+                            j.buffer.item.name,
+                            j.buffer.location.name,
                             round(j.quantity, 8),
-                            str(j.date),
+                            j.date,
                             round(j.onhand, 8),
                             round(j.minimum, 8),
                             round(j.period_of_cover, 8),
@@ -829,34 +1008,111 @@ class export:
         if self.verbosity:
             logger.info("Exporting operationplan materials...")
         starttime = time()
-        cursor = connections[self.database].cursor()
-        updates = []
-        cursor.copy_from(
-            CopyFromGenerator(getData()),
-            "operationplanmaterial",
-            columns=(
-                "operationplan_id",
-                "item_id",
-                "location_id",
-                "quantity",
-                "flowdate",
-                "onhand",
-                "minimum",
-                "periodofcover",
-                "status",
-                "lastmodified",
-            ),
-            size=1024,
-            sep="\v",
-        )
-        if len(updates) > 0:
-            cursor.execute("\n".join(updates))
+        if self.workers > 1 and not self.incremental:
+            self.shard(getData(), export.copyOperationPlanMaterials)
+        else:
+            self.copyOperationPlanMaterials(rec for key, rec in getData())
         if self.verbosity:
             logger.info(
                 "Exported operationplan materials in %.2f seconds"
                 % (time() - starttime)
             )
 
+    def copyOperationPlanMaterials(self, data):
+        cursor = connections[self.database].cursor()
+        if self.incremental:
+            with transaction.atomic(using=self.database):
+                cursor.execute(
+                    """
+                    create temporary table tmp_operationplanmaterial (
+                        operationplan_id character varying(300) NOT NULL,
+                        item_id character varying(300) NOT NULL,
+                        location_id character varying(300) NOT NULL,
+                        quantity numeric(20,8) NOT NULL,
+                        flowdate timestamp with time zone NOT NULL,
+                        onhand numeric(20,8),
+                        minimum numeric(20,8),
+                        periodofcover numeric(20,8),
+                        status character varying(20),
+                        lastmodified timestamp with time zone NOT NULL
+                    )
+                    """
+                )
+                self.copyOperationPlanMaterialsInto(
+                    cursor, data, "tmp_operationplanmaterial"
+                )
+                cursor.execute(
+                    "create index on tmp_operationplanmaterial (operationplan_id)"
+                )
+                cursor.execute("analyze tmp_operationplanmaterial")
+                # Records that are unchanged stay untouched
+                cursor.execute(
+                    """
+                    delete from operationplanmaterial
+                    where not exists (
+                      select 1 from tmp_operationplanmaterial as tmp
+                      where tmp.operationplan_id = operationplanmaterial.operationplan_id
+                      and tmp.item_id = operationplanmaterial.item_id
+                      and tmp.location_id = operationplanmaterial.location_id
+                      and tmp.flowdate = operationplanmaterial.flowdate
+                      and tmp.quantity = operationplanmaterial.quantity
+                      and (tmp.onhand, tmp.minimum, tmp.periodofcover, tmp.status)
+                        is not distinct from (
+                        operationplanmaterial.onhand, operationplanmaterial.minimum,
+                        operationplanmaterial.periodofcover, operationplanmaterial.status
+                        )
+                      )
+                    """
+                )
+                cursor.execute(
+                    """
+                    insert into operationplanmaterial
+                      (operationplan_id, item_id, location_id, quantity, flowdate,
+                      onhand, minimum, periodofcover, status, lastmodified)
+                    select
+                      operationplan_id, item_id, location_id, quantity, flowdate,
+                      onhand, minimum, periodofcover, status, lastmodified
+                    from tmp_operationplanmaterial as tmp
+                    where not exists (
+                      select 1 from operationplanmaterial
+                      where tmp.operationplan_id = operationplanmaterial.operationplan_id
+                      and tmp.item_id = operationplanmaterial.item_id
+                      and tmp.location_id = operationplanmaterial.location_id
+                      and tmp.flowdate = operationplanmaterial.flowdate
+                      and tmp.quantity = operationplanmaterial.quantity
+                      and (tmp.onhand, tmp.minimum, tmp.periodofcover, tmp.status)
+                        is not distinct from (
+                        operationplanmaterial.onhand, operationplanmaterial.minimum,
+                        operationplanmaterial.periodofcover, operationplanmaterial.status
+                        )
+                      )
+                    """
+                )
+                cursor.execute("drop table tmp_operationplanmaterial")
+        else:
+            self.copyOperationPlanMaterialsInto(cursor, data, "operationplanmaterial")
+
+    def copyOperationPlanMaterialsInto(self, cursor, data, table):
+        updates = []
+        CopyEncoder(
+            table,
+            (
+                ("operationplan_id", "varchar"),
+                ("item_id", "varchar"),
+                ("location_id", "varchar"),
+                ("quantity", "numeric"),
+                ("flowdate", "timestamptz"),
+                ("onhand", "numeric"),
+                ("minimum", "numeric"),
+                ("periodofcover", "numeric"),
+                ("status", "varchar"),
+                ("lastmodified", "timestamptz"),
+            ),
+            binary=self.binary,
+        ).copy(cursor, data)
+        if len(updates) > 0:
+            cursor.execute("\n".join(updates))
+
     def exportOperationPlanResources(self):
         def getData():
             for i in frepple.resources():
@@ -874,13 +1130,13 @@ class export:
                             j.operationplan.end,
                         )
                     else:
-                        yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                            clean_value(j.operationplan.reference),
-                            clean_value(j.resource.name),
+                        yield j.operationplan.reference, (
+                            j.operationplan.reference,
+                            j.resource.name,
                             round(-j.quantity, 8),
-                            str(j.startdate),
-                            str(j.enddate),
-                            clean_value(j.setup),
+                            j.startdate,
+                            j.enddate,
+                            j.setup,
                             j.status,
                             self.timestamp,
                         )
@@ -888,29 +1144,100 @@ class export:
         if self.verbosity:
             logger.info("Exporting operationplan resources...")
         starttime = time()
-        cursor = connections[self.database].cursor()
-        cursor.copy_from(
-            CopyFromGenerator(getData()),
-            "operationplanresource",
-            columns=(
-                "operationplan_id",
-                "resource_id",
-                "quantity",
-                "startdate",
-                "enddate",
-                "setup",
-                "status",
-                "lastmodified",
-            ),
-            size=1024,
-            sep="\v",
-        )
+        if self.workers > 1 and not self.incremental:
+            self.shard(getData(), export.copyOperationPlanResources)
+        else:
+            self.copyOperationPlanResources(rec for key, rec in getData())
         if self.verbosity:
             logger.info(
                 "Exported operationplan resources in %.2f seconds"
                 % (time() - starttime)
             )
 
+    def copyOperationPlanResources(self, data):
+        cursor = connections[self.database].cursor()
+        if self.incremental:
+            with transaction.atomic(using=self.database):
+                cursor.execute(
+                    """
+                    create temporary table tmp_operationplanresource (
+                        operationplan_id character varying(300) NOT NULL,
+                        resource_id character varying(300) NOT NULL,
+                        quantity numeric(20,8) NOT NULL,
+                        startdate timestamp with time zone,
+                        enddate timestamp with time zone,
+                        setup character varying(300),
+                        status character varying(20),
+                        lastmodified timestamp with time zone NOT NULL
+                    )
+                    """
+                )
+                self.copyOperationPlanResourcesInto(
+                    cursor, data, "tmp_operationplanresource"
+                )
+                cursor.execute(
+                    "create index on tmp_operationplanresource (operationplan_id)"
+                )
+                cursor.execute("analyze tmp_operationplanresource")
+                # Records that are unchanged stay untouched
+                cursor.execute(
+                    """
+                    delete from operationplanresource
+                    where not exists (
+                      select 1 from tmp_operationplanresource as tmp
+                      where tmp.operationplan_id = operationplanresource.operationplan_id
+                      and tmp.resource_id = operationplanresource.resource_id
+                      and tmp.quantity = operationplanresource.quantity
+                      and (tmp.startdate, tmp.enddate, tmp.setup, tmp.status)
+                        is not distinct from (
+                        operationplanresource.startdate, operationplanresource.enddate,
+                        operationplanresource.setup, operationplanresource.status
+                        )
+                      )
+                    """
+                )
+                cursor.execute(
+                    """
+                    insert into operationplanresource
+                      (operationplan_id, resource_id, quantity, startdate, enddate,
+                      setup, status, lastmodified)
+                    select
+                      operationplan_id, resource_id, quantity, startdate, enddate,
+                      setup, status, lastmodified
+                    from tmp_operationplanresource as tmp
+                    where not exists (
+                      select 1 from operationplanresource
+                      where tmp.operationplan_id = operationplanresource.operationplan_id
+                      and tmp.resource_id = operationplanresource.resource_id
+                      and tmp.quantity = operationplanresource.quantity
+                      and (tmp.startdate, tmp.enddate, tmp.setup, tmp.status)
+                        is not distinct from (
+                        operationplanresource.startdate, operationplanresource.enddate,
+                        operationplanresource.setup, operationplanresource.status
+                        )
+                      )
+                    """
+                )
+                cursor.execute("drop table tmp_operationplanresource")
+        else:
+            self.copyOperationPlanResourcesInto(cursor, data, "operationplanresource")
+
+    def copyOperationPlanResourcesInto(self, cursor, data, table):
+        CopyEncoder(
+            table,
+            (
+                ("operationplan_id", "varchar"),
+                ("resource_id", "varchar"),
+                ("quantity", "numeric"),
+                ("startdate", "timestamptz"),
+                ("enddate", "timestamptz"),
+                ("setup", "varchar"),
+                ("status", "varchar"),
+                ("lastmodified", "timestamptz"),
+            ),
+            binary=self.binary,
+        ).copy(cursor, data)
+
     def exportResourceplans(self):
         # Build a list of horizon buckets
         if self.verbosity:
@@ -957,9 +1284,9 @@ class export:
             # Loop over all reporting buckets of all resources
             for i in frepple.resources():
                 for j in i.plan(buckets):
-                    yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                        clean_value(i.name),
-                        str(j["start"]),
+                    yield (
+                        i.name,
+                        j["start"],
                         round(j["available"], 8),
                         round(j["unavailable"], 8),
                         round(j["setup"], 8),
@@ -967,58 +1294,109 @@ class export:
                         round(j["free"], 8),
                     )
 
-        cursor.copy_from(
-            CopyFromGenerator(getData()),
+        CopyEncoder(
             "out_resourceplan",
-            columns=(
-                "resource",
-                "startdate",
-                "available",
-                "unavailable",
-                "setup",
-                "load",
-                "free",
+            (
+                ("resource", "varchar"),
+                ("startdate", "timestamptz"),
+                ("available", "numeric"),
+                ("unavailable", "numeric"),
+                ("setup", "numeric"),
+                ("load", "numeric"),
+                ("free", "numeric"),
             ),
-            size=1024,
-            sep="\v",
-        )
+            binary=self.binary,
+        ).copy(cursor, getData())
         if self.verbosity:
             logger.info("Exported resourceplans in %.2f seconds" % (time() - starttime))
 
+    def exportInventoryplans(self):
+        if self.verbosity:
+            logger.info("Exporting inventory plans...")
+        starttime = time()
+        cursor = connections[self.database].cursor()
+        startdate, enddate = ExportInventoryPlans.getHorizon(cluster=self.cluster)
+        CopyEncoder(
+            "out_inventoryplan",
+            (
+                ("item", "varchar"),
+                ("location", "varchar"),
+                ("bucket", "varchar"),
+                ("startdate", "timestamptz"),
+                ("enddate", "timestamptz"),
+                ("startoh", "numeric"),
+                ("startohdoc", "int4"),
+                ("safetystock", "numeric"),
+                ("consumed", "numeric"),
+                ("consumedmo", "numeric"),
+                ("consumeddo", "numeric"),
+                ("consumedso", "numeric"),
+                ("produced", "numeric"),
+                ("producedmo", "numeric"),
+                ("produceddo", "numeric"),
+                ("producedpo", "numeric"),
+                ("endoh", "numeric"),
+                ("total_in_progress", "numeric"),
+                ("work_in_progress_mo", "numeric"),
+                ("on_order_po", "numeric"),
+                ("in_transit_do", "numeric"),
+            ),
+            binary=self.binary,
+        ).copy(
+            cursor,
+            ExportInventoryPlans.getData(
+                ExportInventoryPlans.getBuckets(cursor, startdate, enddate),
+                ExportInventoryPlans.getSafetyStock(cursor),
+                cluster=self.cluster,
+            ),
+        )
+        if self.verbosity:
+            logger.info(
+                "Exported inventory plans in %.2f seconds" % (time() - starttime)
+            )
+
     def exportPegging(self):
-        def getDemandPlan():
+        def getData():
             for i in frepple.demands():
                 if self.cluster != -1 and self.cluster != i.cluster:
                     continue
                 if i.hidden or not isinstance(i, frepple.demand_default):
                     continue
-                peg = []
                 for j in i.pegging:
-                    peg.append(
-                        {
-                            "level": j.level,
-                            "opplan": j.operationplan.reference,
-                            "quantity": j.quantity,
-                        }
+                    yield i.name, (
+                        i.name,
+                        j.operationplan.reference,
+                        j.level,
+                        round(j.quantity, 8),
                     )
-                yield (json.dumps({"pegging": peg}), i.name)
 
         logger.info("Exporting demand pegging...")
         starttime = time()
-        with transaction.atomic(using=self.database, savepoint=False):
-            cursor = connections[self.database].cursor()
-            execute_batch(
-                cursor,
-                "update demand set plan=%s where name=%s",
-                getDemandPlan(),
-                page_size=200,
-            )
+        if self.workers > 1:
+            self.shard(getData(), export.copyPegging)
+        else:
+            self.copyPegging(rec for key, rec in getData())
         logger.info("Exported demand pegging in %.2f seconds" % (time() - starttime))
 
+    def copyPegging(self, data):
+        cursor = connections[self.database].cursor()
+        CopyEncoder(
+            "out_pegging",
+            (
+                ("demand", "varchar"),
+                ("operationplan", "varchar"),
+                ("level", "int4"),
+                ("quantity", "numeric"),
+            ),
+            binary=self.binary,
+        ).copy(cursor, data)
+
     def run(self):
         """
         This function exports the data from the frePPLe memory into the database.
         The export runs in parallel over 2 connections to PostgreSQL.
+        When multiple workers are configured, the large tables are further
+        split by reference over that number of extra connections.
         """
         # Truncate
         task = DatabasePipe(self, export.truncate)
@@ -1030,6 +1408,7 @@ class export:
             DatabasePipe(
                 self,
                 export.exportResourceplans,
+                export.exportInventoryplans,
                 export.exportProblems,
                 export.exportConstraints,
             ),
@@ -1038,8 +1417,8 @@ class export:
                 export.exportOperationplans,
                 export.exportOperationPlanMaterials,
                 export.exportOperationPlanResources,
-                export.exportPegging
-                ),
+                export.exportPegging,
+            ),
         )
 
         # Start all threads
@@ -1059,6 +1438,8 @@ class export:
         union select 'operationplanmaterial', count(*) from operationplanmaterial
         union select 'operationplanresource', count(*) from operationplanresource
         union select 'out_resourceplan', count(*) from out_resourceplan
+        union select 'out_inventoryplan', count(*) from out_inventoryplan
+        union select 'out_pegging', count(*) from out_pegging
         union select 'operationplan', count(*) from operationplan
         order by 1
         """
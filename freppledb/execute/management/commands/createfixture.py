@@ -242,6 +242,16 @@ class Command(BaseCommand):
             n = Command.extractTable(
                 database, file_object, "out_resourceplan", "output.resourcesummary"
             )
+            if n > 0:
+                file_object.write(",\n")
+            n = Command.extractTable(
+                database, file_object, "out_inventoryplan", "output.inventorysummary"
+            )
+            if n > 0:
+                file_object.write(",\n")
+            n = Command.extractTable(
+                database, file_object, "out_pegging", "output.pegging"
+            )
             if n > 0:
                 file_object.write(",\n")
             n = Command.extractTable(
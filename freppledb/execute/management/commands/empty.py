@@ -304,10 +304,14 @@ class Command(BaseCommand):
                 tables.add("operationplanmaterial")
                 tables.add("operationplanresource")
                 tables.add("out_problem")
+                tables.add("out_inventoryplan")
+                tables.add("out_pegging")
             if "resource" in tables and "out_resourceplan" not in tables:
                 tables.add("out_resourceplan")
             if "demand" in tables and "out_constraint" not in tables:
                 tables.add("out_constraint")
+            if "demand" in tables and "out_pegging" not in tables:
+                tables.add("out_pegging")
             tables.discard("auth_group_permissions")
             tables.discard("auth_permission")
             tables.discard("auth_group")
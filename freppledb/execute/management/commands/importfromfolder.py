@@ -20,9 +20,11 @@ from datetime import datetime
 from time import localtime, strftime
 import csv
 import gzip
+from multiprocessing import Pool
 from openpyxl import load_workbook
 import os
 import logging
+import queue
 
 from django.conf import settings
 from django.contrib.auth import get_permission_codename
@@ -38,7 +40,7 @@ from django.template import Template, RequestContext
 from freppledb.execute.models import Task
 from freppledb.common.middleware import _thread_locals
 from freppledb.common.report import GridReport, matchesModelName
-from freppledb import VERSION
+from freppledb import VERSION, initDjango
 from freppledb.common.dataload import parseCSVdata, parseExcelWorksheet
 from freppledb.common.models import User
 from freppledb.common.report import EXCLUDE_FROM_BULK_OPERATIONS
@@ -46,6 +48,44 @@ from freppledb.common.report import EXCLUDE_FROM_BULK_OPERATIONS
 logger = logging.getLogger(__name__)
 
 
+class LogCollector(logging.Handler):
+    """
+    Logging handler that keeps the messages of a worker process in memory.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+
+def loadFile(database, user, delimiter, model, ifile):
+    """
+    Loads a data file in a worker process of a parallel import.
+
+    The log messages are returned to the parent process, which writes
+    them in the log file of the task.
+    """
+    cmd = Command()
+    cmd.database = database
+    cmd.user = User.objects.all().using(database).get(pk=user) if user else None
+    cmd.delimiter = delimiter
+    translation.activate(settings.LANGUAGE_CODE)
+    collector = LogCollector()
+    handlers = logger.handlers
+    propagate = logger.propagate
+    logger.handlers = [collector]
+    logger.propagate = False
+    try:
+        errors = cmd.loadFile(model, ifile)
+    finally:
+        logger.handlers = handlers
+        logger.propagate = propagate
+    return errors, collector.records
+
+
 class Command(BaseCommand):
 
     help = """
@@ -68,6 +108,12 @@ class Command(BaseCommand):
             type=int,
             help="Task identifier (generated automatically if not provided)",
         )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="Number of data files loaded in parallel (default: 1)",
+        )
 
     def get_version(self):
         return VERSION
@@ -206,43 +252,19 @@ class Command(BaseCommand):
                 # Sort the list of models, based on dependencies between models
                 models = GridReport.sort_models(models)
 
-                i = 0
                 cnt = len(models)
-                for ifile, model, contenttype_id, dependencies in models:
-                    task.status = str(int(10 + i / cnt * 80)) + "%"
-                    task.message = "Processing data file %s" % ifile
-                    task.save(using=self.database)
-                    i += 1
-                    filetoparse = os.path.join(
-                        os.path.abspath(
-                            settings.DATABASES[self.database]["FILEUPLOADFOLDER"]
-                        ),
-                        ifile,
-                    )
-                    if ifile.lower().endswith(".xlsx"):
-                        logger.info(
-                            "%s Started processing data in Excel file: %s"
-                            % (datetime.now().replace(microsecond=0), ifile)
-                        )
-                        returnederrors = self.loadExcelfile(model, filetoparse)
-                        errors[0] += returnederrors[0]
-                        errors[1] += returnederrors[1]
-                        logger.info(
-                            "%s Finished processing data in file: %s"
-                            % (datetime.now().replace(microsecond=0), ifile)
-                        )
-                    else:
-                        logger.info(
-                            "%s Started processing data in CSV file: %s"
-                            % (datetime.now().replace(microsecond=0), ifile)
-                        )
-                        returnederrors = self.loadCSVfile(model, filetoparse)
+                if options["processes"] > 1 and cnt > 1:
+                    self.loadParallel(models, task, errors, options["processes"])
+                else:
+                    i = 0
+                    for ifile, model, contenttype_id, dependencies in models:
+                        task.status = str(int(10 + i / cnt * 80)) + "%"
+                        task.message = "Processing data file %s" % ifile
+                        task.save(using=self.database)
+                        i += 1
+                        returnederrors = self.loadFile(model, ifile)
                         errors[0] += returnederrors[0]
                         errors[1] += returnederrors[1]
-                        logger.info(
-                            "%s Finished processing data in CSV file: %s"
-                            % (datetime.now().replace(microsecond=0), ifile)
-                        )
             else:
                 errors[0] += 1
                 cnt = 0
@@ -296,6 +318,98 @@ class Command(BaseCommand):
                 "%s End of importfromfolder\n" % datetime.now().replace(microsecond=0)
             )
 
+    def loadParallel(self, models, task, errors, processes):
+        """
+        Loads the data files in a pool of worker processes.
+
+        A file is submitted as soon as all files it depends on are loaded.
+        Files of unrelated models are thus loaded at the same time, while
+        files of the same model are loaded in alphabetical order.
+        """
+        # Build the dependency graph, using the same rules as sort_models
+        waitfor = {
+            m[0]: set(
+                n[0]
+                for n in models
+                if GridReport.depends_on(m, n) or (m[1] == n[1] and m[0] > n[0])
+            )
+            for m in models
+        }
+        pending = list(models)
+        running = set()
+        done = 0
+        cnt = len(models)
+        results = queue.Queue()
+        userid = self.user.pk if self.user else None
+
+        # The child processes can't share the database connections
+        connections.close_all()
+        with Pool(
+            processes=min(processes, cnt),
+            initializer=initDjango,
+            initargs=(self.database,),
+        ) as pool:
+            while pending or running:
+                # Submit all files that are ready to be loaded
+                for m in [m for m in pending if not waitfor[m[0]]]:
+                    pending.remove(m)
+                    running.add(m[0])
+                    pool.apply_async(
+                        loadFile,
+                        (self.database, userid, self.delimiter, m[1], m[0]),
+                        callback=lambda r, f=m[0]: results.put((f, r, None)),
+                        error_callback=lambda e, f=m[0]: results.put((f, None, e)),
+                    )
+                task.status = str(int(10 + done / cnt * 80)) + "%"
+                task.message = "Processing data files %s" % ", ".join(sorted(running))
+                task.save(using=self.database)
+
+                # Wait for the next file to finish
+                ifile, result, exc = results.get()
+                running.discard(ifile)
+                done += 1
+                for w in waitfor.values():
+                    w.discard(ifile)
+                if exc:
+                    logger.error(
+                        "%s Error: Failed processing data file %s: %s"
+                        % (datetime.now().replace(microsecond=0), ifile, exc)
+                    )
+                    errors[0] += 1
+                else:
+                    returnederrors, records = result
+                    for level, msg in records:
+                        logger.log(level, msg)
+                    errors[0] += returnederrors[0]
+                    errors[1] += returnederrors[1]
+
+    def loadFile(self, model, ifile):
+        filetoparse = os.path.join(
+            os.path.abspath(settings.DATABASES[self.database]["FILEUPLOADFOLDER"]),
+            ifile,
+        )
+        if ifile.lower().endswith(".xlsx"):
+            logger.info(
+                "%s Started processing data in Excel file: %s"
+                % (datetime.now().replace(microsecond=0), ifile)
+            )
+            returnederrors = self.loadExcelfile(model, filetoparse)
+            logger.info(
+                "%s Finished processing data in file: %s"
+                % (datetime.now().replace(microsecond=0), ifile)
+            )
+        else:
+            logger.info(
+                "%s Started processing data in CSV file: %s"
+                % (datetime.now().replace(microsecond=0), ifile)
+            )
+            returnederrors = self.loadCSVfile(model, filetoparse)
+            logger.info(
+                "%s Finished processing data in CSV file: %s"
+                % (datetime.now().replace(microsecond=0), ifile)
+            )
+        return returnederrors
+
     def loadCSVfile(self, model, file):
         errorcount = 0
         warningcount = 0
@@ -30,6 +30,7 @@ from django.template import Template, RequestContext
 from freppledb.common.commands import PlanTaskRegistry
 from freppledb.common.models import User
 from freppledb.execute.models import Task
+from freppledb.execute.service import getServicePort, sendRequest
 from freppledb import VERSION
 
 
@@ -84,6 +85,27 @@ class Command(BaseCommand):
             default=False,
             help="Run the planning engine in the background (default = False)",
         )
+        parser.add_argument(
+            "--service",
+            dest="service",
+            action="store_true",
+            default=False,
+            help="Keep the planning engine running in the background after generating the plan, to process later replan requests on the port in the parameter plan.servicePort (default = False)",
+        )
+        parser.add_argument(
+            "--reload",
+            dest="reload",
+            action="store_true",
+            default=False,
+            help="Reload all data when the plan is generated by a running planning service (default = False)",
+        )
+        parser.add_argument(
+            "--stopservice",
+            dest="stopservice",
+            action="store_true",
+            default=False,
+            help="Stop the planning service (default = False)",
+        )
 
     def handle(self, **options):
         # Pick up the options
@@ -103,6 +125,16 @@ class Command(BaseCommand):
         else:
             user = None
 
+        if options["stopservice"]:
+            port = getServicePort(database)
+            if not port:
+                raise CommandError("Parameter plan.servicePort isn't set")
+            try:
+                sendRequest(port, {"command": "stop"})
+            except ConnectionRefusedError:
+                raise CommandError("Planning service isn't running")
+            return
+
         timestamp = now.strftime("%Y%m%d%H%M%S")
         if database == DEFAULT_DB_ALIAS:
             logfile = "frepple-%s.log" % timestamp
@@ -181,11 +213,45 @@ class Command(BaseCommand):
                 )
             if options["background"]:
                 task.arguments += " --background"
+            if options["service"]:
+                task.arguments += " --service"
+            if options["reload"]:
+                task.arguments += " --reload"
 
             # Log task
             # Different from the other tasks the frepple engine will write the processid
             task.save(using=database)
 
+            # Pass the request to a running planning service
+            port = getServicePort(database)
+            if options["service"]:
+                if not port:
+                    raise CommandError("Parameter plan.servicePort isn't set")
+                os.environ["FREPPLE_SERVICE"] = str(port)
+                options["background"] = True
+            else:
+                os.environ.pop("FREPPLE_SERVICE", None)
+                if port:
+                    try:
+                        reply = sendRequest(
+                            port,
+                            {
+                                "command": "reload" if options["reload"] else "replan",
+                                "constraint": constraint,
+                                "plantype": plantype,
+                                "env": options["env"],
+                                "task": task.id,
+                                "logfile": logfile,
+                            },
+                            wait=not options["background"],
+                        )
+                        if reply and reply["status"] != "Done":
+                            raise Exception("Planning service %s" % reply["status"])
+                        return
+                    except ConnectionRefusedError:
+                        # No service running: start a new planning engine
+                        pass
+
             # Locate commands.py
             import freppledb.common.commands
 
@@ -269,7 +335,9 @@ class Command(BaseCommand):
                 task = Task.objects.all().using(database).get(pk=task.id)
                 task.processid = None
                 task.status = "Done"
-                task.finished = datetime.now()
+                if not task.finished:
+                    # Normally already set by the planning engine
+                    task.finished = datetime.now()
                 task.save(using=database)
 
         except Exception as e:
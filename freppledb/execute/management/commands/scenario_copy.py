@@ -15,18 +15,23 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from collections import deque
 import os
+import psycopg2
+import shutil
 import subprocess
+import tempfile
 from datetime import datetime
 
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
-from django.db import DEFAULT_DB_ALIAS
+from django.db import connections, DEFAULT_DB_ALIAS
 from django.utils.translation import gettext_lazy as _
 from django.template import Template, RequestContext
 
 from freppledb.execute.models import Task
 from freppledb.common.models import User, Scenario
+from freppledb.input.commands import loadDeltaScenario
 from freppledb import VERSION
 
 
@@ -35,7 +40,18 @@ class Command(BaseCommand):
   This command copies the contents of a database into another.
   The original data in the destination database are lost.
 
-  The pg_dump and psql commands need to be in the path, otherwise
+  When both databases are on the same server and nobody is connected to
+  them, the destination database is recreated with the source database
+  as template. Otherwise the data is copied with a parallel pg_dump and
+  pg_restore.
+
+  With the --delta option the destination becomes a delta scenario: the
+  input and output tables are left empty, and the planning engine reads
+  the data of the source scenario for all records that aren't changed in
+  the destination. The foreign keys between these tables are removed in
+  the destination.
+
+  The pg_dump and pg_restore commands need to be in the path, otherwise
   this command will fail.
   """
 
@@ -55,6 +71,12 @@ class Command(BaseCommand):
         parser.add_argument(
             "--description", help="Description of the destination scenario"
         )
+        parser.add_argument(
+            "--delta",
+            action="store_true",
+            default=False,
+            help="Only store the changes against the source scenario in the destination",
+        )
         parser.add_argument(
             "--task",
             type=int,
@@ -78,6 +100,7 @@ class Command(BaseCommand):
 
         # Pick up options
         force = options["force"]
+        delta = options["delta"]
         test = "FREPPLE_TEST" in os.environ
         if options["user"]:
             try:
@@ -130,6 +153,8 @@ class Command(BaseCommand):
                 )
             if force:
                 task.arguments += " --force"
+            if delta:
+                task.arguments += " --delta"
             task.save(using=source)
             try:
                 destinationscenario = Scenario.objects.using(DEFAULT_DB_ALIAS).get(
@@ -145,68 +170,37 @@ class Command(BaseCommand):
                 raise CommandError("Source scenario is not in use")
             if destinationscenario.status != "Free" and not force:
                 raise CommandError("Destination scenario is not free")
+            children = [
+                sc.name
+                for sc in Scenario.objects.using(DEFAULT_DB_ALIAS).filter(
+                    parent=destination, status="In use"
+                )
+            ]
+            if children and not force:
+                raise CommandError(
+                    "Destination scenario is the parent of delta scenario %s"
+                    % ", ".join(children)
+                )
+            if destination in Scenario.getParents(source):
+                raise CommandError("Can't copy a scenario into its parent scenario")
 
             # Logging message - always logging in the default database
             destinationscenario.status = "Busy"
             destinationscenario.save(using=DEFAULT_DB_ALIAS)
 
             # Copying the data
-            # Commenting the next line is a little more secure, but requires you to create a .pgpass file.
-            if settings.DATABASES[source]["PASSWORD"]:
-                os.environ["PGPASSWORD"] = settings.DATABASES[source]["PASSWORD"]
-            if os.name == "nt":
-                # On windows restoring with pg_restore over a pipe is broken :-(
-                cmd = "pg_dump -c -Fp %s%s%s%s | psql %s%s%s%s"
-            else:
-                cmd = "pg_dump -Fc %s%s%s%s | pg_restore -n public -Fc -c --if-exists %s%s%s -d %s"
-            commandline = cmd % (
-                settings.DATABASES[source]["USER"]
-                and ("-U %s " % settings.DATABASES[source]["USER"])
-                or "",
-                settings.DATABASES[source]["HOST"]
-                and ("-h %s " % settings.DATABASES[source]["HOST"])
-                or "",
-                settings.DATABASES[source]["PORT"]
-                and ("-p %s " % settings.DATABASES[source]["PORT"])
-                or "",
-                test
-                and settings.DATABASES[source]["TEST"]["NAME"]
-                or settings.DATABASES[source]["NAME"],
-                settings.DATABASES[destination]["USER"]
-                and ("-U %s " % settings.DATABASES[destination]["USER"])
-                or "",
-                settings.DATABASES[destination]["HOST"]
-                and ("-h %s " % settings.DATABASES[destination]["HOST"])
-                or "",
-                settings.DATABASES[destination]["PORT"]
-                and ("-p %s " % settings.DATABASES[destination]["PORT"])
-                or "",
-                test
-                and settings.DATABASES[destination]["TEST"]["NAME"]
-                or settings.DATABASES[destination]["NAME"],
-            )
-            with subprocess.Popen(
-                commandline,
-                shell=True,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.STDOUT,
-            ) as p:
-                try:
-                    task.processid = p.pid
-                    task.save(using=source)
-                    p.wait()
-                except:
-                    p.kill()
-                    p.wait()
-                    # Consider the destination database free again
-                    destinationscenario.status = "Free"
-                    destinationscenario.lastrefresh = datetime.today()
-                    destinationscenario.save(using=DEFAULT_DB_ALIAS)
-                    raise Exception("Database copy failed")
-
-            # Update the scenario table
+            exclude = loadDeltaScenario.getTables() if delta else []
+            if not self.copyWithTemplate(source, destination, task, test, exclude):
+                self.copyWithDump(source, destination, task, test, exclude)
+            if delta:
+                # The plan of the delta scenario refers to parent records
+                loadDeltaScenario.dropForeignKeys(destination)
+
+            # Update the scenario table.
+            # A copy of a delta scenario is a delta scenario with the same parent.
             destinationscenario.status = "In use"
             destinationscenario.lastrefresh = datetime.today()
+            destinationscenario.parent = source if delta else sourcescenario.parent
             if options["description"]:
                 destinationscenario.description = options["description"]
             destinationscenario.save(using=DEFAULT_DB_ALIAS)
@@ -256,6 +250,223 @@ class Command(BaseCommand):
                 task.save(using=source)
             settings.DEBUG = tmp_debug
 
+    @staticmethod
+    def getDatabaseName(database, test):
+        return (
+            test
+            and settings.DATABASES[database]["TEST"]["NAME"]
+            or settings.DATABASES[database]["NAME"]
+        )
+
+    @staticmethod
+    def getCommandArguments(database):
+        args = []
+        if settings.DATABASES[database]["USER"]:
+            args += ["-U", settings.DATABASES[database]["USER"]]
+        if settings.DATABASES[database]["HOST"]:
+            args += ["-h", settings.DATABASES[database]["HOST"]]
+        if settings.DATABASES[database]["PORT"]:
+            args += ["-p", str(settings.DATABASES[database]["PORT"])]
+        return args
+
+    @staticmethod
+    def quote(name):
+        return '"%s"' % name.replace('"', '""')
+
+    def copyWithTemplate(self, source, destination, task, test, exclude=()):
+        """
+        Recreates the destination database with the source database as
+        template. This is only possible when both databases are on the same
+        server and no other sessions are connected to them.
+        The tables passed in the exclude argument are emptied afterwards.
+        Returns False when the database isn't copied this way.
+        """
+        src = settings.DATABASES[source]
+        dest = settings.DATABASES[destination]
+        if (src["HOST"], src["PORT"]) != (dest["HOST"], dest["PORT"]):
+            return False
+        if (
+            connections[source].in_atomic_block
+            or connections[destination].in_atomic_block
+        ):
+            return False
+        srcname = self.getDatabaseName(source, test)
+        destname = self.getDatabaseName(destination, test)
+
+        task.message = "Copying the database"
+        task.save(using=source)
+        connections[source].close()
+        connections[destination].close()
+        try:
+            conn = psycopg2.connect(
+                dbname="postgres",
+                user=dest["USER"] or None,
+                password=dest["PASSWORD"] or None,
+                host=dest["HOST"] or None,
+                port=dest["PORT"] or None,
+            )
+        except psycopg2.Error:
+            return False
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "select rolsuper or rolcreatedb from pg_roles where rolname = current_user"
+                )
+                if not cursor.fetchone()[0]:
+                    return False
+                cursor.execute(
+                    """
+                    select count(*) from pg_stat_activity
+                    where datname in (%s, %s) and pid <> pg_backend_pid()
+                    """,
+                    (srcname, destname),
+                )
+                if cursor.fetchone()[0]:
+                    return False
+                try:
+                    cursor.execute("drop database if exists %s" % self.quote(destname))
+                except psycopg2.Error:
+                    return False
+                owner = " owner %s" % self.quote(dest["USER"]) if dest["USER"] else ""
+                try:
+                    cursor.execute(
+                        "create database %s template %s%s"
+                        % (self.quote(destname), self.quote(srcname), owner)
+                    )
+                except psycopg2.Error:
+                    # Somebody connected to the source database in the meantime.
+                    # We need an empty destination database to restore into.
+                    try:
+                        cursor.execute(
+                            "create database %s%s" % (self.quote(destname), owner)
+                        )
+                    except psycopg2.Error as e:
+                        raise CommandError(
+                            "Database %s was dropped and couldn't be recreated: %s"
+                            % (destname, e)
+                        )
+                    return False
+        finally:
+            conn.close()
+        if exclude:
+            with connections[destination].cursor() as cursor:
+                cursor.execute(
+                    "truncate table %s cascade"
+                    % ", ".join(self.quote(t) for t in exclude)
+                )
+        return True
+
+    def copyWithDump(self, source, destination, task, test, exclude=()):
+        """
+        Copies the database with a parallel pg_dump in directory format,
+        followed by a parallel pg_restore.
+        The data of the tables passed in the exclude argument isn't copied.
+        """
+        jobs = str(getattr(settings, "SCENARIO_COPY_JOBS", 4))
+        with connections[source].cursor() as cursor:
+            cursor.execute("select count(*) from pg_tables where schemaname = 'public'")
+            tables = cursor.fetchone()[0] - len(exclude)
+        tmpdir = tempfile.mkdtemp(prefix="frepple_copy_")
+        try:
+            dumpdir = os.path.join(tmpdir, "dump")
+            task.message = "Dumping the source scenario"
+            returncode, errors = self.runCommand(
+                ["pg_dump", "-v", "-Fd", "-j", jobs, "-f", dumpdir]
+                + ["--exclude-table-data=%s" % self.quote(t) for t in exclude]
+                + self.getCommandArguments(source)
+                + [self.getDatabaseName(source, test)],
+                source,
+                task,
+                ("dumping contents of table",),
+                tables,
+                0,
+                50,
+            )
+            if returncode:
+                raise CommandError("Database dump failed: %s" % errors)
+
+            # The restore reports progress on the items of the table of contents
+            toc = subprocess.run(
+                ["pg_restore", "-l", dumpdir],
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+                check=True,
+            ).stdout
+            items = sum(1 for i in toc.splitlines() if i and not i.startswith(";"))
+            task.message = "Restoring into the destination scenario"
+            returncode, errors = self.runCommand(
+                [
+                    "pg_restore",
+                    "-v",
+                    "-n",
+                    "public",
+                    "-Fd",
+                    "-c",
+                    "--if-exists",
+                    "-j",
+                    jobs,
+                ]
+                + self.getCommandArguments(destination)
+                + ["-d", self.getDatabaseName(destination, test), dumpdir],
+                destination,
+                task,
+                ("processing item", "finished item"),
+                items,
+                50,
+                100,
+            )
+            if returncode:
+                raise CommandError("Database restore failed: %s" % errors)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def runCommand(self, cmd, database, task, patterns, total, start, end):
+        """
+        Runs a PostgreSQL client command and updates the progress of the task
+        from its verbose output. The progress moves from start to end percent
+        as the output lines matching the patterns reach the total.
+        Returns the exit code and the last output lines.
+        """
+        env = os.environ.copy()
+        # Commenting the next lines is a little more secure, but requires you to create a .pgpass file.
+        if settings.DATABASES[database]["PASSWORD"]:
+            env["PGPASSWORD"] = settings.DATABASES[database]["PASSWORD"]
+        # We parse the output of the command
+        env.pop("LC_ALL", None)
+        env["LC_MESSAGES"] = "C"
+        count = 0
+        progress = start
+        output = deque(maxlen=5)
+        with subprocess.Popen(
+            cmd,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        ) as p:
+            try:
+                task.processid = p.pid
+                task.save(using=task._state.db)
+                for line in p.stderr:
+                    if any(i in line for i in patterns):
+                        count += 1
+                        newprogress = start + (end - start) * min(count, total) // max(
+                            total, 1
+                        )
+                        if newprogress > progress:
+                            progress = newprogress
+                            task.status = "%d%%" % progress
+                            task.save(using=task._state.db)
+                    else:
+                        output.append(line.strip())
+                p.wait()
+            except:
+                p.kill()
+                p.wait()
+                raise
+        return p.returncode, " ".join(output)
+
     # accordion template
     title = _("scenario management")
     index = 1500
@@ -394,7 +605,7 @@ class Command(BaseCommand):
                {% endif %}
             </td>
             {% with mystatus=j.status|lower %}
-            <td style="padding:5px 10px 5px 10px; text-align: center">{% trans mystatus|capfirst %}</td>
+            <td style="padding:5px 10px 5px 10px; text-align: center">{% trans mystatus|capfirst %}{% if j.parent and j.status == 'In use' %}<br>{% trans 'parent'|capfirst %}: {{ j.parent|capfirst }}{% endif %}</td>
             {% endwith %}
             <td style="padding:5px 10px 5px 10px">
               <input class="scenariolabel" type="text" size="20" data-target="{{ j.name }}"
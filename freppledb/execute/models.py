@@ -14,7 +14,7 @@
 # You should have received a copy of the GNU Affero General Public
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
-from django.db import models
+from django.db import models, DEFAULT_DB_ALIAS
 from django.utils.translation import gettext_lazy as _
 
 from freppledb.common.models import User
@@ -42,7 +42,7 @@ class Task(models.Model):
     submitted = models.DateTimeField(_("submitted"), editable=False)
     started = models.DateTimeField(_("started"), blank=True, null=True, editable=False)
     finished = models.DateTimeField(
-        _("submitted"), blank=True, null=True, editable=False
+        _("submitted"), blank=True, null=True, editable=False, db_index=True
     )
     arguments = models.TextField(
         _("arguments"), max_length=200, null=True, editable=False
@@ -69,6 +69,19 @@ class Task(models.Model):
         verbose_name_plural = _("tasks")
         verbose_name = _("task")
 
+    @staticmethod
+    def lastFinished(database=DEFAULT_DB_ALIAS):
+        """
+        Returns the end time of the most recently finished task.
+        Data cached from the plan or from the input data is stale when this
+        value changes.
+        """
+        return (
+            Task.objects.all()
+            .using(database)
+            .aggregate(last=models.Max("finished"))["last"]
+        )
+
     @staticmethod
     def submitTask():
         # Add record to the database
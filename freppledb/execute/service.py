@@ -0,0 +1,247 @@
+#
+# Copyright (C) 2019 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from datetime import datetime
+import json
+import logging
+import os
+import socket
+import socketserver
+from threading import Thread
+
+from django.conf import settings
+from django.db import connections, close_old_connections, DEFAULT_DB_ALIAS
+
+from freppledb.common.commands import PlanTaskRegistry
+from freppledb.common.dashboard import Dashboard
+from freppledb.common.models import Parameter
+from freppledb.execute.models import Task
+from freppledb.input.commands import LoadTask
+
+logger = logging.getLogger(__name__)
+
+
+def getServicePort(database=DEFAULT_DB_ALIAS):
+    """
+    Returns the port of the planning service of a scenario, or None when
+    the service isn't configured.
+    """
+    port = Parameter.getValue("plan.servicePort", database, None)
+    return int(port) if port else None
+
+
+def sendRequest(port, request, wait=True):
+    """
+    Sends a request to the planning service listening on a local port.
+    Raises a ConnectionRefusedError when the service isn't running.
+    """
+    with socket.create_connection(("localhost", port)) as conn:
+        conn.sendall(("%s\n" % json.dumps(request)).encode("utf-8"))
+        if not wait:
+            return None
+        with conn.makefile("rb") as f:
+            reply = f.readline()
+    if not reply:
+        raise Exception("No reply from the planning service")
+    return json.loads(reply.decode("utf-8"))
+
+
+class PlanService:
+    """
+    Planning service that keeps the model in memory after a plan is generated.
+
+    The service listens on a local port. A request is a single line with a
+    JSON object, and the command field of the request is one of:
+      - replan: reads the changes since the previous load and generates
+        a new plan
+      - reload: erases the model, reads all data and generates a new plan
+      - status: returns the timestamp of the last load
+      - stop: stops the service
+    A replan or reload request has the following optional fields:
+      - constraint, plantype, env: same as the arguments of runplan
+      - task: identifier of the task to report progress on
+      - logfile: name of the log file for the run
+    The reply is a single line with a JSON object.
+
+    Changes are detected with the lastmodified field of the input data.
+    Records deleted from the database remain in the model until a reload.
+    """
+
+    def __init__(self, database=DEFAULT_DB_ALIAS, port=None, loaded=None):
+        self.database = database
+        self.port = int(port)
+        self.loaded = loaded
+        self.stopped = False
+        self.prerenderer = None
+
+    def serve(self):
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline().decode("utf-8"))
+                    reply = service.process(request)
+                except Exception as e:
+                    logger.error("Error in planning service: %s" % e)
+                    reply = {"status": "Failed", "message": str(e)}
+                try:
+                    self.wfile.write(("%s\n" % json.dumps(reply)).encode("utf-8"))
+                except OSError:
+                    # The client didn't wait for the reply
+                    pass
+
+        with socketserver.TCPServer(("localhost", self.port), Handler) as server:
+            logger.info(
+                "Planning service for database '%s' listening on port %s"
+                % (self.database, self.port)
+            )
+            while not self.stopped:
+                server.handle_request()
+        logger.info("Planning service stopped")
+
+    def process(self, request):
+        command = request.get("command", None)
+        if command == "status":
+            return {"status": "Done", "loaded": str(self.loaded)}
+        elif command == "stop":
+            self.stopped = True
+            return {"status": "Done"}
+        elif command in ("replan", "reload"):
+            return {
+                "status": self.replan(
+                    full=(command == "reload"),
+                    constraint=request.get("constraint", 15),
+                    plantype=request.get("plantype", 1),
+                    env=request.get("env", None),
+                    task=request.get("task", None),
+                    logfile=request.get("logfile", None),
+                )
+            }
+        else:
+            raise Exception("Invalid command '%s'" % command)
+
+    @staticmethod
+    def loadTasks():
+        for t in PlanTaskRegistry.reg:
+            if issubclass(t, LoadTask):
+                yield t
+
+    def hasStructuralChanges(self):
+        """
+        Checks for changes in the data that can't be reloaded incrementally.
+        """
+        tables = set()
+        for t in self.loadTasks():
+            if t.incremental is False:
+                tables.update(t.tables)
+        with connections[self.database].cursor() as cursor:
+            for table in sorted(tables):
+                cursor.execute(
+                    "select exists (select 1 from %s where lastmodified >= %%s)"
+                    % table,
+                    (self.loaded,),
+                )
+                if cursor.fetchone()[0]:
+                    logger.info("Changes in table %s require a complete reload" % table)
+                    return True
+        return False
+
+    def replan(
+        self, full=False, constraint=15, plantype=1, env=None, task=None, logfile=None
+    ):
+        import frepple
+
+        if self.prerenderer:
+            # Wait for the widgets of the previous plan
+            self.prerenderer.join()
+        close_old_connections()
+
+        # Same environment as a new planning engine process
+        for label in PlanTaskRegistry.getLabels():
+            os.environ.pop(label[0], None)
+        if env:
+            for i in env.split(","):
+                j = i.split("=")
+                os.environ[j[0]] = "1" if len(j) == 1 else j[1]
+        os.environ["FREPPLE_PLANTYPE"] = str(plantype)
+        os.environ["FREPPLE_CONSTRAINT"] = str(constraint)
+        if task:
+            os.environ["FREPPLE_TASKID"] = str(task)
+        else:
+            os.environ.pop("FREPPLE_TASKID", None)
+        if logfile:
+            frepple.settings.logfile = os.path.join(settings.FREPPLE_LOGDIR, logfile)
+
+        if not full and (not self.loaded or self.hasStructuralChanges()):
+            full = True
+        starttime = datetime.now()
+        newstatus = "Done"
+        try:
+            if full:
+                logger.info("Reloading the complete model")
+                frepple.erase(True)
+                PlanTaskRegistry.run(database=self.database)
+            else:
+                logger.info("Loading the changes since %s" % self.loaded)
+                frepple.erase(False)
+                filters = {}
+                for t in self.loadTasks():
+                    if t.incremental:
+                        filters[t] = t.filter
+                        t.filter = "lastmodified >= '%s'" % self.loaded
+                        if filters[t]:
+                            t.filter = "(%s) and %s" % (filters[t], t.filter)
+                try:
+                    PlanTaskRegistry.run(database=self.database, loadsince=self.loaded)
+                finally:
+                    for t, f in filters.items():
+                        t.filter = f
+            self.loaded = starttime
+        except SystemExit:
+            # Task was cancelled before it started
+            newstatus = "Cancelled"
+        except Exception as e:
+            logger.error("Error during planning: %s" % e)
+            newstatus = "Failed"
+            # The model may be incomplete: load everything on the next request
+            self.loaded = None
+        finally:
+            if task:
+                try:
+                    t = Task.objects.all().using(self.database).get(pk=task)
+                    t.processid = None
+                    t.status = newstatus
+                    t.finished = datetime.now()
+                    t.save(
+                        update_fields=["processid", "status", "finished"],
+                        using=self.database,
+                    )
+                except Task.DoesNotExist:
+                    pass
+        if newstatus == "Done":
+            self.prerenderer = Thread(target=self.prerender)
+            self.prerenderer.start()
+        return newstatus
+
+    def prerender(self):
+        # Prerender the dashboard widgets while the service waits for
+        # the next request
+        try:
+            Dashboard.prerenderPlan(self.database)
+        finally:
+            connections[self.database].close()
@@ -17,6 +17,7 @@
 
 import base64
 import json
+from logging import ERROR
 import os
 from time import sleep
 import unittest
@@ -30,6 +31,7 @@ from django.test import TransactionTestCase
 import freppledb.output as output
 import freppledb.input as input
 import freppledb.common as common
+from freppledb.common.dataload import parseCSVdata
 from freppledb.common.models import Parameter, User
 
 
@@ -154,6 +156,92 @@ class execute_multidb(TransactionTestCase):
         self.assertNotEqual(count2, 0)
         self.assertNotEqual(count2, count1new)
 
+    def test_delta_scenario(self):
+        # Find out which databases to use
+        db1 = DEFAULT_DB_ALIAS
+        db2 = None
+        for i in settings.DATABASES:
+            if i != DEFAULT_DB_ALIAS:
+                db2 = i
+                break
+        if not db2:
+            # Only a single database is configured and we skip this test
+            return
+
+        # Create a delta scenario: the input data isn't copied
+        transaction.commit(using=db1)
+        transaction.commit(using=db2)
+        management.call_command("scenario_copy", db1, db2, delta=True, force=True)
+        self.assertEqual(
+            common.models.Scenario.objects.using(DEFAULT_DB_ALIAS).get(name=db2).parent,
+            db1,
+        )
+        self.assertEqual(common.models.Scenario.getParents(db2), [db1])
+        self.assertEqual(input.models.Demand.objects.all().using(db2).count(), 0)
+        self.assertGreater(common.models.Parameter.objects.all().using(db2).count(), 0)
+
+        # A data file loaded in the delta scenario refers to parent records
+        dmd = input.models.Demand.objects.using(db1).first()
+        errors = [
+            e
+            for e in parseCSVdata(
+                input.models.Demand,
+                iter(
+                    [
+                        ["name", "item", "location", "customer", "due", "quantity"],
+                        [
+                            "delta demand",
+                            dmd.item_id,
+                            dmd.location_id,
+                            dmd.customer_id,
+                            dmd.due.strftime("%Y-%m-%d %H:%M:%S"),
+                            "10",
+                        ],
+                    ]
+                ),
+                database=db2,
+            )
+            if e[0] == ERROR
+        ]
+        self.assertEqual(errors, [])
+        self.assertEqual(input.models.Demand.objects.all().using(db2).count(), 1)
+
+        # The plan of the delta scenario uses the data of the parent
+        management.call_command(
+            "runplan", plantype=1, constraint=15, env="supply", database=db2
+        )
+        self.assertGreater(
+            input.models.OperationPlan.objects.all().using(db2).count(), 0
+        )
+        self.assertGreater(
+            input.models.OperationPlanMaterial.objects.all().using(db2).count(), 0
+        )
+
+        # An order approved in the delta scenario is kept by the next plan
+        po = (
+            input.models.PurchaseOrder.objects.all()
+            .using(db2)
+            .filter(status="proposed")
+            .order_by("reference")
+            .first()
+        )
+        self.assertIsNotNone(po)
+        po.status = "approved"
+        po.quantity += 1
+        po.save(using=db2)
+        management.call_command(
+            "runplan", plantype=1, constraint=15, env="supply", database=db2
+        )
+        po_new = input.models.PurchaseOrder.objects.using(db2).get(
+            reference=po.reference
+        )
+        self.assertEqual(po_new.status, "approved")
+        self.assertEqual(po_new.quantity, po.quantity)
+
+        # A parent scenario can't be overwritten
+        with self.assertRaises(management.CommandError):
+            management.call_command("scenario_copy", db2, db1)
+
 
 class FixtureTest(TransactionTestCase):
     def test_fixture_demo(self):
@@ -380,8 +380,15 @@ def wrapTask(request, action):
             if not request.user.has_perm("auth.release_scenario"):
                 raise Exception("Missing execution privileges")
             sc = Scenario.objects.using(DEFAULT_DB_ALIAS).get(name=request.database)
+            if (
+                Scenario.objects.using(DEFAULT_DB_ALIAS)
+                .filter(parent=sc.name, status="In use")
+                .exists()
+            ):
+                raise Exception("Scenario is the parent of a delta scenario")
             if sc.status != "Free" and sc.name != DEFAULT_DB_ALIAS:
                 sc.status = "Free"
+                sc.parent = None
                 sc.lastrefresh = now
                 sc.save(using=DEFAULT_DB_ALIAS)
         elif "update" in args:
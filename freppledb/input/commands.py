@@ -21,10 +21,11 @@ from time import time
 from datetime import datetime
 from dateutil.parser import parse
 
+from django.apps import apps
 from django.db import connections, DEFAULT_DB_ALIAS
 
 from freppledb.boot import getAttributes
-from freppledb.common.models import Parameter
+from freppledb.common.models import Parameter, Scenario
 from freppledb.common.commands import PlanTaskRegistry, PlanTask
 from freppledb.input.models import Resource, Item, Location
 
@@ -51,15 +52,111 @@ class LoadTask(PlanTask):
     Specific are:
     - low weight by default, ie fast execution assumed
     - filter attribute to load only a subset of the data
+    - incremental attribute to define how the planning service reloads data
     - subclass is used by the odoo connector to recognize data loading tasks
+    - the parent scenarios of a delta scenario are read before it
+    - the master data is loaded in 3 steps, each running a number of threads
+      in parallel: a task only refers to entities loaded in an earlier step
+      or by an earlier task on the same thread
     """
 
-    @staticmethod
-    def getWeight(database=DEFAULT_DB_ALIAS, **kwargs):
+    @classmethod
+    def getWeight(cls, database=DEFAULT_DB_ALIAS, loadsince=None, **kwargs):
+        if loadsince and cls.incremental is False:
+            return -1
         return 0.1
 
     filter = None
 
+    # Behavior when the planning service reloads the changes since a
+    # previous load, passed as the loadsince argument:
+    #  - None: all records are read again
+    #  - True: only records changed since the previous load are read
+    #  - False: the task is skipped, and a change in any of the tables
+    #    listed in the tables attribute triggers a complete reload instead
+    incremental = None
+    tables = ()
+
+    # Behavior in a delta scenario, which only stores the records that differ
+    # from its parent scenarios, passed as the parents argument: the parent
+    # scenarios are read first, and the records of the delta scenario replace
+    # the records with the same key. The run method gets a delta argument
+    # when it reads a scenario on top of its parent.
+    # Tasks that aren't incremental read their tables from the closest
+    # scenario that has records in them.
+
+    @classmethod
+    def execute(cls, database=DEFAULT_DB_ALIAS, parents=None, **kwargs):
+        if not parents:
+            cls.run(database=database, **kwargs)
+        elif cls.incremental is False:
+            cls.run(database=cls.closestScenario(database, parents), **kwargs)
+        else:
+            for db in reversed(parents):
+                cls.run(database=db, delta=(db != parents[-1]), **kwargs)
+            cls.run(database=database, delta=True, **kwargs)
+
+    @classmethod
+    def closestScenario(cls, database, parents):
+        """
+        Returns the first scenario that has records in the tables of the task.
+        """
+        inputtables = {
+            m._meta.db_table for m in apps.get_app_config("input").get_models()
+        }
+        tables = [t for t in cls.tables if t in inputtables]
+        for db in [database] + parents:
+            with connections[db].cursor() as cursor:
+                for t in tables:
+                    cursor.execute(
+                        "select exists (select 1 from %s)"
+                        % connections[db].ops.quote_name(t)
+                    )
+                    if cursor.fetchone()[0]:
+                        return db
+        return database
+
+    # Number of records fetched from the server-side cursor in a single call
+    chunksize = 5000
+
+    @classmethod
+    def chunks(cls, cursor, *caches):
+        """
+        Generator returning the result of a query in lists of records.
+        The name caches passed as argument are cleared at the start of each
+        chunk, which keeps their size bounded for large tables.
+        """
+        while True:
+            rows = cursor.fetchmany(cls.chunksize)
+            if not rows:
+                break
+            for c in caches:
+                c.clear()
+            yield rows
+
+
+class NameCache(dict):
+    """
+    Dictionary mapping a name to a frePPLe object.
+
+    Looking up an entity through the extension API is relatively expensive,
+    while consecutive records in a large table typically refer to a small
+    number of operations, items and locations.
+    A missing or empty name maps to None. Lookups that raise an exception are
+    not cached.
+    """
+
+    def __init__(self, factory):
+        super().__init__()
+        self.factory = factory
+
+    def __missing__(self, name):
+        if not name:
+            return None
+        obj = self.factory(name=name)
+        self[name] = obj
+        return obj
+
 
 @PlanTaskRegistry.register
 class checkBuckets(CheckTask):
@@ -159,6 +256,70 @@ class checkBuckets(CheckTask):
                 cursor.execute("comment on index %s is %%s" % q[0], (q[1],))
 
 
+@PlanTaskRegistry.register
+class loadDeltaScenario(PlanTask):
+    """
+    A delta scenario only stores the input records that differ from its
+    parent scenario, and the loading tasks read the data of the parent
+    scenarios as well.
+
+    The plan of a delta scenario refers to records that only exist in its
+    parent scenarios. The foreign keys between the input and output tables
+    are removed from a delta scenario when it is created, and again here
+    in case a migration recreated some of them.
+    """
+
+    description = "Preparing the delta scenario"
+    sequence = 85
+
+    @classmethod
+    def getWeight(cls, database=DEFAULT_DB_ALIAS, parents=None, **kwargs):
+        return 0.1 if parents else -1
+
+    @classmethod
+    def run(cls, database=DEFAULT_DB_ALIAS, parents=None, **kwargs):
+        logger.info("Reading scenario %s on top of %s" % (database, ", ".join(parents)))
+        cls.dropForeignKeys(database)
+
+    @staticmethod
+    def getTables():
+        """
+        Returns the tables that only store the changes in a delta scenario.
+        """
+        tables = set()
+        for app in ("input", "output"):
+            for m in apps.get_app_config(app).get_models(include_auto_created=True):
+                if m._meta.managed and not m._meta.proxy:
+                    tables.add(m._meta.db_table)
+        return sorted(tables)
+
+    @classmethod
+    def dropForeignKeys(cls, database):
+        tables = cls.getTables()
+        with connections[database].cursor() as cursor:
+            cursor.execute(
+                """
+                select src.relname, conname
+                from pg_constraint
+                inner join pg_class as src on src.oid = pg_constraint.conrelid
+                inner join pg_class as dest on dest.oid = pg_constraint.confrelid
+                where contype = 'f'
+                  and src.relnamespace = 'public'::regnamespace
+                  and src.relname = any(%s)
+                  and dest.relname = any(%s)
+                """,
+                (tables, tables),
+            )
+            for table, constraint in cursor.fetchall():
+                cursor.execute(
+                    "alter table %s drop constraint %s"
+                    % (
+                        connections[database].ops.quote_name(table),
+                        connections[database].ops.quote_name(constraint),
+                    )
+                )
+
+
 @PlanTaskRegistry.register
 class loadParameter(LoadTask):
 
@@ -196,8 +357,9 @@ class loadParameter(LoadTask):
 @PlanTaskRegistry.register
 class loadLocations(LoadTask):
 
-    description = "Importing locations"
-    sequence = 91
+    description = ("Load model", "Importing locations")
+    sequence = (91, "location", 1)
+    incremental = True
 
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -254,8 +416,9 @@ class loadLocations(LoadTask):
 
 @PlanTaskRegistry.register
 class loadCalendars(LoadTask):
-    description = "Importing calendars"
-    sequence = 92
+    description = ("Load model", "Importing calendars")
+    sequence = (91, "calendar", 1)
+    incremental = True
 
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -296,8 +459,10 @@ class loadCalendars(LoadTask):
 @PlanTaskRegistry.register
 class loadCalendarBuckets(LoadTask):
 
-    description = "Importing calendar buckets"
-    sequence = 93
+    description = ("Load model", "Importing calendar buckets")
+    sequence = (91, "calendar", 2)
+    incremental = False
+    tables = ("calendarbucket", "common_bucketdetail")
 
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -377,8 +542,9 @@ class loadCalendarBuckets(LoadTask):
 @PlanTaskRegistry.register
 class loadCustomers(LoadTask):
 
-    description = "Importing customers"
-    sequence = 94
+    description = ("Load model", "Importing customers")
+    sequence = (91, "customer", 1)
+    incremental = True
 
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -422,8 +588,9 @@ class loadCustomers(LoadTask):
 @PlanTaskRegistry.register
 class loadSuppliers(LoadTask):
 
-    description = "Importing suppliers"
-    sequence = 95
+    description = ("Load model", "Importing suppliers")
+    sequence = (91, "location", 2)
+    incremental = True
 
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -471,8 +638,9 @@ class loadSuppliers(LoadTask):
 @PlanTaskRegistry.register
 class loadOperations(LoadTask):
 
-    description = "Importing operations"
-    sequence = 96
+    description = ("Load model", "Importing operations")
+    sequence = (92, "operation", 1)
+    incremental = True
 
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -684,8 +852,10 @@ class loadOperations(LoadTask):
 @PlanTaskRegistry.register
 class loadSuboperations(LoadTask):
 
-    description = "Importing suboperations"
-    sequence = 97
+    description = ("Load model", "Importing suboperations")
+    sequence = (92, "operation", 2)
+    incremental = False
+    tables = ("suboperation",)
 
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -748,8 +918,9 @@ class loadSuboperations(LoadTask):
 @PlanTaskRegistry.register
 class loadItems(LoadTask):
 
-    description = "Importing items"
-    sequence = 98
+    description = ("Load model", "Importing items")
+    sequence = (91, "item", 1)
+    incremental = True
 
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -803,8 +974,10 @@ class loadItems(LoadTask):
 @PlanTaskRegistry.register
 class loadItemSuppliers(LoadTask):
 
-    description = "Importing item suppliers"
-    sequence = 99
+    description = ("Load model", "Importing item suppliers")
+    sequence = (93, "itemsupplier", 1)
+    incremental = False
+    tables = ("itemsupplier",)
 
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -876,8 +1049,10 @@ class loadItemSuppliers(LoadTask):
 @PlanTaskRegistry.register
 class loadItemDistributions(LoadTask):
 
-    description = "Importing item distributions"
-    sequence = 100
+    description = ("Load model", "Importing item distributions")
+    sequence = (93, "itemsupplier", 2)
+    incremental = False
+    tables = ("itemdistribution",)
 
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -950,8 +1125,9 @@ class loadItemDistributions(LoadTask):
 @PlanTaskRegistry.register
 class loadBuffers(LoadTask):
 
-    description = "Importing buffers"
-    sequence = 101
+    description = ("Load model", "Importing buffers")
+    sequence = (92, "buffer", 1)
+    incremental = True
 
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -1014,8 +1190,10 @@ class loadBuffers(LoadTask):
 @PlanTaskRegistry.register
 class loadSetupMatrices(LoadTask):
 
-    description = "Importing setup matrix rules"
-    sequence = 102
+    description = ("Load model", "Importing setup matrix rules")
+    sequence = (91, "setupmatrix", 1)
+    incremental = False
+    tables = ("setupmatrix", "setuprule")
 
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -1082,8 +1260,9 @@ class loadSetupMatrices(LoadTask):
 @PlanTaskRegistry.register
 class loadResources(LoadTask):
 
-    description = "Importing resources"
-    sequence = 94.5
+    description = ("Load model", "Importing resources")
+    sequence = (92, "resource", 1)
+    incremental = True
 
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -1185,8 +1364,10 @@ class loadResources(LoadTask):
 @PlanTaskRegistry.register
 class loadResourceSkills(LoadTask):
 
-    description = "Importing resources skills"
-    sequence = 104
+    description = ("Load model", "Importing resources skills")
+    sequence = (92, "resource", 2)
+    incremental = False
+    tables = ("resourceskill", "skill")
 
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -1232,8 +1413,10 @@ class loadResourceSkills(LoadTask):
 @PlanTaskRegistry.register
 class loadOperationMaterials(LoadTask):
 
-    description = "Importing operation materials"
-    sequence = 105
+    description = ("Load model", "Importing operation materials")
+    sequence = (93, "operationmaterial", 1)
+    incremental = False
+    tables = ("operationmaterial",)
 
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -1320,8 +1503,10 @@ class loadOperationMaterials(LoadTask):
 @PlanTaskRegistry.register
 class loadOperationResources(LoadTask):
 
-    description = "Importing operation resources"
-    sequence = 106
+    description = ("Load model", "Importing operation resources")
+    sequence = (93, "operationresource", 1)
+    incremental = False
+    tables = ("operationresource",)
 
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -1382,11 +1567,12 @@ class loadOperationResources(LoadTask):
 @PlanTaskRegistry.register
 class loadDemand(LoadTask):
 
-    description = "Importing demands"
-    sequence = 107
+    description = ("Load model", "Importing demands")
+    sequence = (93, "demand", 1)
+    incremental = True
 
     @classmethod
-    def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
+    def run(cls, database=DEFAULT_DB_ALIAS, loadsince=None, delta=False, **kwargs):
         import frepple
 
         if cls.filter:
@@ -1394,6 +1580,26 @@ class loadDemand(LoadTask):
         else:
             filter_and = ""
 
+        if loadsince or delta:
+            # Remove the demands closed or canceled since the previous load,
+            # or closed or canceled in a delta scenario
+            with connections[database].cursor() as cursor:
+                cursor.execute(
+                    """
+                    select name from demand
+                    where status is not null and status not in ('open', 'quote')
+                    %s
+                    """
+                    % ("and lastmodified >= %s" if loadsince else ""),
+                    (loadsince,) if loadsince else None,
+                )
+                for i in cursor.fetchall():
+                    try:
+                        frepple.demand(name=i[0], action="R")
+                    except Exception:
+                        # Demand wasn't in the model
+                        pass
+
         with connections[database].chunked_cursor() as cursor:
             cnt = 0
             starttime = time()
@@ -1408,34 +1614,39 @@ class loadDemand(LoadTask):
                 """
                 % filter_and
             )
-            for i in cursor:
-                cnt += 1
-                try:
-                    x = frepple.demand(
-                        name=i[0],
-                        due=i[1],
-                        quantity=i[2],
-                        priority=i[3],
-                        status=i[14],
-                        item=frepple.item(name=i[4]),
-                        category=i[10],
-                        subcategory=i[11],
-                        source=i[12],
-                    )
-                    if i[5]:
-                        x.operation = frepple.operation(name=i[5])
-                    if i[6]:
-                        x.customer = frepple.customer(name=i[6])
-                    if i[7]:
-                        x.owner = frepple.demand(name=i[7])
-                    if i[8] is not None:
-                        x.minshipment = i[8]
-                    if i[9] is not None:
-                        x.maxlateness = i[9].total_seconds()
-                    if i[13]:
-                        x.location = frepple.location(name=i[13])
-                except Exception as e:
-                    logger.error("**** %s ****" % e)
+            items = NameCache(frepple.item)
+            operations = NameCache(frepple.operation)
+            customers = NameCache(frepple.customer)
+            locations = NameCache(frepple.location)
+            for rows in cls.chunks(cursor, items, operations, customers, locations):
+                for i in rows:
+                    cnt += 1
+                    try:
+                        x = frepple.demand(
+                            name=i[0],
+                            due=i[1],
+                            quantity=i[2],
+                            priority=i[3],
+                            status=i[14],
+                            item=items[i[4]],
+                            category=i[10],
+                            subcategory=i[11],
+                            source=i[12],
+                        )
+                        if i[5]:
+                            x.operation = operations[i[5]]
+                        if i[6]:
+                            x.customer = customers[i[6]]
+                        if i[7]:
+                            x.owner = frepple.demand(name=i[7])
+                        if i[8] is not None:
+                            x.minshipment = i[8]
+                        if i[9] is not None:
+                            x.maxlateness = i[9].total_seconds()
+                        if i[13]:
+                            x.location = locations[i[13]]
+                    except Exception as e:
+                        logger.error("**** %s ****" % e)
             logger.info("Loaded %d demands in %.2f seconds" % (cnt, time() - starttime))
 
 
@@ -1446,7 +1657,7 @@ class loadOperationPlans(LoadTask):
     sequence = 108
 
     @classmethod
-    def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
+    def run(cls, database=DEFAULT_DB_ALIAS, delta=False, **kwargs):
         import frepple
 
         if cls.filter:
@@ -1454,6 +1665,19 @@ class loadOperationPlans(LoadTask):
         else:
             filter_and = ""
 
+        if delta:
+            # Remove the orders closed in a delta scenario
+            with connections[database].cursor() as cursor:
+                cursor.execute(
+                    "select reference from operationplan where status = 'closed'"
+                )
+                for i in cursor.fetchall():
+                    try:
+                        frepple.operationplan(reference=i[0], action="R")
+                    except Exception:
+                        # Order wasn't in the model
+                        pass
+
         with connections[database].chunked_cursor() as cursor:
             consume_material = (
                 Parameter.getValue("WIP.consume_material", database, "true").lower()
@@ -1463,12 +1687,14 @@ class loadOperationPlans(LoadTask):
                 Parameter.getValue("WIP.consume_capacity", database, "true").lower()
                 == "true"
             )
-            if "supply" in os.environ:
+            if "supply" in os.environ or delta:
+                # A delta scenario also stores its own proposed plan. Only the
+                # orders locked in the delta scenario replace the orders of
+                # its parent.
                 confirmed_filter = " and operationplan.status in ('confirmed', 'approved', 'completed')"
-                create_flag = True
             else:
                 confirmed_filter = ""
-                create_flag = False
+            create_flag = "supply" in os.environ
             cnt_mo = 0
             cnt_po = 0
             cnt_do = 0
@@ -1496,94 +1722,99 @@ class loadOperationPlans(LoadTask):
         """
                 % (filter_and, confirmed_filter)
             )
-            for i in cursor:
-                try:
-                    if i[13]:
-                        dmd = frepple.demand(name=i[13])
-                    else:
-                        dmd = None
-                    if i[7] == "MO":
-                        cnt_mo += 1
-                        opplan = frepple.operationplan(
-                            operation=frepple.operation(name=i[0]),
-                            reference=i[1],
-                            quantity=i[2],
-                            source=i[6],
-                            start=i[3],
-                            end=i[4],
-                            statusNoPropagation=i[5],
-                            create=create_flag,
-                        )
-                        if opplan and i[5] == "confirmed":
-                            if not consume_material:
-                                opplan.consume_material = False
-                            if not consume_capacity:
-                                opplan.consume_capacity = False
-                    elif i[7] == "PO":
-                        cnt_po += 1
-                        opplan = frepple.operationplan(
-                            location=frepple.location(name=i[12]),
-                            ordertype=i[7],
-                            reference=i[1],
-                            item=frepple.item(name=i[11]) if i[11] else None,
-                            supplier=frepple.supplier(name=i[10]) if i[10] else None,
-                            quantity=i[2],
-                            start=i[3],
-                            end=i[4],
-                            statusNoPropagation=i[5],
-                            source=i[6],
-                            create=create_flag,
-                        )
-                        if opplan and i[5] == "confirmed":
-                            if not consume_capacity:
-                                opplan.consume_capacity = False
-                    elif i[7] == "DO":
-                        cnt_do += 1
-                        opplan = frepple.operationplan(
-                            location=frepple.location(name=i[9]) if i[9] else None,
-                            reference=i[1],
-                            ordertype=i[7],
-                            item=frepple.item(name=i[11]) if i[11] else None,
-                            origin=frepple.location(name=i[8]) if i[8] else None,
-                            quantity=i[2],
-                            start=i[3],
-                            end=i[4],
-                            statusNoPropagation=i[5],
-                            source=i[6],
-                            create=create_flag,
-                        )
-                        if opplan and i[5] == "confirmed":
-                            if not consume_capacity:
-                                opplan.consume_capacity = False
-                    elif i[7] == "DLVR":
-                        cnt_dlvr += 1
-                        opplan = frepple.operationplan(
-                            location=frepple.location(name=i[12]) if i[12] else None,
-                            reference=i[1],
-                            ordertype=i[7],
-                            item=frepple.item(name=i[11]) if i[11] else None,
-                            origin=frepple.location(name=i[8]) if i[8] else None,
-                            demand=dmd,
-                            quantity=i[2],
-                            start=i[3],
-                            end=i[4],
-                            statusNoPropagation=i[5],
-                            source=i[6],
-                            create=create_flag,
-                        )
-                        if opplan and i[5] == "confirmed":
-                            if not consume_capacity:
-                                opplan.consume_capacity = False
-                        opplan = None
-                    else:
-                        logger.warning(
-                            "Warning: unhandled operationplan type '%s'" % i[7]
-                        )
-                        continue
-                    if dmd and opplan:
-                        opplan.demand = dmd
-                except Exception as e:
-                    logger.error("**** %s ****" % e)
+            operations = NameCache(frepple.operation)
+            locations = NameCache(frepple.location)
+            items = NameCache(frepple.item)
+            suppliers = NameCache(frepple.supplier)
+            demands = NameCache(frepple.demand)
+            for rows in cls.chunks(
+                cursor, operations, locations, items, suppliers, demands
+            ):
+                for i in rows:
+                    try:
+                        dmd = demands[i[13]]
+                        if i[7] == "MO":
+                            cnt_mo += 1
+                            opplan = frepple.operationplan(
+                                operation=operations[i[0]],
+                                reference=i[1],
+                                quantity=i[2],
+                                source=i[6],
+                                start=i[3],
+                                end=i[4],
+                                statusNoPropagation=i[5],
+                                create=create_flag,
+                            )
+                            if opplan and i[5] == "confirmed":
+                                if not consume_material:
+                                    opplan.consume_material = False
+                                if not consume_capacity:
+                                    opplan.consume_capacity = False
+                        elif i[7] == "PO":
+                            cnt_po += 1
+                            opplan = frepple.operationplan(
+                                location=locations[i[12]],
+                                ordertype=i[7],
+                                reference=i[1],
+                                item=items[i[11]],
+                                supplier=suppliers[i[10]],
+                                quantity=i[2],
+                                start=i[3],
+                                end=i[4],
+                                statusNoPropagation=i[5],
+                                source=i[6],
+                                create=create_flag,
+                            )
+                            if opplan and i[5] == "confirmed":
+                                if not consume_capacity:
+                                    opplan.consume_capacity = False
+                        elif i[7] == "DO":
+                            cnt_do += 1
+                            opplan = frepple.operationplan(
+                                location=locations[i[9]],
+                                reference=i[1],
+                                ordertype=i[7],
+                                item=items[i[11]],
+                                origin=locations[i[8]],
+                                quantity=i[2],
+                                start=i[3],
+                                end=i[4],
+                                statusNoPropagation=i[5],
+                                source=i[6],
+                                create=create_flag,
+                            )
+                            if opplan and i[5] == "confirmed":
+                                if not consume_capacity:
+                                    opplan.consume_capacity = False
+                        elif i[7] == "DLVR":
+                            cnt_dlvr += 1
+                            opplan = frepple.operationplan(
+                                location=locations[i[12]],
+                                reference=i[1],
+                                ordertype=i[7],
+                                item=items[i[11]],
+                                origin=locations[i[8]],
+                                demand=dmd,
+                                quantity=i[2],
+                                start=i[3],
+                                end=i[4],
+                                statusNoPropagation=i[5],
+                                source=i[6],
+                                create=create_flag,
+                            )
+                            if opplan and i[5] == "confirmed":
+                                if not consume_capacity:
+                                    opplan.consume_capacity = False
+                            opplan = None
+                        else:
+                            logger.warning(
+                                "Warning: unhandled operationplan type '%s'" % i[7]
+                            )
+                            continue
+                        if dmd and opplan:
+                            opplan.demand = dmd
+                    except Exception as e:
+                        logger.error("**** %s ****" % e)
         with connections[database].chunked_cursor() as cursor:
             cursor.execute(
                 """
@@ -1609,54 +1840,58 @@ class loadOperationPlans(LoadTask):
         """
                 % (filter_and, confirmed_filter)
             )
-            for i in cursor:
-                try:
-                    cnt_mo += 1
-                    opplan = frepple.operationplan(
-                        operation=frepple.operation(name=i[0]),
-                        reference=i[1],
-                        quantity=i[2],
-                        source=i[7],
-                        start=i[3],
-                        end=i[4],
-                        statusNoPropagation=i[5],
-                    )
-                    if opplan and i[5] == "confirmed":
-                        if not consume_material:
-                            opplan.consume_material = False
-                        if not consume_capacity:
-                            opplan.consume_capacity = False
-                    if opplan:
-                        if i[6]:
-                            try:
-                                opplan.owner = frepple.operationplan(reference=i[6])
-                            except:
-                                pass
-                        if i[8]:
-                            opplan.demand = frepple.demand(name=i[8])
-                except Exception as e:
-                    logger.error("**** %s ****" % e)
+            for rows in cls.chunks(cursor, operations, demands):
+                for i in rows:
+                    try:
+                        cnt_mo += 1
+                        opplan = frepple.operationplan(
+                            operation=operations[i[0]],
+                            reference=i[1],
+                            quantity=i[2],
+                            source=i[7],
+                            start=i[3],
+                            end=i[4],
+                            statusNoPropagation=i[5],
+                        )
+                        if opplan and i[5] == "confirmed":
+                            if not consume_material:
+                                opplan.consume_material = False
+                            if not consume_capacity:
+                                opplan.consume_capacity = False
+                        if opplan:
+                            if i[6]:
+                                try:
+                                    opplan.owner = frepple.operationplan(reference=i[6])
+                                except:
+                                    pass
+                            if i[8]:
+                                opplan.demand = demands[i[8]]
+                    except Exception as e:
+                        logger.error("**** %s ****" % e)
             logger.info(
                 "Loaded %d manufacturing orders, %d purchase orders, %d distribution orders and %s deliveries in %.2f seconds"
                 % (cnt_mo, cnt_po, cnt_do, cnt_dlvr, time() - starttime)
             )
 
-        with connections[database].cursor() as cursor:
-            # Assure the operationplan ids will be unique.
-            # We call this method only at the end, as calling it earlier gives a slower
-            # performance to load operationplans
-            # By limiting the number of digits in the query we enforce reusing numbers at some point.
-            cursor.execute(
-                """
-        select coalesce(max(reference::bigint), 0) as max_reference
-        from operationplan
-        where status <> 'proposed'
-        and reference ~ '^[0-9]*$'
-        and char_length(reference) <= 9
-        """
-            )
-            d = cursor.fetchone()
-            frepple.settings.id = d[0]
+        # Assure the operationplan ids will be unique.
+        # We call this method only at the end, as calling it earlier gives a slower
+        # performance to load operationplans
+        # By limiting the number of digits in the query we enforce reusing numbers at some point.
+        # A delta scenario also needs to check the references of its parents.
+        max_reference = 0
+        for db in [database] + (Scenario.getParents(database) if delta else []):
+            with connections[db].cursor() as cursor:
+                cursor.execute(
+                    """
+            select coalesce(max(reference::bigint), 0) as max_reference
+            from operationplan
+            where status <> 'proposed'
+            and reference ~ '^[0-9]*$'
+            and char_length(reference) <= 9
+            """
+                )
+                max_reference = max(max_reference, cursor.fetchone()[0])
+        frepple.settings.id = max_reference
 
 
 @PlanTaskRegistry.register
@@ -1666,7 +1901,7 @@ class loadOperationPlanMaterials(LoadTask):
     sequence = 109
 
     @classmethod
-    def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
+    def run(cls, database=DEFAULT_DB_ALIAS, delta=False, **kwargs):
         import frepple
 
         with connections[database].chunked_cursor() as cursor:
@@ -1688,7 +1923,7 @@ class loadOperationPlanMaterials(LoadTask):
         """
                 % (
                     "and operationplan.status in ('approved', 'confirmed', 'completed')"
-                    if "supply" in os.environ
+                    if "supply" in os.environ or delta
                     else ""
                 )
             )
@@ -1723,7 +1958,7 @@ class loadOperationPlanResources(LoadTask):
     sequence = 110
 
     @classmethod
-    def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
+    def run(cls, database=DEFAULT_DB_ALIAS, delta=False, **kwargs):
         import frepple
 
         with connections[database].chunked_cursor() as cursor:
@@ -1742,23 +1977,25 @@ class loadOperationPlanResources(LoadTask):
         """
                 % (
                     "and operationplan.status in ('approved', 'confirmed', 'completed')"
-                    if "supply" in os.environ
+                    if "supply" in os.environ or delta
                     else ""
                 )
             )
-            res = None
-            for i in cursor:
-                cnt += 1
-                try:
-                    opplan = frepple.operationplan(reference=i[0])
-                    if not res or res.name != i[1]:
-                        res = frepple.resource(name=i[1])
-                    # Note we don't restore the date or quantity from the operationplanresource table
-                    frepple.loadplan(
-                        operationplan=opplan, resource=res, status=i[2], source=i[3]
-                    )
-                except Exception as e:
-                    logger.error("**** %s ****" % e)
+            resources = NameCache(frepple.resource)
+            for rows in cls.chunks(cursor, resources):
+                for i in rows:
+                    cnt += 1
+                    try:
+                        opplan = frepple.operationplan(reference=i[0])
+                        # Note we don't restore the date or quantity from the operationplanresource table
+                        frepple.loadplan(
+                            operationplan=opplan,
+                            resource=resources[i[1]],
+                            status=i[2],
+                            source=i[3],
+                        )
+                    except Exception as e:
+                        logger.error("**** %s ****" % e)
             logger.info(
                 "Loaded %d operationplanresources in %.2f seconds"
                 % (cnt, time() - starttime)
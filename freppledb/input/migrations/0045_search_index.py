@@ -0,0 +1,74 @@
+#
+# Copyright (C) 2019 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+
+from django.db import migrations, DatabaseError, transaction
+
+logger = logging.getLogger(__name__)
+
+# Tables and primary key columns used by the global search
+searchTables = [
+    ("calendar", "name"),
+    ("common_bucket", "name"),
+    ("common_parameter", "name"),
+    ("customer", "name"),
+    ("demand", "name"),
+    ("item", "name"),
+    ("location", "name"),
+    ("operation", "name"),
+    ("operationplan", "reference"),
+    ("resource", "name"),
+    ("setupmatrix", "name"),
+    ("skill", "name"),
+    ("supplier", "name"),
+]
+
+
+def createSearchIndexes(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        # Creating the trigram extension requires the create privilege on
+        # the database. Without it the search still works, using table scans.
+        try:
+            with transaction.atomic(using=schema_editor.connection.alias):
+                cursor.execute("create extension if not exists pg_trgm")
+        except DatabaseError:
+            logger.warning(
+                "The pg_trgm extension isn't available. "
+                "The global search won't use an index."
+            )
+            return
+        for table, column in searchTables:
+            cursor.execute(
+                """
+        create index if not exists %s_search_idx
+        on %s using gin (upper(%s::text) gin_trgm_ops)
+        """
+                % (table, table, column)
+            )
+
+
+def dropSearchIndexes(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        for table, column in searchTables:
+            cursor.execute("drop index if exists %s_search_idx" % table)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("input", "0044_squashed_60"), ("common", "0014_squashed_60")]
+
+    operations = [migrations.RunPython(createSearchIndexes, dropSearchIndexes)]
@@ -27,7 +27,12 @@ from django.utils.translation import gettext_lazy as _
 from django.utils.text import format_lazy
 
 from freppledb.common.fields import JSONBField, AliasDateTimeField
-from freppledb.common.models import HierarchyModel, AuditModel, MultiDBManager
+from freppledb.common.models import (
+    HierarchyModel,
+    AuditModel,
+    MultiDBManager,
+    Scenario,
+)
 
 
 searchmode = (
@@ -2090,14 +2095,23 @@ class ManufacturingOrder(OperationPlan):
 
     @classmethod
     def getModelForm(cls, fields, database=DEFAULT_DB_ALIAS):
+        from freppledb.common.dataload import BulkForeignKeyFormField
+
+        # A delta scenario can refer to the records of its parent scenarios
+        parents = Scenario.getParents(database)
+
+        def formfieldCallback(f):
+            if not isinstance(f, RelatedField):
+                return f.formfield()
+            elif parents:
+                return BulkForeignKeyFormField(field=f, using=database, parents=parents)
+            else:
+                return f.formfield(using=database)
 
         template = modelform_factory(
             cls,
             fields=[i for i in fields if i != "resource"],
-            formfield_callback=lambda f: (
-                isinstance(f, RelatedField) and f.formfield(using=database)
-            )
-            or f.formfield(),
+            formfield_callback=formfieldCallback,
         )
 
         if "resource" not in fields:
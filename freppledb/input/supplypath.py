@@ -0,0 +1,434 @@
+#
+# Copyright (C) 2019 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+r"""
+In-memory graph of the supply chain, used by the supply path and where-used
+reports.
+"""
+
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from freppledb.common.cache import getSize
+from freppledb.common.report import reportCache
+
+
+def jsonbOrder(d):
+    """
+    Returns a dictionary with the keys in the order PostgreSQL stores the
+    keys of a jsonb object: shorter keys first.
+    """
+    return {k: d[k] for k in sorted(d, key=lambda k: (len(k.encode("utf-8")), k))}
+
+
+def buffer(item, location):
+    return "%s @ %s" % (item, location) if item and location else None
+
+
+class SupplyPath:
+    """
+    Graph of the operations, materials and resources of a scenario.
+
+    The graph is loaded once and shared by all requests till the data of
+    one of the tables it is built from changes.
+    The queries return rows with the fields:
+      - operation
+      - location
+      - operation type
+      - priority
+      - buffers: dictionary with the buffer names and their quantity
+      - resources: dictionary with the resource names and their quantity
+      - duration
+      - duration per unit
+      - parent operation
+      - parent operation type
+      - parent operation priority
+      - grandparent operation
+      - grandparent operation type
+    """
+
+    tables = (
+        "item",
+        "location",
+        "operation",
+        "operationmaterial",
+        "operationresource",
+        "itemdistribution",
+        "itemsupplier",
+    )
+
+    @classmethod
+    def get(cls, database=DEFAULT_DB_ALIAS):
+        """
+        Returns the graph of a scenario, loading it when the data changed.
+        """
+        if not reportCache.maxsize:
+            return cls(database)
+        key = ("supplypath", database)
+        version = cls.getVersion(database)
+        graph = reportCache.get(key, version)
+        if not graph:
+            graph = cls(database)
+            reportCache.set(key, graph, version, graph.size)
+        return graph
+
+    @classmethod
+    def getVersion(cls, database=DEFAULT_DB_ALIAS):
+        """
+        Returns the number of records and the last modification of the tables
+        of the graph.
+        """
+        with connections[database].cursor() as cursor:
+            cursor.execute(
+                "select %s"
+                % ", ".join(
+                    "(select count(*) from %s), (select max(lastmodified) from %s)"
+                    % (t, t)
+                    for t in cls.tables
+                )
+            )
+            return cursor.fetchone()
+
+    def __init__(self, database=DEFAULT_DB_ALIAS):
+        self.items = {}
+        self.locations = {}
+        self.operations = {}
+        self.suboperations = {}
+        self.materials = {}
+        self.resources = {}
+        self.distributions = {}
+        self.suppliers = {}
+        with connections[database].cursor() as cursor:
+            # Hierarchies of items and locations
+            for model, owners in (("item", self.items), ("location", self.locations)):
+                cursor.execute("select name, owner_id from %s" % model)
+                for name, owner in cursor.fetchall():
+                    owners[name] = owner if owner != name else None
+
+            # Operations and their suboperations
+            cursor.execute(
+                """
+                select name, type, location_id, priority, duration, duration_per,
+                  item_id, owner_id
+                from operation
+                order by name
+                """
+            )
+            for i in cursor.fetchall():
+                self.operations[i[0]] = i[1:]
+                if i[7]:
+                    self.suboperations.setdefault(i[7], []).append(i[0])
+
+            # Materials and resources of the operations
+            cursor.execute(
+                "select operation_id, item_id, quantity from operationmaterial order by id"
+            )
+            for operation, item, quantity in cursor.fetchall():
+                self.materials.setdefault(operation, []).append(
+                    (item, float(quantity) if quantity is not None else None)
+                )
+            cursor.execute(
+                "select operation_id, resource_id, quantity from operationresource order by id"
+            )
+            for operation, resource, quantity in cursor.fetchall():
+                self.resources.setdefault(operation, []).append(
+                    (resource, float(quantity) if quantity is not None else None)
+                )
+
+            # Distribution and purchasing operations
+            cursor.execute(
+                """
+                select item_id, origin_id, location_id, resource_id, resource_qty, leadtime
+                from itemdistribution
+                order by id
+                """
+            )
+            for i in cursor.fetchall():
+                self.distributions.setdefault(i[0], []).append(
+                    i[1:4] + (float(i[4]) if i[4] is not None else None, i[5])
+                )
+            cursor.execute(
+                """
+                select item_id, location_id, supplier_id, resource_id, resource_qty, leadtime
+                from itemsupplier
+                order by id
+                """
+            )
+            for i in cursor.fetchall():
+                self.suppliers.setdefault(i[0], []).append(
+                    i[1:4] + (float(i[4]) if i[4] is not None else None, i[5])
+                )
+
+        # Index the operations on the items they produce and consume, and on
+        # the resources they load
+        self.producers = {}
+        self.consumers = {}
+        self.users = {}
+        for name, op in self.operations.items():
+            if op[0] not in ("time_per", "fixed_time"):
+                continue
+            produced = [op[5]]
+            parent = self.operations.get(op[6], None)
+            if parent:
+                produced.append(parent[5])
+                grandparent = self.operations.get(parent[6], None)
+                if grandparent:
+                    produced.append(grandparent[5])
+            for item, quantity in self.materials.get(name, []):
+                if quantity is not None and quantity > 0:
+                    produced.append(item)
+                elif quantity is not None and quantity < 0:
+                    self.consumers.setdefault(item, {})[name] = True
+            for item in produced:
+                if item:
+                    self.producers.setdefault(item, {})[name] = True
+            for resource, quantity in self.resources.get(name, []):
+                self.users.setdefault(resource, {})[name] = True
+
+        # Index the distribution and purchasing operations on their resource
+        self.resourceDistributions = {}
+        for item, distributions in self.distributions.items():
+            for d in distributions:
+                if d[2]:
+                    self.resourceDistributions.setdefault(d[2], []).append((item,) + d)
+        self.resourceSuppliers = {}
+        for item, suppliers in self.suppliers.items():
+            for s in suppliers:
+                if s[2]:
+                    self.resourceSuppliers.setdefault(s[2], []).append((item,) + s)
+
+        # Children in the item and location hierarchies
+        self.itemChildren = {}
+        for child, owner in sorted(self.items.items()):
+            if owner:
+                self.itemChildren.setdefault(owner, []).append(child)
+        self.locationChildren = {}
+        for child, owner in sorted(self.locations.items()):
+            if owner:
+                self.locationChildren.setdefault(owner, []).append(child)
+
+        # Leaf locations, used by suppliers without location
+        self.leafLocations = sorted(
+            i for i in self.locations if i not in self.locationChildren
+        )
+
+        self.rows = {name: self._getRow(name) for name in self.operations}
+        self.size = getSize(vars(self))
+
+    def _getRow(self, name):
+        op = self.operations[name]
+        location = op[1]
+        materials = self.materials.get(name, None)
+        resources = self.resources.get(name, None)
+        if resources:
+            resources = jsonbOrder({r: q for r, q in resources if r})
+        if not op[6] or op[6] not in self.operations:
+            # Operation without owner
+            if materials:
+                buffers = {}
+                if buffer(op[5], location):
+                    buffers[buffer(op[5], location)] = 1
+                for item, quantity in materials:
+                    if buffer(item, location):
+                        buffers[buffer(item, location)] = quantity
+                buffers = jsonbOrder(buffers)
+            else:
+                buffers = None
+            return (name, location, op[0], op[2], buffers, resources, op[3], op[4]) + (
+                None,
+            ) * 5
+
+        # Suboperation of a routing or alternate operation.
+        # The products of the owner are only shown on the suboperations with
+        # the highest priority.
+        parentname = op[6]
+        parent = self.operations[parentname]
+        grandparentname = parent[6] if parent[6] in self.operations else None
+        grandparent = self.operations[grandparentname] if grandparentname else None
+        buffers = {}
+        priorities = [
+            self.operations[i][2]
+            for i in self.suboperations[parentname]
+            if self.operations[i][2] is not None
+        ]
+        if op[2] is not None and op[2] == max(priorities, default=None):
+            if grandparent and buffer(grandparent[5], grandparent[1]):
+                buffers[buffer(grandparent[5], grandparent[1])] = 1
+            if buffer(parent[5], parent[1]):
+                buffers[buffer(parent[5], parent[1])] = 1
+        if buffer(op[5], location):
+            buffers[buffer(op[5], location)] = 1
+        for item, quantity in materials or []:
+            if buffer(item, location):
+                buffers[buffer(item, location)] = quantity
+        return (
+            name,
+            location,
+            op[0],
+            op[2],
+            jsonbOrder(buffers),
+            resources,
+            op[3],
+            op[4],
+            parentname,
+            parent[0],
+            parent[2],
+            grandparentname,
+            grandparent[0] if grandparent else None,
+        )
+
+    def _getOperationRows(self, operations, location=None):
+        """
+        Returns the rows of a list of operations.
+        A suboperation is returned together with all its siblings.
+        """
+        names = {}
+        for name in operations:
+            op = self.operations[name]
+            if location and op[1] != location:
+                continue
+            if op[6] in self.suboperations:
+                for i in self.suboperations[op[6]]:
+                    names[i] = True
+            else:
+                names[name] = True
+        return [self.rows[i] for i in names]
+
+    def _getHierarchy(self, owners, name):
+        """
+        Returns a node and all its parents.
+        """
+        result = []
+        while name and name not in result:
+            result.append(name)
+            name = owners.get(name, None)
+        return result
+
+    def _getMembers(self, children, name):
+        """
+        Returns a node and all its children.
+        """
+        result = [name]
+        members = set(result)
+        for i in result:
+            for j in children.get(i, []):
+                if j not in members:
+                    members.add(j)
+                    result.append(j)
+        return result
+
+    def _getDistributionRow(self, item, origin, location, resource, quantity, leadtime):
+        return (
+            "Ship %s from %s to %s" % (item, origin, location),
+            location,
+            "distribution",
+            None,
+            jsonbOrder({buffer(item, origin): -1, buffer(item, location): 1}),
+            jsonbOrder({resource: quantity}) if resource else {},
+            leadtime,
+        ) + (None,) * 6
+
+    def _getPurchaseRow(self, item, location, supplier, resource, quantity, leadtime):
+        return (
+            "Purchase %s @ %s from %s" % (item, location, supplier),
+            location,
+            "purchase",
+            None,
+            {buffer(item, location): 1},
+            jsonbOrder({resource: quantity}) if resource else {},
+            leadtime,
+        ) + (None,) * 6
+
+    def _getPurchaseLocations(self, location):
+        if location:
+            return self._getMembers(self.locationChildren, location)
+        else:
+            return self.leafLocations
+
+    @staticmethod
+    def _sort(rows):
+        return sorted(rows, key=lambda i: (i[3] is None, i[3] or 0))
+
+    def getSuboperationCount(self, operation):
+        return len(self.suboperations.get(operation, []))
+
+    def getOperationsFromItem(self, item, downstream):
+        """
+        Returns the operations producing an item, or the operations
+        consuming it when the downstream argument is true.
+        """
+        rows = self._getOperationRows(
+            (self.consumers if downstream else self.producers).get(item, [])
+        )
+        hierarchy = self._getHierarchy(self.items, item)
+        for i in hierarchy:
+            for d in self.distributions.get(i, []):
+                rows.append(self._getDistributionRow(item, *d))
+        if not downstream:
+            for i in hierarchy:
+                for s in self.suppliers.get(i, []):
+                    for loc in self._getPurchaseLocations(s[0]):
+                        rows.append(self._getPurchaseRow(item, loc, *s[1:]))
+        return self._sort(rows)
+
+    def getOperationsFromBuffer(self, item, location, downstream):
+        """
+        Returns the operations replenishing a buffer, or the operations
+        consuming from it when the downstream argument is true.
+        """
+        rows = self._getOperationRows(
+            (self.consumers if downstream else self.producers).get(item, []), location,
+        )
+        hierarchy = self._getHierarchy(self.items, item)
+        for i in hierarchy:
+            for d in self.distributions.get(i, []):
+                if d[0 if downstream else 1] == location:
+                    rows.append(self._getDistributionRow(item, *d))
+        if not downstream:
+            for i in hierarchy:
+                for s in self.suppliers.get(i, []):
+                    if location in self._getPurchaseLocations(s[0]):
+                        rows.append(self._getPurchaseRow(item, location, *s[1:]))
+        return self._sort(rows)
+
+    def getOperationsFromResource(self, resource):
+        """
+        Returns the operations loading a resource.
+        """
+        rows = self._getOperationRows(self.users.get(resource, []))
+        for d in self.resourceDistributions.get(resource, []):
+            for item in self._getMembers(self.itemChildren, d[0]):
+                rows.append(self._getDistributionRow(item, *d[1:]))
+        for s in self.resourceSuppliers.get(resource, []):
+            for item in self._getMembers(self.itemChildren, s[0]):
+                for loc in self._getPurchaseLocations(s[1]):
+                    rows.append(self._getPurchaseRow(item, loc, *s[2:]))
+        return self._sort(rows)
+
+    def getOperationsFromName(self, operation):
+        """
+        Returns an operation and its suboperations.
+        """
+        names = []
+        for name in [operation] + self.suboperations.get(operation, []):
+            if name in self.operations:
+                names.append(name)
+                names.extend(self.suboperations.get(name, []))
+        return self._sort(
+            self._getOperationRows(
+                i for i in names if self.operations[i][0] in ("time_per", "fixed_time")
+            )
+        )
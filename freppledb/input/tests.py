@@ -15,15 +15,17 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import json
 import os
 from rest_framework.test import APIClient, APITestCase, APIRequestFactory
 import tempfile
 
 from django.core import management
 from django.http.response import StreamingHttpResponse
-from django.test import TestCase, TransactionTestCase
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
 
 from freppledb.common.models import User, Bucket, BucketDetail, Parameter
+from freppledb.input.commands import LoadTask, NameCache
 from freppledb.input.models import (
     Buffer,
     Calendar,
@@ -51,6 +53,38 @@ from freppledb.input.models import (
 )
 
 
+class BulkLoadTest(SimpleTestCase):
+    class Cursor:
+        def __init__(self, rows):
+            self.rows = rows
+
+        def fetchmany(self, size):
+            result = self.rows[:size]
+            self.rows = self.rows[size:]
+            return result
+
+    def test_chunks(self):
+        calls = []
+
+        def factory(name):
+            calls.append(name)
+            return name.upper()
+
+        cache = NameCache(factory)
+        chunksize = LoadTask.chunksize
+        LoadTask.chunksize = 2
+        try:
+            chunks = []
+            for rows in LoadTask.chunks(self.Cursor(["a", "a", "b", "a", "c"]), cache):
+                chunks.append([cache[r] for r in rows])
+        finally:
+            LoadTask.chunksize = chunksize
+        self.assertEqual(chunks, [["A", "A"], ["B", "A"], ["C"]])
+        # Names are looked up once per chunk
+        self.assertEqual(calls, ["a", "b", "a", "c"])
+        self.assertIsNone(cache[None])
+
+
 class DataLoadTest(TestCase):
 
     fixtures = ["demo"]
@@ -89,6 +123,70 @@ class DataLoadTest(TestCase):
         response = self.client.get("/data/input/suboperation/?format=json")
         self.assertContains(response, '"records":0,')
 
+    def test_search(self):
+        response = self.client.get("/search/?term=factory")
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content.decode("utf-8"))
+        idx = result.index({"value": None, "label": "Location - 2 matches"})
+        self.assertEqual(
+            result[idx + 1 : idx + 3],
+            [
+                {"url": "/detail/input/location/", "value": "factory 1"},
+                {"url": "/detail/input/location/", "value": "factory 2"},
+            ],
+        )
+        # An exact match is listed first
+        Location(name="old factory 2").save()
+        response = self.client.get("/search/?term=Factory 2")
+        result = json.loads(response.content.decode("utf-8"))
+        idx = result.index({"value": None, "label": "Location - 2 matches"})
+        self.assertEqual(
+            result[idx + 1], {"url": "/detail/input/location/", "value": "factory 2"}
+        )
+
+    def test_supply_path(self):
+        response = self.client.get("/supplypath/item/product/?format=json")
+        self.assertContains(response, "Pack product @ factory 1")
+        self.assertContains(response, "Make fabric @ factory 1")
+        response = self.client.get("/whereused/item/fabric/?format=json")
+        self.assertContains(response, "Pack product @ factory 1")
+        self.assertNotContains(response, "Make fabric @ factory 1")
+
+    def test_hierarchy_save(self):
+        Location.rebuildHierarchy()
+        loc = Location.objects.get(name="factory 1")
+        self.assertIsNotNone(loc.lft)
+        # Changes without a new owner keep the hierarchy
+        loc.description = "updated"
+        loc.save()
+        self.assertEqual(Location.objects.get(name="factory 1").lft, loc.lft)
+        # Moves, inserts and deletes update the affected records
+        loc.owner = None
+        loc.save()
+        Location(name="factory 3", owner=loc).save()
+        Location.objects.get(name="factory 2").delete()
+        self.assertEqual(
+            [(i.name, i.lft, i.rght, i.lvl) for i in Location.objects.order_by("lft")],
+            [
+                ("All locations", 1, 2, 0),
+                ("factory 1", 3, 6, 0),
+                ("factory 3", 4, 5, 1),
+            ],
+        )
+        # A copy saved with a new key gets its own place
+        loc = Location.objects.get(name="factory 3")
+        loc.pk = "Copy of factory 3"
+        loc.save(force_insert=True)
+        self.assertEqual(
+            [(i.name, i.lft, i.rght, i.lvl) for i in Location.objects.order_by("lft")],
+            [
+                ("All locations", 1, 2, 0),
+                ("factory 1", 3, 8, 0),
+                ("factory 3", 4, 5, 1),
+                ("Copy of factory 3", 6, 7, 1),
+            ],
+        )
+
     def test_csv_upload(self):
         self.assertEqual(
             [(i.name, i.category or u"") for i in Location.objects.all()],
@@ -121,6 +219,26 @@ class DataLoadTest(TestCase):
             ],  # Test result is different in Enterprise Edition
         )
 
+    def test_csv_upload_hierarchy(self):
+        Location.rebuildHierarchy()
+        lft = Location.objects.get(name="factory 1").lft
+        self.assertIsNotNone(lft)
+        try:
+            data = tempfile.NamedTemporaryFile(mode="w+b")
+            data.write(b"name,category\n")
+            data.write(b"factory 1,cat1\n")
+            data.seek(0)
+            response = self.client.post("/data/input/location/", {"csv_file": data})
+            for rec in response.streaming_content:
+                rec
+            self.assertEqual(response.status_code, 200)
+        finally:
+            data.close()
+        # Records keeping their owner keep their place in the hierarchy
+        loc = Location.objects.get(name="factory 1")
+        self.assertEqual(loc.category, "cat1")
+        self.assertEqual(loc.lft, lft)
+
     def test_forms(self):
         item = Item.objects.all()[0].name
         loc1 = Location.objects.all()[0].name
@@ -55,6 +55,7 @@ from freppledb.input.models import (
     OperationPlanMaterial,
     OperationPlanResource,
 )
+from freppledb.input.supplypath import SupplyPath
 from freppledb.common.report import GridReport, GridFieldBool, GridFieldLastModified
 from freppledb.common.report import GridFieldDateTime, GridFieldTime, GridFieldText
 from freppledb.common.report import GridFieldNumber, GridFieldInteger, GridFieldCurrency
@@ -65,54 +66,104 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of matches counted per model in the global search
+searchlimit = getattr(settings, "GLOBAL_SEARCH_LIMIT", 100)
+
 
 @staff_member_required
 def search(request):
     term = request.GET.get("term").strip()
     result = []
 
-    # Loop over all models in the data_site
+    # Build a query for all models in the data_site
     # We are interested in models satisfying these criteria:
     #  - primary key is of type text
     #  - user has change permissions
+    # The matches of a model are counted up to a limit, and only the best
+    # matches are returned: an exact match first, then the records starting
+    # with the search term, and then some other matching records. The exact
+    # and prefix matches are retrieved with separate queries, so they are
+    # never left out on large tables. None of these queries sorts all
+    # matching records: short search terms can match most of a table.
+    # The trigram indexes created by the migration 0045_search_index make
+    # the pattern match fast on large tables.
+    connection = connections[request.database]
+    models = []
+    sql = []
+    params = []
     for cls, admn in data_site._registry.items():
         if request.user.has_perm(
             "%s.view_%s" % (cls._meta.app_label, cls._meta.object_name.lower())
         ) and isinstance(cls._meta.pk, CharField):
-            query = (
-                cls.objects.using(request.database)
-                .filter(pk__icontains=term)
-                .order_by("pk")
-                .values_list("pk")
+            queryset = cls.objects.using(request.database).order_by()
+            subqueries = []
+            for subquery in (
+                queryset.filter(pk__icontains=term)[: searchlimit + 1],
+                queryset.filter(pk__iexact=term)[:10],
+                queryset.filter(pk__istartswith=term)[:10],
+                queryset.filter(pk__icontains=term)[:10],
+            ):
+                subsql, subparams = subquery.values_list("pk").query.sql_with_params()
+                subqueries.append(subsql)
+                params.extend(subparams)
+            sql.append(
+                """
+        (
+        select %d, x.pk, (select count(*) from (%s) c),
+          row_number() over (order by min(x.rank), length(x.pk), x.pk)
+        from (
+          select pk, 1 from (%s) e(pk)
+          union all
+          select pk, 2 from (%s) p(pk)
+          union all
+          select pk, 3 from (%s) o(pk)
+          ) x(pk, rank)
+        group by x.pk
+        order by 4
+        limit 10
+        )
+        """
+                % ((len(models),) + tuple(subqueries))
             )
-            count = len(query)
-            if count > 0:
-                result.append(
-                    {
-                        "value": None,
-                        "label": (
-                            ungettext(
-                                "%(name)s - %(count)d match",
-                                "%(name)s - %(count)d matches",
-                                count,
-                            )
-                            % {
-                                "name": force_text(cls._meta.verbose_name),
-                                "count": count,
-                            }
-                        ).capitalize(),
-                    }
-                )
-                result.extend(
-                    [
-                        {
-                            "url": "/detail/%s/%s/"
-                            % (cls._meta.app_label, cls._meta.object_name.lower()),
-                            "value": i[0],
+            models.append(cls)
+
+    # Execute a single query
+    with connection.cursor() as cursor:
+        if sql:
+            cursor.execute(
+                "select * from (%s) matches order by 1, 4" % " union all ".join(sql),
+                params,
+            )
+            matches = cursor.fetchall()
+        else:
+            matches = []
+        current = None
+        for idx, pk, count, rank in matches:
+            cls = models[idx]
+            if cls != current:
+                current = cls
+                if count > searchlimit:
+                    label = force_text(
+                        _("%(name)s - more than %(count)d matches")
+                        % {
+                            "name": force_text(cls._meta.verbose_name),
+                            "count": searchlimit,
                         }
-                        for i in query[:10]
-                    ]
-                )
+                    )
+                else:
+                    label = ungettext(
+                        "%(name)s - %(count)d match",
+                        "%(name)s - %(count)d matches",
+                        count,
+                    ) % {"name": force_text(cls._meta.verbose_name), "count": count}
+                result.append({"value": None, "label": label.capitalize()})
+            result.append(
+                {
+                    "url": "/detail/%s/%s/"
+                    % (cls._meta.app_label, cls._meta.object_name.lower()),
+                    "value": pk,
+                }
+            )
 
     # Construct reply
     return HttpResponse(
@@ -223,158 +274,7 @@ class PathReport(GridReport):
 
     @classmethod
     def getOperationFromItem(reportclass, request, item_name, downstream, depth):
-        cursor = connections[request.database].cursor()
-        query = """      
-      -- MANUFACTURING OPERATIONS
-      select distinct 
-      case when parentoperation is null then operation else sibling end,
-      case when parentoperation is null then operation_location else sibling_location end,
-      case when parentoperation is null then operation_type else sibling_type end,
-      case when parentoperation is null then operation_priority else sibling_priority end,
-      case when parentoperation is null then operation_om else sibling_om end,
-      case when parentoperation is null then operation_or else sibling_or end,
-      case when parentoperation is null then operation_duration else sibling_duration end,
-      case when parentoperation is null then operation_duration_per else sibling_duration_per end,
-      parentoperation,
-      parentoperation_type,
-      parentoperation_priority,
-      grandparentoperation,
-      grandparentoperation_type from
-      (
-      select operation.name as operation, 
-           operation.type operation_type,
-           operation.location_id operation_location,
-           operation.priority as operation_priority, 
-           operation.duration as operation_duration, 
-           operation.duration_per as operation_duration_per,
-           case when operation.item_id is not null then jsonb_build_object(operation.item_id||' @ '||operation.location_id, 1) else '{}'::jsonb end
-           ||jsonb_object_agg(operationmaterial.item_id||' @ '||operation.location_id, operationmaterial.quantity) filter (where operationmaterial.id is not null) as operation_om,
-           jsonb_object_agg(operationresource.resource_id, operationresource.quantity) filter (where operationresource.id is not null) as operation_or,
-             parentoperation.name as parentoperation, 
-           parentoperation.type as parentoperation_type,
-           parentoperation.priority parentoperation_priority,
-             sibling.name as sibling, 
-           sibling.type as sibling_type,
-           sibling.location_id as sibling_location,
-           sibling.priority as sibling_priority, 
-           sibling.duration as sibling_duration, 
-           sibling.duration_per as sibling_duration_per,
-           case when grandparentoperation.item_id is not null 
-           and sibling.priority = (select max(priority) from operation where owner_id = parentoperation.name) 
-           then jsonb_build_object(grandparentoperation.item_id||' @ '||grandparentoperation.location_id, 1) else '{}'::jsonb end
-           ||case when parentoperation.item_id is not null 
-           and sibling.priority = (select max(priority) from operation where owner_id = parentoperation.name) 
-           then jsonb_build_object(parentoperation.item_id||' @ '||parentoperation.location_id, 1) else '{}'::jsonb end
-           ||case when sibling.item_id is not null then jsonb_build_object(sibling.item_id||' @ '||sibling.location_id, 1) else '{}'::jsonb end
-           ||coalesce(jsonb_object_agg(siblingoperationmaterial.item_id||' @ '||sibling.location_id, siblingoperationmaterial.quantity)filter (where siblingoperationmaterial.id is not null), '{}'::jsonb) as sibling_om,
-           jsonb_object_agg(siblingoperationresource.resource_id, siblingoperationresource.quantity)filter (where siblingoperationresource.id is not null) as sibling_or,
-             grandparentoperation.name as grandparentoperation, 
-           grandparentoperation.type as grandparentoperation_type
-      from operation
-      left outer join operationmaterial on operationmaterial.operation_id = operation.name
-      left outer join operationresource on operationresource.operation_id = operation.name
-      left outer join operation parentoperation on parentoperation.name = operation.owner_id
-      left outer join operation grandparentoperation on grandparentoperation.name = parentoperation.owner_id
-      left outer join operation sibling on sibling.owner_id = parentoperation.name
-      left outer join operationmaterial siblingoperationmaterial on siblingoperationmaterial.operation_id = sibling.name
-      left outer join operationresource siblingoperationresource on siblingoperationresource.operation_id = sibling.name
-      where operation.type in ('time_per','fixed_time')
-      %s
-      group by operation.name, parentoperation.name, sibling.name, grandparentoperation.name
-      ) t
-      union all
-      -- DISTRIBUTION OPERATIONS
-      select 'Ship '||item.name||' from '||itemdistribution.origin_id||' to '||itemdistribution.location_id,    
-      itemdistribution.location_id,
-      'distribution' as type,
-      null as priority,
-      jsonb_build_object(item.name||' @ '||itemdistribution.origin_id, -1,
-                         item.name||' @ '||itemdistribution.location_id, 1) as operation_om,                      
-      case when itemdistribution.resource_id is not null 
-      then jsonb_build_object(itemdistribution.resource_id, itemdistribution.resource_qty) 
-      else '{}'::jsonb end operation_or,
-      leadtime as duration,
-      null as duration_per,
-      null,
-      null,
-      null,
-      null,
-      null
-      from itemdistribution
-      inner join item parent on parent.name = itemdistribution.item_id
-      inner join item on item.name = %%s and item.lft between parent.lft and parent.rght 
-      """ % (
-            (
-                """
-                and (operation.item_id = %s or 
-                (operationmaterial.item_id = %s and operationmaterial.quantity > 0)
-                or parentoperation.item_id = %s
-                or grandparentoperation.item_id = %s)
-            """,
-            )
-            if not downstream
-            else (
-                """
-                and exists (select 1 from operationmaterial om where om.operation_id = operation.name
-                and om.item_id = %s and om.quantity < 0)
-            """,
-            )
-        )
-
-        if not downstream:
-            query = (
-                query
-                + """
-        union all
-      -- PURCHASING OPERATIONS
-      select 'Purchase '||item.name||' @ '|| location.name||' from '||itemsupplier.supplier_id,
-      location.name as location_id,
-      'purchase' as type,
-      null as priority,
-      jsonb_build_object(item.name||' @ '|| location.name,1),
-      case when itemsupplier.resource_id is not null then jsonb_build_object(itemsupplier.resource_id, itemsupplier.resource_qty) else '{}'::jsonb end resources,
-      itemsupplier.leadtime as duration,
-      null as duration_per,
-      null,
-      null,
-      null,
-      null,
-      null
-      from itemsupplier
-      inner join item i_parent on i_parent.name = itemsupplier.item_id
-      inner join item on item.name = %s and item.lft between i_parent.lft and i_parent.rght
-      inner join location l_parent on l_parent.name = itemsupplier.location_id
-      inner join location on location.lft between l_parent.lft and l_parent.rght
-      union all
-      select 'Purchase '||item.name||' @ '|| location.name||' from '||itemsupplier.supplier_id,
-      location.name as location_id,
-      'purchase' as type,
-      null as priority,
-      jsonb_build_object(item.name||' @ '|| location.name,1),
-      case when itemsupplier.resource_id is not null then jsonb_build_object(itemsupplier.resource_id, itemsupplier.resource_qty) else '{}'::jsonb end resources,
-      itemsupplier.leadtime as duration,
-      null as duration_per,
-      null,
-      null,
-      null,
-      null,
-      null
-      from itemsupplier
-      inner join item i_parent on i_parent.name = itemsupplier.item_id
-      inner join item on item.name = %s and item.lft between i_parent.lft and i_parent.rght
-      inner join location on location.lft = location.rght - 1
-      where location_id is null
-      """
-            )
-
-        query = query + " order by 4"
-
-        if downstream:
-            cursor.execute(query, (item_name,) * 2)
-        else:
-            cursor.execute(query, (item_name,) * 7)
-
-        for i in cursor.fetchall():
+        for i in request.supplypath.getOperationsFromItem(item_name, downstream):
             for j in reportclass.processRecord(i, request, depth, downstream):
                 yield j
 
@@ -382,387 +282,21 @@ class PathReport(GridReport):
     def getOperationFromResource(
         reportclass, request, resource_name, downstream, depth
     ):
-        cursor = connections[request.database].cursor()
-        query = """      
-      -- MANUFACTURING OPERATIONS
-      select distinct 
-      case when parentoperation is null then operation else sibling end,
-      case when parentoperation is null then operation_location else sibling_location end,
-      case when parentoperation is null then operation_type else sibling_type end,
-      case when parentoperation is null then operation_priority else sibling_priority end,
-      case when parentoperation is null then operation_om else sibling_om end,
-      case when parentoperation is null then operation_or else sibling_or end,
-      case when parentoperation is null then operation_duration else sibling_duration end,
-      case when parentoperation is null then operation_duration_per else sibling_duration_per end,
-      parentoperation,
-      parentoperation_type,
-      parentoperation_priority,
-      grandparentoperation,
-      grandparentoperation_type from
-      (
-      select operation.name as operation, 
-           operation.type operation_type,
-           operation.location_id operation_location,
-           operation.priority as operation_priority, 
-           operation.duration as operation_duration, 
-           operation.duration_per as operation_duration_per,
-           case when operation.item_id is not null then jsonb_build_object(operation.item_id||' @ '||operation.location_id, 1) else '{}'::jsonb end
-           ||jsonb_object_agg(operationmaterial.item_id||' @ '||operation.location_id, operationmaterial.quantity) filter (where operationmaterial.id is not null) as operation_om,
-           jsonb_object_agg(operationresource.resource_id, operationresource.quantity) filter (where operationresource.id is not null) as operation_or,
-             parentoperation.name as parentoperation, 
-           parentoperation.type as parentoperation_type,
-           parentoperation.priority parentoperation_priority,
-             sibling.name as sibling, 
-           sibling.type as sibling_type,
-           sibling.location_id as sibling_location,
-           sibling.priority as sibling_priority, 
-           sibling.duration as sibling_duration, 
-           sibling.duration_per as sibling_duration_per,
-           case when grandparentoperation.item_id is not null 
-           and sibling.priority = (select max(priority) from operation where owner_id = parentoperation.name) 
-           then jsonb_build_object(grandparentoperation.item_id||' @ '||grandparentoperation.location_id, 1) else '{}'::jsonb end
-           ||case when parentoperation.item_id is not null 
-           and sibling.priority = (select max(priority) from operation where owner_id = parentoperation.name) 
-           then jsonb_build_object(parentoperation.item_id||' @ '||parentoperation.location_id, 1) else '{}'::jsonb end
-           ||case when sibling.item_id is not null then jsonb_build_object(sibling.item_id||' @ '||sibling.location_id, 1) else '{}'::jsonb end
-           || coalesce(jsonb_object_agg(siblingoperationmaterial.item_id||' @ '||sibling.location_id, siblingoperationmaterial.quantity)filter (where siblingoperationmaterial.id is not null), '{}'::jsonb) as sibling_om,
-           jsonb_object_agg(siblingoperationresource.resource_id, siblingoperationresource.quantity)filter (where siblingoperationresource.id is not null) as sibling_or,
-             grandparentoperation.name as grandparentoperation, 
-           grandparentoperation.type as grandparentoperation_type
-      from operation
-      left outer join operationmaterial on operationmaterial.operation_id = operation.name
-      left outer join operationresource on operationresource.operation_id = operation.name
-      left outer join operation parentoperation on parentoperation.name = operation.owner_id
-      left outer join operation grandparentoperation on grandparentoperation.name = parentoperation.owner_id
-      left outer join operation sibling on sibling.owner_id = parentoperation.name      
-      left outer join operationmaterial siblingoperationmaterial on siblingoperationmaterial.operation_id = sibling.name
-      left outer join operationresource siblingoperationresource on siblingoperationresource.operation_id = sibling.name
-      where operation.type in ('time_per','fixed_time')
-      and %s
-      group by operation.name, parentoperation.name, sibling.name, grandparentoperation.name
-      ) t
-      union all
-      -- DISTRIBUTION OPERATIONS
-      select 'Ship '||item.name||' from '||itemdistribution.origin_id||' to '||itemdistribution.location_id,    
-      itemdistribution.location_id,
-      'distribution' as type,
-      null as priority,
-      jsonb_build_object(item.name||' @ '||itemdistribution.origin_id, -1,
-                         item.name||' @ '||itemdistribution.location_id, 1) as operation_om,                      
-      case when itemdistribution.resource_id is not null 
-      then jsonb_build_object(itemdistribution.resource_id, itemdistribution.resource_qty) 
-      else '{}'::jsonb end operation_or,
-      leadtime as duration,
-      null as duration_per,
-      null,
-      null,
-      null,
-      null,
-      null
-      from itemdistribution
-      inner join item parent on parent.name = itemdistribution.item_id
-      inner join item on item.lft between parent.lft and parent.rght 
-      where itemdistribution.resource_id = %%s
-      union all
-      -- PURCHASING OPERATIONS
-      select 'Purchase '||item.name||' @ '|| location.name||' from '||itemsupplier.supplier_id,
-      location.name as location_id,
-      'purchase' as type,
-      null as priority,
-      jsonb_build_object(item.name||' @ '|| location.name,1),
-      case when itemsupplier.resource_id is not null then jsonb_build_object(itemsupplier.resource_id, itemsupplier.resource_qty) else '{}'::jsonb end resources,
-      itemsupplier.leadtime as duration,
-      null as duration_per,
-      null,
-      null,
-      null,
-      null,
-      null
-      from itemsupplier
-      inner join item i_parent on i_parent.name = itemsupplier.item_id
-      inner join item on item.lft between i_parent.lft and i_parent.rght
-      inner join location l_parent on l_parent.name = itemsupplier.location_id
-      inner join location on location.lft between l_parent.lft and l_parent.rght
-      where itemsupplier.resource_id = %%s
-      union all
-      select 'Purchase '||item.name||' @ '|| location.name||' from '||itemsupplier.supplier_id,
-      location.name as location_id,
-      'purchase' as type,
-      null as priority,
-      jsonb_build_object(item.name||' @ '|| location.name,1),
-      case when itemsupplier.resource_id is not null then jsonb_build_object(itemsupplier.resource_id, itemsupplier.resource_qty) else '{}'::jsonb end resources,
-      itemsupplier.leadtime as duration,
-      null as duration_per,
-      null,
-      null,
-      null,
-      null,
-      null
-      from itemsupplier
-      inner join item i_parent on i_parent.name = itemsupplier.item_id
-      inner join item on item.lft between i_parent.lft and i_parent.rght
-      inner join location on location.lft = location.rght - 1
-      where location_id is null and itemsupplier.resource_id = %%s
-      order by 4
-      """ % (
-            "operationresource.resource_id = %s"
-            if downstream == False
-            else """
-             exists (select 1 from operationresource where operation_id = operation.name and resource_id = %s)      
-            """
-        )
-
-        cursor.execute(query, (resource_name,) * 4)
-
-        for i in cursor.fetchall():
+        for i in request.supplypath.getOperationsFromResource(resource_name):
             for j in reportclass.processRecord(i, request, depth, downstream):
                 yield j
 
     @classmethod
     def getOperationFromName(reportclass, request, operation_name, downstream, depth):
-        cursor = connections[request.database].cursor()
-        query = """      
-      -- MANUFACTURING OPERATIONS
-      select distinct 
-      case when parentoperation is null then operation else sibling end,
-      case when parentoperation is null then operation_location else sibling_location end,
-      case when parentoperation is null then operation_type else sibling_type end,
-      case when parentoperation is null then operation_priority else sibling_priority end,
-      case when parentoperation is null then operation_om else sibling_om end,
-      case when parentoperation is null then operation_or else sibling_or end,
-      case when parentoperation is null then operation_duration else sibling_duration end,
-      case when parentoperation is null then operation_duration_per else sibling_duration_per end,
-      parentoperation,
-      parentoperation_type,
-      parentoperation_priority,
-      grandparentoperation,
-      grandparentoperation_type from
-      (
-      select operation.name as operation, 
-           operation.type operation_type,
-           operation.location_id operation_location,
-           operation.priority as operation_priority, 
-           operation.duration as operation_duration, 
-           operation.duration_per as operation_duration_per,
-           case when operation.item_id is not null then jsonb_build_object(operation.item_id||' @ '||operation.location_id, 1) else '{}'::jsonb end
-           ||jsonb_object_agg(operationmaterial.item_id||' @ '||operation.location_id, operationmaterial.quantity) filter (where operationmaterial.id is not null) as operation_om,
-           jsonb_object_agg(operationresource.resource_id, operationresource.quantity) filter (where operationresource.id is not null) as operation_or,
-             parentoperation.name as parentoperation, 
-           parentoperation.type as parentoperation_type,
-           parentoperation.priority parentoperation_priority,
-             sibling.name as sibling, 
-           sibling.type as sibling_type,
-           sibling.location_id as sibling_location,
-           sibling.priority as sibling_priority, 
-           sibling.duration as sibling_duration, 
-           sibling.duration_per as sibling_duration_per,
-           case when grandparentoperation.item_id is not null 
-           and sibling.priority = (select max(priority) from operation where owner_id = parentoperation.name) 
-           then jsonb_build_object(grandparentoperation.item_id||' @ '||grandparentoperation.location_id, 1) else '{}'::jsonb end
-           ||case when parentoperation.item_id is not null 
-           and sibling.priority = (select max(priority) from operation where owner_id = parentoperation.name) 
-           then jsonb_build_object(parentoperation.item_id||' @ '||parentoperation.location_id, 1) else '{}'::jsonb end
-           ||case when sibling.item_id is not null then jsonb_build_object(sibling.item_id||' @ '||sibling.location_id, 1) else '{}'::jsonb end
-           ||coalesce(jsonb_object_agg(siblingoperationmaterial.item_id||' @ '||sibling.location_id, siblingoperationmaterial.quantity)filter (where siblingoperationmaterial.id is not null), '{}'::jsonb) as sibling_om,
-           jsonb_object_agg(siblingoperationresource.resource_id, siblingoperationresource.quantity)filter (where siblingoperationresource.id is not null) as sibling_or,
-             grandparentoperation.name as grandparentoperation, 
-           grandparentoperation.type as grandparentoperation_type
-      from operation
-      left outer join operationmaterial on operationmaterial.operation_id = operation.name
-      left outer join operationresource on operationresource.operation_id = operation.name
-      left outer join operation parentoperation on parentoperation.name = operation.owner_id
-      left outer join operation grandparentoperation on grandparentoperation.name = parentoperation.owner_id
-      left outer join operation sibling on sibling.owner_id = parentoperation.name
-      left outer join operationmaterial siblingoperationmaterial on siblingoperationmaterial.operation_id = sibling.name
-      left outer join operationresource siblingoperationresource on siblingoperationresource.operation_id = sibling.name
-      where operation.type in ('time_per','fixed_time')
-      and (operation.name = %s or parentoperation.name = %s or grandparentoperation.name = %s)
-      group by operation.name, parentoperation.name, sibling.name, grandparentoperation.name
-      ) t
-      order by 4
-      """
-
-        cursor.execute(query, (operation_name,) * 3)
-
-        for i in cursor.fetchall():
+        for i in request.supplypath.getOperationsFromName(operation_name):
             for j in reportclass.processRecord(i, request, depth, downstream):
                 yield j
 
     @classmethod
     def getOperationFromBuffer(reportclass, request, buffer_name, downstream, depth):
-        cursor = connections[request.database].cursor()
         item = buffer_name[0 : buffer_name.find(" @ ")]
         location = buffer_name[buffer_name.find(" @ ") + 3 :]
-        query = """      
-      -- MANUFACTURING OPERATIONS
-      select distinct 
-      case when parentoperation is null then operation else sibling end,
-      case when parentoperation is null then operation_location else sibling_location end,
-      case when parentoperation is null then operation_type else sibling_type end,
-      case when parentoperation is null then operation_priority else sibling_priority end,
-      case when parentoperation is null then operation_om else sibling_om end,
-      case when parentoperation is null then operation_or else sibling_or end,
-      case when parentoperation is null then operation_duration else sibling_duration end,
-      case when parentoperation is null then operation_duration_per else sibling_duration_per end,
-      parentoperation,
-      parentoperation_type,
-      parentoperation_priority,
-      grandparentoperation,
-      grandparentoperation_type from
-      (
-      select operation.name as operation, 
-           operation.type operation_type,
-           operation.location_id operation_location,
-           operation.priority as operation_priority, 
-           operation.duration as operation_duration, 
-           operation.duration_per as operation_duration_per,
-           case when operation.item_id is not null then jsonb_build_object(operation.item_id||' @ '||operation.location_id, 1) else '{}'::jsonb end
-           ||jsonb_object_agg(operationmaterial.item_id||' @ '||operation.location_id, operationmaterial.quantity) filter (where operationmaterial.id is not null) as operation_om,
-           jsonb_object_agg(operationresource.resource_id, operationresource.quantity) filter (where operationresource.id is not null) as operation_or,
-             parentoperation.name as parentoperation, 
-           parentoperation.type as parentoperation_type,
-           parentoperation.priority parentoperation_priority,
-             sibling.name as sibling, 
-           sibling.type as sibling_type,
-           sibling.location_id as sibling_location,
-           sibling.priority as sibling_priority, 
-           sibling.duration as sibling_duration, 
-           sibling.duration_per as sibling_duration_per,
-           case when grandparentoperation.item_id is not null 
-           and sibling.priority = (select max(priority) from operation where owner_id = parentoperation.name) 
-           then jsonb_build_object(grandparentoperation.item_id||' @ '||grandparentoperation.location_id, 1) else '{}'::jsonb end
-           ||case when parentoperation.item_id is not null 
-           and sibling.priority = (select max(priority) from operation where owner_id = parentoperation.name) 
-           then jsonb_build_object(parentoperation.item_id||' @ '||parentoperation.location_id, 1) else '{}'::jsonb end
-           ||case when sibling.item_id is not null then jsonb_build_object(sibling.item_id||' @ '||sibling.location_id, 1) else '{}'::jsonb end
-           ||coalesce(jsonb_object_agg(siblingoperationmaterial.item_id||' @ '||sibling.location_id, siblingoperationmaterial.quantity)filter (where siblingoperationmaterial.id is not null), '{}'::jsonb) as sibling_om,
-           jsonb_object_agg(siblingoperationresource.resource_id, siblingoperationresource.quantity)filter (where siblingoperationresource.id is not null) as sibling_or,
-             grandparentoperation.name as grandparentoperation, 
-           grandparentoperation.type as grandparentoperation_type
-      from operation
-      left outer join operationmaterial on operationmaterial.operation_id = operation.name
-      left outer join operationresource on operationresource.operation_id = operation.name
-      left outer join operation parentoperation on parentoperation.name = operation.owner_id
-      left outer join operation grandparentoperation on grandparentoperation.name = parentoperation.owner_id
-      left outer join operation sibling on sibling.owner_id = parentoperation.name
-      left outer join operationmaterial siblingoperationmaterial on siblingoperationmaterial.operation_id = sibling.name
-      left outer join operationresource siblingoperationresource on siblingoperationresource.operation_id = sibling.name
-      where operation.type in ('time_per','fixed_time')
-      and operation.location_id = %%s
-      %s
-      group by operation.name, parentoperation.name, sibling.name, grandparentoperation.name
-      ) t
-      union all
-      -- DISTRIBUTION OPERATIONS
-      select 'Ship '||item.name||' from '||itemdistribution.origin_id||' to '||itemdistribution.location_id,    
-      itemdistribution.location_id,
-      'distribution' as type,
-      null as priority,
-      jsonb_build_object(item.name||' @ '||itemdistribution.origin_id, -1,
-                         item.name||' @ '||itemdistribution.location_id, 1) as operation_om,                      
-      case when itemdistribution.resource_id is not null 
-      then jsonb_build_object(itemdistribution.resource_id, itemdistribution.resource_qty) 
-      else '{}'::jsonb end operation_or,
-      leadtime as duration,
-      null as duration_per,
-      null,
-      null,
-      null,
-      null,
-      null
-      from itemdistribution
-      inner join item parent on parent.name = itemdistribution.item_id
-      inner join item on item.name = %%s and item.lft between parent.lft and parent.rght 
-      where itemdistribution.%s = %%s
-      """ % (
-            (
-                """
-                and (operation.item_id = %s or 
-                (operationmaterial.item_id = %s and operationmaterial.quantity > 0)
-                or parentoperation.item_id = %s
-                or grandparentoperation.item_id = %s)
-            """,
-                "location_id",
-            )
-            if not downstream
-            else (
-                """
-                and exists (select 1 from operationmaterial om where om.operation_id = operation.name
-                and om.item_id = %s and om.quantity < 0)
-            """,
-                "origin_id",
-            )
-        )
-
-        if not downstream:
-            query = (
-                query
-                + """
-        union all
-      -- PURCHASING OPERATIONS
-      select 'Purchase '||item.name||' @ '|| location.name||' from '||itemsupplier.supplier_id,
-      location.name as location_id,
-      'purchase' as type,
-      null as priority,
-      jsonb_build_object(item.name||' @ '|| location.name,1),
-      case when itemsupplier.resource_id is not null then jsonb_build_object(itemsupplier.resource_id, itemsupplier.resource_qty) else '{}'::jsonb end resources,
-      itemsupplier.leadtime as duration,
-      null as duration_per,
-      null,
-      null,
-      null,
-      null,
-      null
-      from itemsupplier
-      inner join item i_parent on i_parent.name = itemsupplier.item_id
-      inner join item on item.name = %s and item.lft between i_parent.lft and i_parent.rght
-      inner join location l_parent on l_parent.name = itemsupplier.location_id
-      inner join location on location.name = %s and location.lft between l_parent.lft and l_parent.rght
-      union all
-      select 'Purchase '||item.name||' @ '|| location.name||' from '||itemsupplier.supplier_id,
-      location.name as location_id,
-      'purchase' as type,
-      null as priority,
-      jsonb_build_object(item.name||' @ '|| location.name,1),
-      case when itemsupplier.resource_id is not null then jsonb_build_object(itemsupplier.resource_id, itemsupplier.resource_qty) else '{}'::jsonb end resources,
-      itemsupplier.leadtime as duration,
-      null as duration_per,
-      null,
-      null,
-      null,
-      null,
-      null
-      from itemsupplier
-      inner join item i_parent on i_parent.name = itemsupplier.item_id
-      inner join item on item.name = %s and item.lft between i_parent.lft and i_parent.rght
-      inner join location on location.name = %s and location.lft = location.rght - 1
-      where location_id is null
-      """
-            )
-
-        query = query + " order by 4"
-
-        if downstream:
-            cursor.execute(query, (location, item, item, location))
-        else:
-            cursor.execute(
-                query,
-                (
-                    location,
-                    item,
-                    item,
-                    item,
-                    item,
-                    item,
-                    location,
-                    item,
-                    location,
-                    item,
-                    location,
-                ),
-            )
-
-        for i in cursor.fetchall():
+        for i in request.supplypath.getOperationsFromBuffer(item, location, downstream):
             for j in reportclass.processRecord(i, request, depth, downstream):
                 yield j
 
@@ -778,9 +312,9 @@ class PathReport(GridReport):
             reportclass.operation_id = reportclass.operation_id + 1
             reportclass.operation_dict[i[11]] = reportclass.operation_id
             if i[11] not in reportclass.suboperations_count_dict:
-                reportclass.suboperations_count_dict[i[11]] = Operation.objects.filter(
-                    owner_id=i[11]
-                ).count()
+                reportclass.suboperations_count_dict[
+                    i[11]
+                ] = request.supplypath.getSuboperationCount(i[11])
             grandparentoperation = {
                 "depth": depth * 2,
                 "id": reportclass.operation_id,
@@ -808,9 +342,9 @@ class PathReport(GridReport):
             reportclass.operation_id = reportclass.operation_id + 1
             reportclass.operation_dict[i[8]] = reportclass.operation_id
             if i[8] not in reportclass.suboperations_count_dict:
-                reportclass.suboperations_count_dict[i[8]] = Operation.objects.filter(
-                    owner_id=i[8]
-                ).count()
+                reportclass.suboperations_count_dict[
+                    i[8]
+                ] = request.supplypath.getSuboperationCount(i[8])
             if i[11]:
                 if i[11] in reportclass.parent_count_dict:
                     reportclass.parent_count_dict[i[11]] = (
@@ -903,9 +437,8 @@ class PathReport(GridReport):
         """
         A function that recurses upstream or downstream in the supply chain.
         """
-        # Update item and location hierarchies
-        Item.rebuildHierarchy(database=request.database)
-        Location.rebuildHierarchy(database=request.database)
+        # Graph of the supply chain, kept on the request as it depends on the scenario
+        request.supplypath = SupplyPath.get(request.database)
 
         # dictionary to retrieve the operation id from its name
         reportclass.operation_dict = {}
@@ -4275,8 +3808,8 @@ class PurchaseOrderList(OperationPlanMixin, GridReport):
             elif path == "supplier" or request.path.startswith(
                 "/detail/input/supplier/"
             ):
+                Supplier.updateHierarchy(database=request.database)
                 try:
-                    Supplier.rebuildHierarchy(database=request.database)
                     sup = (
                         Supplier.objects.all().using(request.database).get(name=args[0])
                     )
@@ -4285,12 +3818,16 @@ class PurchaseOrderList(OperationPlanMixin, GridReport):
                 except Supplier.DoesNotExist:
                     lft = 1
                     rght = 1
-                q = q.filter(supplier__lft__gte=lft, supplier__rght__lte=rght)
+                if lft is None:
+                    # The hierarchy is being rebuilt
+                    q = q.filter(supplier__name=args[0])
+                else:
+                    q = q.filter(supplier__lft__gte=lft, supplier__rght__lte=rght)
             elif path == "location" or request.path.startswith(
                 "/detail/input/location/"
             ):
+                Location.updateHierarchy(database=request.database)
                 try:
-                    Location.rebuildHierarchy(database=request.database)
                     loc = (
                         Location.objects.all().using(request.database).get(name=args[0])
                     )
@@ -4299,17 +3836,25 @@ class PurchaseOrderList(OperationPlanMixin, GridReport):
                 except Location.DoesNotExist:
                     lft = 1
                     rght = 1
-                q = q.filter(location__lft__gte=lft, location__rght__lte=rght)
+                if lft is None:
+                    # The hierarchy is being rebuilt
+                    q = q.filter(location__name=args[0])
+                else:
+                    q = q.filter(location__lft__gte=lft, location__rght__lte=rght)
             elif path == "item" or request.path.startswith("/detail/input/item/"):
+                Item.updateHierarchy(database=request.database)
                 try:
-                    Item.rebuildHierarchy(database=request.database)
                     itm = Item.objects.all().using(request.database).get(name=args[0])
                     lft = itm.lft
                     rght = itm.rght
                 except Item.DoesNotExist:
                     lft = 1
                     rght = 1
-                q = q.filter(item__lft__gte=lft, item__rght__lte=rght)
+                if lft is None:
+                    # The hierarchy is being rebuilt
+                    q = q.filter(item__name=args[0])
+                else:
+                    q = q.filter(item__lft__gte=lft, item__rght__lte=rght)
 
         q = reportclass.operationplanExtraBasequery(q.select_related("item"), request)
         return q.annotate(
@@ -18,14 +18,20 @@ import base64
 import email
 import jwt
 import os
+import shutil
+import tempfile
+from threading import Event, Thread
 import time
 import logging
 from urllib.request import urlopen, HTTPError, Request
+import zlib
+from xml.etree.cElementTree import iterparse
 from xml.sax.saxutils import quoteattr
 
 from django.utils.http import urlencode
 
-from django.db import DEFAULT_DB_ALIAS
+from django.apps import apps
+from django.db import connections, DEFAULT_DB_ALIAS
 from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 
@@ -35,6 +41,110 @@ from freppledb.input.commands import LoadTask
 
 logger = logging.getLogger(__name__)
 
+# Size of the blocks read from and written to the network
+chunksize = 64 * 1024
+
+# Size above which the plan uploaded to odoo is spooled to disk
+spoolsize = 16 * 1024 * 1024
+
+
+def readXMLresponse(response, callback=None):
+    """
+    Parses the XML data of an HTTP response while it is being downloaded.
+
+    The response is decompressed when it uses gzip content encoding.
+    The data is passed to the parser through a named pipe. On platforms
+    without named pipes, the data is written to a temporary file first.
+    The same happens when a callback function is passed: it is called with
+    the name of the temporary file before the data is parsed.
+    """
+    import frepple
+
+    if response.headers.get("Content-Encoding", None) == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+        decompressor = None
+
+    stopped = Event()
+
+    def copyData(f):
+        while not stopped.is_set():
+            data = response.read(chunksize)
+            if not data:
+                break
+            f.write(decompressor.decompress(data) if decompressor else data)
+        if decompressor:
+            f.write(decompressor.flush())
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "odoo.xml")
+        if callback or not hasattr(os, "mkfifo"):
+            with open(filename, "wb") as f:
+                copyData(f)
+            if callback:
+                callback(filename)
+            frepple.readXMLfile(filename, False, False)
+            return
+
+        errors = []
+
+        def writer():
+            try:
+                with open(filename, "wb") as f:
+                    copyData(f)
+            except BrokenPipeError:
+                # The parser stopped reading
+                pass
+            except Exception as e:
+                errors.append(e)
+
+        os.mkfifo(filename)
+        t = Thread(target=writer, daemon=True)
+        t.start()
+        try:
+            frepple.readXMLfile(filename, False, False)
+        finally:
+            # When the parser stopped before the end of the data, we read
+            # from the pipe until the writer notices it needs to stop
+            stopped.set()
+            fd = os.open(filename, os.O_RDONLY | os.O_NONBLOCK)
+            try:
+                while t.is_alive():
+                    try:
+                        os.read(fd, chunksize)
+                    except BlockingIOError:
+                        pass
+                    t.join(0.1)
+            finally:
+                os.close(fd)
+        if errors:
+            raise errors[0]
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def writeXMLdata(f, data, compress=False):
+    """
+    Writes the strings returned by a generator to a binary file, one per
+    line, in blocks. The data is optionally compressed in gzip format.
+    """
+    if compress:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    buf = []
+    size = 0
+    for i in data:
+        buf.append(i)
+        buf.append("\n")
+        size += len(i) + 1
+        if size >= chunksize:
+            block = "".join(buf).encode("utf-8")
+            f.write(compressor.compress(block) if compress else block)
+            buf = []
+            size = 0
+    block = "".join(buf).encode("utf-8")
+    f.write(compressor.compress(block) + compressor.flush() if compress else block)
+
 
 @PlanTaskRegistry.register
 class OdooReadData(PlanTask):
@@ -52,37 +162,71 @@ class OdooReadData(PlanTask):
       can be transferred during automated scheduled runs at a quiet moment.
   Which data elements belong to each category is determined in the Odoo
   addon module and can vary between implementations.
+
+  With the odoo_delta argument only the data changed since the previous load
+  is read from Odoo. The data of the previous loads is then read from the
+  database rather than being excluded from the load.
   """
 
     description = "Load Odoo data"
     sequence = 119
     label = ("odoo_read_1", _("Read Odoo data"))
 
+    # Odoo timestamp of the previous load when loading the changes only
+    since = None
+
+    # Odoo timestamp of this load
+    timestamp = None
+
+    # Operationplans removed by an incremental load
+    removed = []
+
     @classmethod
     def getWeight(cls, database=DEFAULT_DB_ALIAS, **kwargs):
         for i in range(5):
             if ("odoo_read_%s" % i) in os.environ:
                 cls.mode = i
-                for stdLoad in PlanTaskRegistry.reg:
-                    if issubclass(stdLoad, LoadTask):
-                        stdLoad.filter = (
-                            "(source is null or source<>'odoo_%s')" % cls.mode
+                cls.since = None
+                if "odoo_delta" in os.environ:
+                    cls.since = Parameter.getValue(
+                        "odoo.timestamp_mode_%s" % cls.mode, database, None
+                    )
+                    if not cls.since:
+                        logger.warning(
+                            "No previous load from odoo found: loading all data"
                         )
-                        stdLoad.description += " - non-odoo source"
+                if not cls.since:
+                    for stdLoad in PlanTaskRegistry.reg:
+                        if issubclass(stdLoad, LoadTask):
+                            stdLoad.filter = (
+                                "(source is null or source not in ('odoo_%s', 'odoo_%s_delta'))"
+                                % (cls.mode, cls.mode)
+                            )
+                            stdLoad.description += " - non-odoo source"
                 return 1
         else:
             return -1
 
+    @classmethod
+    def findRemovals(cls, filename):
+        """
+        Collects the operationplans removed by an incremental load.
+        """
+        for event, elem in iterparse(filename):
+            if elem.tag == "operationplan":
+                if elem.get("action", None) == "R":
+                    cls.removed.append(elem.get("reference"))
+                elem.clear()
+
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
         import frepple
 
         # Uncomment the following lines to bypass the connection to odoo and use
         # a XML flat file alternative. This can be useful for debugging.
-        # with open("my_path/my_data_file.xml", 'rb') as f:
-        #  frepple.readXMLdata(f.read().decode('utf-8'), False, False)
-        #  frepple.printsize()
-        #  return
+        # frepple.readXMLfile("my_path/my_data_file.xml", False, False)
+        # frepple.printsize()
+        # return
 
         odoo_user = Parameter.getValue("odoo.user", database)
         odoo_password = settings.ODOO_PASSWORDS.get(database, None)
@@ -129,30 +273,37 @@ class OdooReadData(PlanTask):
                 break
 
         # Connect to the odoo URL to GET data
-        url = "%sfrepple/xml?%s" % (
-            odoo_url,
-            urlencode(
-                {
-                    "database": odoo_db,
-                    "language": odoo_language,
-                    "company": odoo_company,
-                    "mode": cls.mode,
-                }
-            ),
-        )
+        args = {
+            "database": odoo_db,
+            "language": odoo_language,
+            "company": odoo_company,
+            "mode": cls.mode,
+        }
+        if cls.since:
+            args["since"] = cls.since
+        url = "%sfrepple/xml?%s" % (odoo_url, urlencode(args))
         try:
             request = Request(url)
             encoded = base64.encodestring(
                 ("%s:%s" % (odoo_user, odoo_password)).encode("utf-8")
             )[:-1]
             request.add_header("Authorization", "Basic %s" % encoded.decode("ascii"))
+            request.add_header("Accept-Encoding", "gzip")
         except HTTPError as e:
             logger.error("Error connecting to odoo at %s: %s" % (url, e))
             raise e
 
         # Download and parse XML data
+        cls.removed = []
         with urlopen(request) as f:
-            frepple.readXMLdata(f.read().decode("utf-8"), False, False)
+            cls.timestamp = f.headers.get("X-Frepple-Timestamp", None)
+            if cls.since:
+                if not cls.timestamp:
+                    raise Exception("The Odoo addon doesn't support incremental loads")
+                logger.info("Loading the changes in odoo since %s" % cls.since)
+                readXMLresponse(f, callback=cls.findRemovals)
+            else:
+                readXMLresponse(f)
 
         # Assure single root hierarchies
         for r in frepple.items():
@@ -182,11 +333,70 @@ class OdooSaveStatic(PlanTask):
         else:
             return -1
 
+    @classmethod
+    def renameSource(cls, database, old, new):
+        with connections[database].cursor() as cursor:
+            tables = set()
+            for m in apps.get_app_config("input").get_models():
+                if m._meta.db_table not in tables and any(
+                    f.name == "source" for f in m._meta.fields
+                ):
+                    tables.add(m._meta.db_table)
+                    cursor.execute(
+                        "update %s set source = %%s where source = %%s"
+                        % connections[database].ops.quote_name(m._meta.db_table),
+                        (new, old),
+                    )
+
+    @classmethod
+    def deleteOperationplans(cls, database, references, source):
+        with connections[database].cursor() as cursor:
+            for table in ("operationplanmaterial", "operationplanresource"):
+                cursor.execute(
+                    """
+                    delete from %s
+                    where operationplan_id in (
+                      select reference from operationplan
+                      where reference = any(%%s) or owner_id = any(%%s)
+                      )
+                    """
+                    % table,
+                    (references, references),
+                )
+            cursor.execute(
+                "delete from operationplan where owner_id = any(%s)", (references,)
+            )
+            cursor.execute(
+                "delete from operationplan where reference = any(%s) and source = %s",
+                (references, source),
+            )
+
     @classmethod
     def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
         from freppledb.execute.export_database_static import exportStaticModel
 
-        exportStaticModel(database=database, source="odoo_%s" % cls.mode).run()
+        # Objects of an incremental load are marked with a separate source.
+        # Only these are saved, after which they get the normal odoo source.
+        source = "odoo_%s" % cls.mode
+        cls.renameSource(database, "%s_delta" % source, source)
+        if OdooReadData.since:
+            exportStaticModel(database=database, source="%s_delta" % source).run()
+            cls.renameSource(database, "%s_delta" % source, source)
+            if OdooReadData.removed:
+                cls.deleteOperationplans(database, OdooReadData.removed, source)
+        else:
+            exportStaticModel(database=database, source=source).run()
+
+        # Remember the odoo timestamp for the next incremental load
+        if OdooReadData.timestamp:
+            Parameter.objects.using(database).update_or_create(
+                name="odoo.timestamp_mode_%s" % cls.mode,
+                defaults={
+                    "value": OdooReadData.timestamp,
+                    "description": "Odoo connector: Odoo time of the last load in mode %s. Incremental loads read the changes since then."
+                    % cls.mode,
+                },
+            )
 
 
 @PlanTaskRegistry.register
@@ -272,33 +482,40 @@ class OdooWritePlan(PlanTask):
         # results in XML-format.
         # TODO respect the parameters odoo.filter_export_purchase_order, odoo.filter_export_manufacturing_order, odoo.filter_export_distribution_order
         # these are python expressions - attack-sensitive evaluation!
-        def publishPlan(cls):
-            yield "--%s\r" % boundary
-            yield 'Content-Disposition: form-data; name="webtoken"\r'
-            yield "\r"
-            yield "%s\r" % jwt.encode(
+        def publishForm(compress):
+            yield "--%s" % boundary
+            yield 'Content-Disposition: form-data; name="webtoken"'
+            yield ""
+            yield "%s" % jwt.encode(
                 {"exp": round(time.time()) + 600, "user": odoo_user},
                 settings.DATABASES[database].get(
                     "SECRET_WEBTOKEN_KEY", settings.SECRET_KEY
                 ),
                 algorithm="HS256",
             ).decode("ascii")
-            yield "--%s\r" % boundary
-            yield 'Content-Disposition: form-data; name="database"\r'
-            yield "\r"
-            yield "%s\r" % odoo_db
-            yield "--%s\r" % boundary
-            yield 'Content-Disposition: form-data; name="language"\r'
-            yield "\r"
-            yield "%s\r" % odoo_language
-            yield "--%s\r" % boundary
-            yield 'Content-Disposition: form-data; name="company"\r'
-            yield "\r"
-            yield "%s\r" % odoo_company
-            yield "--%s\r" % boundary
-            yield 'Content-Disposition: file; name="frePPLe plan"; filename="frepple_plan.xml"\r'
-            yield "Content-Type: application/xml\r"
-            yield "\r"
+            yield "--%s" % boundary
+            yield 'Content-Disposition: form-data; name="database"'
+            yield ""
+            yield "%s" % odoo_db
+            yield "--%s" % boundary
+            yield 'Content-Disposition: form-data; name="language"'
+            yield ""
+            yield "%s" % odoo_language
+            yield "--%s" % boundary
+            yield 'Content-Disposition: form-data; name="company"'
+            yield ""
+            yield "%s" % odoo_company
+            yield "--%s" % boundary
+            if compress:
+                yield 'Content-Disposition: file; name="frePPLe plan"; filename="frepple_plan.xml.gz"'
+                yield "Content-Type: application/gzip"
+            else:
+                yield 'Content-Disposition: file; name="frePPLe plan"; filename="frepple_plan.xml"'
+                yield "Content-Type: application/xml"
+            yield ""
+            yield ""
+
+        def publishPlan(cls):
             yield '<?xml version="1.0" encoding="UTF-8" ?>'
             yield '<plan xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
             # Export relevant operationplans
@@ -349,32 +566,41 @@ class OdooWritePlan(PlanTask):
                     )
             yield "</operationplans>"
             yield "</plan>"
-            yield "--%s--\r" % boundary
-            yield "\r"
 
         # Connect to the odoo URL to POST data
         try:
             cls.exported = []
-            body = "\n".join(publishPlan(cls)).encode("utf-8")
-            size = len(body)
+            compress = (
+                Parameter.getValue("odoo.compression", database, "false").lower()
+                == "true"
+            )
             encoded = base64.encodestring(
                 ("%s:%s" % (odoo_user, odoo_password)).encode("utf-8")
             )
-            req = Request(
-                "%sfrepple/xml/" % odoo_url,
-                data=body,
-                headers={
-                    "Authorization": "Basic %s" % encoded.decode("ascii")[:-1],
-                    "Content-Type": "multipart/form-data; boundary=%s" % boundary,
-                    "Content-length": size,
-                },
-            )
-
-            # Posting the data and displaying the server response
-            logger.info("Uploading %d bytes of planning results to odoo" % size)
-            with urlopen(req) as f:
-                msg = f.read()
-                logger.info("Odoo response: %s" % msg.decode("utf-8"))
+            with tempfile.SpooledTemporaryFile(max_size=spoolsize) as body:
+                # The message is written to a temporary file first: it stays
+                # in memory when it's small, and is sent in blocks from disk
+                # when it's big.
+                body.write("\r\n".join(publishForm(compress)).encode("utf-8"))
+                writeXMLdata(body, publishPlan(cls), compress)
+                body.write(("\r\n--%s--\r\n" % boundary).encode("utf-8"))
+                size = body.tell()
+                body.seek(0)
+                req = Request(
+                    "%sfrepple/xml/" % odoo_url,
+                    data=body,
+                    headers={
+                        "Authorization": "Basic %s" % encoded.decode("ascii")[:-1],
+                        "Content-Type": "multipart/form-data; boundary=%s" % boundary,
+                        "Content-length": size,
+                    },
+                )
+
+                # Posting the data and displaying the server response
+                logger.info("Uploading %d bytes of planning results to odoo" % size)
+                with urlopen(req) as f:
+                    msg = f.read()
+                    logger.info("Odoo response: %s" % msg.decode("utf-8"))
 
             # Mark the exported operations as approved
             for i in cls.exported:
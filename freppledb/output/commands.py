@@ -15,25 +15,28 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from bisect import bisect_right
 from datetime import timedelta, datetime, date
 import json
 import logging
 import os
-from psycopg2.extensions import adapt
-from psycopg2.extras import execute_batch
 
 from django.db import connections, DEFAULT_DB_ALIAS, transaction
 
-from freppledb.common.commands import (
-    PlanTaskRegistry,
-    PlanTask,
-    clean_value,
-    CopyFromGenerator,
-)
+from freppledb.common.commands import PlanTaskRegistry, PlanTask, CopyEncoder
+from freppledb.common.models import Parameter
 
 logger = logging.getLogger(__name__)
 
 
+def useBinaryCopy(database=DEFAULT_DB_ALIAS):
+    """
+    Returns true when the plan export uses the binary format of the
+    PostgreSQL copy command.
+    """
+    return Parameter.getValue("plan.binaryExport", database, "false").lower() == "true"
+
+
 @PlanTaskRegistry.register
 class TruncatePlan(PlanTask):
 
@@ -55,7 +58,7 @@ class TruncatePlan(PlanTask):
         if cluster == -1:
             # Complete export for the complete model
             cursor.execute(
-                "truncate table out_problem, out_resourceplan, out_constraint"
+                "truncate table out_problem, out_resourceplan, out_constraint, out_inventoryplan, out_pegging"
             )
             cursor.execute(
                 """
@@ -86,45 +89,32 @@ class TruncatePlan(PlanTask):
             cursor.execute(
                 "create temporary table cluster_keys (name character varying(300), constraint cluster_key_pkey primary key (name))"
             )
-            for i in frepple.items():
-                if i.cluster == cluster:
-                    cursor.execute(
-                        (
-                            "insert into cluster_keys (name) values (%s);\n"
-                            % adapt(i.name).getquoted().decode("UTF8")
-                        )
-                    )
+
+            def loadKeys(keys):
+                # All keys are loaded with a single copy statement
+                cursor.execute("truncate table cluster_keys")
+                CopyEncoder("cluster_keys", (("name", "varchar"),)).copy(
+                    cursor, ((k,) for k in keys)
+                )
+                cursor.execute("analyze cluster_keys")
+
+            loadKeys(i.name for i in frepple.items() if i.cluster == cluster)
             cursor.execute(
-                """
-                delete from out_constraint
-                where demand in (
-                  select demand.name
-                  from demand
-                  inner join cluster_keys
-                    on cluster_keys.name = demand.item_id
-                  )
-                """
+                "delete from out_inventoryplan using cluster_keys where item = cluster_keys.name"
             )
             cursor.execute(
                 """
                 delete from operationplanmaterial
-                using cluster_keys
                 where operationplan_id in (
-                  select reference from operationplan
+                  select operationplan.reference
+                  from operationplan
                   inner join cluster_keys on cluster_keys.name = operationplan.item_id
                   union
-                  select reference from operationplan where owner_id in (
-                    select reference from operationplan parent_opplan
-                    inner join cluster_keys on cluster_keys.name = parent_opplan.item_id
-                    )
-                  )
-                """
-            )
-            cursor.execute(
-                """
-                delete from out_problem
-                where entity = 'demand' and owner in (
-                  select demand.name from demand inner join cluster_keys on cluster_keys.name = demand.item_id
+                  select child.reference
+                  from operationplan as child
+                  inner join operationplan as parent_opplan
+                    on parent_opplan.reference = child.owner_id
+                  inner join cluster_keys on cluster_keys.name = parent_opplan.item_id
                   )
                 """
             )
@@ -143,32 +133,27 @@ class TruncatePlan(PlanTask):
                 """
                 delete from operationplanresource
                 where operationplan_id in (
-                  select reference
+                  select operationplan.reference
                   from operationplan
                   inner join cluster_keys on cluster_keys.name = operationplan.item_id
                   where status = 'proposed' or status is null or type='STCK'
                   union
-                  select reference
-                  from operationplan
-                  where owner_id in (
-                    select reference
-                    from operationplan parent_opplan
-                    inner join cluster_keys on cluster_keys.name = parent_opplan.item_id
-                    )
-                  and (status = 'proposed' or status is null)
+                  select child.reference
+                  from operationplan as child
+                  inner join operationplan as parent_opplan
+                    on parent_opplan.reference = child.owner_id
+                  inner join cluster_keys on cluster_keys.name = parent_opplan.item_id
+                  where child.status = 'proposed' or child.status is null
                   )
                 """
             )
             cursor.execute(
                 """
                 delete from operationplan
-                using cluster_keys
-                where owner_id in (
-                  select oplan_parent.reference
-                  from operationplan as oplan_parent
-                  where (oplan_parent.status='proposed' or oplan_parent.status is null or oplan_parent.type='STCK')
-                  and oplan_parent.item_id = cluster_keys.name
-                  )
+                using operationplan as oplan_parent, cluster_keys
+                where operationplan.owner_id = oplan_parent.reference
+                and (oplan_parent.status='proposed' or oplan_parent.status is null or oplan_parent.type='STCK')
+                and oplan_parent.item_id = cluster_keys.name
                 """
             )
             cursor.execute(
@@ -179,26 +164,29 @@ class TruncatePlan(PlanTask):
                 and item_id = cluster_keys.name
                 """
             )
-            cursor.execute("truncate table cluster_keys")
-            for i in frepple.resources():
-                if i.cluster == cluster:
-                    cursor.execute(
-                        (
-                            "insert into cluster_keys (name) values (%s)"
-                            % adapt(i.name).getquoted().decode("UTF8")
-                        )
-                    )
+
+            # The demands of the cluster include the demands generated from
+            # forecasts, which allows an indexed join on the demand name.
+            loadKeys(i.name for i in frepple.demands() if i.cluster == cluster)
+            cursor.execute(
+                """
+                delete from out_constraint
+                using cluster_keys
+                where out_constraint.demand = cluster_keys.name
+                """
+            )
+            cursor.execute(
+                "delete from out_pegging using cluster_keys where demand = cluster_keys.name"
+            )
             cursor.execute(
                 """
                 delete from out_problem
-                where entity = 'demand'
-                and owner in (
-                  select demand.name
-                  from demand
-                  inner join cluster_keys on cluster_keys.name = demand.item_id
-                  )
+                using cluster_keys
+                where entity = 'demand' and owner = cluster_keys.name
                 """
             )
+
+            loadKeys(i.name for i in frepple.resources() if i.cluster == cluster)
             cursor.execute(
                 "delete from operationplanresource using cluster_keys where resource_id = cluster_keys.name"
             )
@@ -208,17 +196,10 @@ class TruncatePlan(PlanTask):
             cursor.execute(
                 "delete from out_problem using cluster_keys where entity = 'capacity' and owner = cluster_keys.name"
             )
-            cursor.execute("truncate table cluster_keys")
-            for i in frepple.operations():
-                if i.cluster == cluster:
-                    cursor.execute(
-                        (
-                            "insert into cluster_keys (name) values (%s)"
-                            % adapt(i.name).getquoted().decode("UTF8")
-                        )
-                    )
+
+            loadKeys(i.name for i in frepple.operations() if i.cluster == cluster)
             cursor.execute(
-                """"
+                """
                 delete from out_problem
                 using cluster_keys
                 where entity = 'operation' and owner = cluster_keys.name
@@ -258,6 +239,8 @@ class ShowPlanStats(PlanTask):
             union select 'operationplanmaterial', count(*) from operationplanmaterial
             union select 'operationplanresource', count(*) from operationplanresource
             union select 'out_resourceplan', count(*) from out_resourceplan
+            union select 'out_inventoryplan', count(*) from out_inventoryplan
+            union select 'out_pegging', count(*) from out_pegging
             union select 'operationplan', count(*) from operationplan
             order by 1
             """
@@ -290,34 +273,32 @@ class ExportProblems(PlanTask):
                 owner = i.owner
             if cluster != -1 and owner.cluster != cluster:
                 continue
-            yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                clean_value(i.entity),
-                clean_value(i.name),
-                clean_value(owner.name),
-                clean_value(i.description),
-                str(i.start),
-                str(i.end),
+            yield (
+                i.entity,
+                i.name,
+                owner.name,
+                i.description,
+                i.start,
+                i.end,
                 round(i.weight, 8),
             )
 
     @classmethod
     def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, **kwargs):
         cursor = connections[database].cursor()
-        cursor.copy_from(
-            CopyFromGenerator(cls.getData(cluster)),
+        CopyEncoder(
             "out_problem",
-            columns=(
-                "entity",
-                "name",
-                "owner",
-                "description",
-                "startdate",
-                "enddate",
-                "weight",
+            (
+                ("entity", "varchar"),
+                ("name", "varchar"),
+                ("owner", "varchar"),
+                ("description", "varchar"),
+                ("startdate", "timestamptz"),
+                ("enddate", "timestamptz"),
+                ("weight", "numeric"),
             ),
-            size=1024,
-            sep="\v",
-        )
+            binary=useBinaryCopy(database),
+        ).copy(cursor, cls.getData(cluster))
 
 
 @PlanTaskRegistry.register
@@ -341,38 +322,36 @@ class ExportConstraints(PlanTask):
             if cluster != -1 and cluster != d.cluster:
                 continue
             for i in d.constraints:
-                yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                    clean_value(d.name),
-                    clean_value(i.entity),
-                    clean_value(i.name),
+                yield (
+                    d.name,
+                    i.entity,
+                    i.name,
                     isinstance(i.owner, frepple.operationplan)
-                    and clean_value(i.owner.operation.name)
-                    or clean_value(i.owner.name),
-                    clean_value(i.description),
-                    str(i.start),
-                    str(i.end),
+                    and i.owner.operation.name
+                    or i.owner.name,
+                    i.description,
+                    i.start,
+                    i.end,
                     round(i.weight, 8),
                 )
 
     @classmethod
     def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, **kwargs):
         cursor = connections[database].cursor()
-        cursor.copy_from(
-            CopyFromGenerator(cls.getData(cluster=cluster)),
+        CopyEncoder(
             "out_constraint",
-            columns=(
-                "demand",
-                "entity",
-                "name",
-                "owner",
-                "description",
-                "startdate",
-                "enddate",
-                "weight",
+            (
+                ("demand", "varchar"),
+                ("entity", "varchar"),
+                ("name", "varchar"),
+                ("owner", "varchar"),
+                ("description", "varchar"),
+                ("startdate", "timestamptz"),
+                ("enddate", "timestamptz"),
+                ("weight", "numeric"),
             ),
-            size=1024,
-            sep="\v",
-        )
+            binary=useBinaryCopy(database),
+        ).copy(cursor, cls.getData(cluster=cluster))
 
 
 @PlanTaskRegistry.register
@@ -416,9 +395,7 @@ class ExportOperationPlans(PlanTask):
                 pln["item"] = buffer.item.name
             if buffer.location:
                 pln["location"] = buffer.location.name
-        # We need to double any backslash to assure that the string remains
-        # valid when passing it through postgresql (which eats them away)
-        return json.dumps(pln).replace("\\", "\\\\")
+        return json.dumps(pln)
 
     @classmethod
     def getData(cls, timestamp, cluster=-1):
@@ -433,193 +410,193 @@ class ExportOperationPlans(PlanTask):
 
                 if isinstance(i, frepple.operation_inventory):
                     # Export inventory
-                    yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                        clean_value(i.name),
+                    yield (
+                        i.name,
                         "STCK",
                         j.status,
                         round(j.quantity, 8),
-                        str(j.start),
-                        str(j.end),
+                        j.start,
+                        j.end,
                         round(j.criticality, 8),
                         j.delay,
                         cls.getPegging(j),
-                        clean_value(j.source),
+                        j.source,
                         timestamp,
-                        "\\N",
-                        clean_value(j.owner.reference)
+                        None,
+                        j.owner.reference
                         if j.owner and not j.owner.operation.hidden
-                        else "\\N",
-                        clean_value(j.operation.buffer.item.name),
-                        clean_value(j.operation.buffer.location.name),
-                        "\\N",
-                        "\\N",
-                        "\\N",
-                        clean_value(j.demand.name)
+                        else None,
+                        j.operation.buffer.item.name,
+                        j.operation.buffer.location.name,
+                        None,
+                        None,
+                        None,
+                        j.demand.name
                         if j.demand
-                        else clean_value(j.owner.demand.name)
+                        else j.owner.demand.name
                         if j.owner and j.owner.demand
-                        else "\\N",
+                        else None,
                         j.demand.due
                         if j.demand
                         else j.owner.demand.due
                         if j.owner and j.owner.demand
-                        else "\\N",
+                        else None,
                         color,
-                        clean_value(j.reference),
+                        j.reference,
                     )
                 elif isinstance(i, frepple.operation_itemdistribution):
                     # Export DO
-                    yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                        clean_value(i.name),
+                    yield (
+                        i.name,
                         "DO",
                         j.status,
                         round(j.quantity, 8),
-                        str(j.start),
-                        str(j.end),
+                        j.start,
+                        j.end,
                         round(j.criticality, 8),
                         j.delay,
                         cls.getPegging(j),
-                        clean_value(j.source),
+                        j.source,
                         timestamp,
-                        "\\N",
-                        clean_value(j.owner.reference)
+                        None,
+                        j.owner.reference
                         if j.owner and not j.owner.operation.hidden
-                        else "\\N",
-                        clean_value(j.operation.destination.item.name)
+                        else None,
+                        j.operation.destination.item.name
                         if j.operation.destination
                         else j.operation.origin.item.name,
-                        clean_value(j.operation.destination.location.name)
+                        j.operation.destination.location.name
                         if j.operation.destination
-                        else "\\N",
-                        clean_value(j.operation.origin.location.name)
+                        else None,
+                        j.operation.origin.location.name
                         if j.operation.origin
-                        else "\\N",
-                        "\\N",
-                        "\\N",
-                        clean_value(j.demand.name)
+                        else None,
+                        None,
+                        None,
+                        j.demand.name
                         if j.demand
-                        else clean_value(j.owner.demand.name)
+                        else j.owner.demand.name
                         if j.owner and j.owner.demand
-                        else "\\N",
+                        else None,
                         j.demand.due
                         if j.demand
                         else j.owner.demand.due
                         if j.owner and j.owner.demand
-                        else "\\N",
+                        else None,
                         color,
-                        clean_value(j.reference),
+                        j.reference,
                     )
                 elif isinstance(i, frepple.operation_itemsupplier):
                     # Export PO
-                    yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                        clean_value(i.name),
+                    yield (
+                        i.name,
                         "PO",
                         j.status,
                         round(j.quantity, 8),
-                        str(j.start),
-                        str(j.end),
+                        j.start,
+                        j.end,
                         round(j.criticality, 8),
                         j.delay,
                         cls.getPegging(j),
-                        clean_value(j.source),
+                        j.source,
                         timestamp,
-                        "\\N",
-                        clean_value(j.owner.reference)
+                        None,
+                        j.owner.reference
                         if j.owner and not j.owner.operation.hidden
-                        else "\\N",
-                        clean_value(j.operation.buffer.item.name),
-                        "\\N",
-                        "\\N",
-                        clean_value(j.operation.buffer.location.name),
-                        clean_value(j.operation.itemsupplier.supplier.name),
-                        clean_value(j.demand.name)
+                        else None,
+                        j.operation.buffer.item.name,
+                        None,
+                        None,
+                        j.operation.buffer.location.name,
+                        j.operation.itemsupplier.supplier.name,
+                        j.demand.name
                         if j.demand
-                        else clean_value(j.owner.demand.name)
+                        else j.owner.demand.name
                         if j.owner and j.owner.demand
-                        else "\\N",
+                        else None,
                         j.demand.due
                         if j.demand
                         else j.owner.demand.due
                         if j.owner and j.owner.demand
-                        else "\\N",
+                        else None,
                         color,
-                        clean_value(j.reference),
+                        j.reference,
                     )
                 elif not i.hidden:
                     # Export MO
-                    yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                        clean_value(i.name),
+                    yield (
+                        i.name,
                         "MO",
                         j.status,
                         round(j.quantity, 8),
-                        str(j.start),
-                        str(j.end),
+                        j.start,
+                        j.end,
                         round(j.criticality, 8),
                         j.delay,
                         cls.getPegging(j),
-                        clean_value(j.source),
+                        j.source,
                         timestamp,
-                        clean_value(i.name),
-                        clean_value(j.owner.reference)
+                        i.name,
+                        j.owner.reference
                         if j.owner and not j.owner.operation.hidden
-                        else "\\N",
-                        clean_value(i.item.name) if i.item else "\\N",
-                        "\\N",
-                        "\\N",
-                        clean_value(i.location.name) if i.location else "\\N",
-                        "\\N",
-                        clean_value(j.demand.name)
+                        else None,
+                        i.item.name if i.item else None,
+                        None,
+                        None,
+                        i.location.name if i.location else None,
+                        None,
+                        j.demand.name
                         if j.demand
-                        else clean_value(j.owner.demand.name)
+                        else j.owner.demand.name
                         if j.owner and j.owner.demand
-                        else "\\N",
+                        else None,
                         j.demand.due
                         if j.demand
                         else j.owner.demand.due
                         if j.owner and j.owner.demand
-                        else "\\N",
+                        else None,
                         color,
-                        clean_value(j.reference),
+                        j.reference,
                     )
                 elif j.demand or (j.owner and j.owner.demand):
                     # Export shipments (with automatically created delivery operations)
-                    yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                        clean_value(i.name),
+                    yield (
+                        i.name,
                         "DLVR",
                         j.status,
                         round(j.quantity, 8),
-                        str(j.start),
-                        str(j.end),
+                        j.start,
+                        j.end,
                         round(j.criticality, 8),
                         j.delay,
                         cls.getPegging(j),
-                        clean_value(j.source),
+                        j.source,
                         timestamp,
-                        "\\N",
-                        clean_value(j.owner.reference)
+                        None,
+                        j.owner.reference
                         if j.owner and not j.owner.operation.hidden
-                        else "\\N",
-                        clean_value(j.operation.buffer.item.name),
-                        "\\N",
-                        "\\N",
-                        clean_value(j.operation.buffer.location.name),
-                        "\\N",
-                        clean_value(j.demand.name)
+                        else None,
+                        j.operation.buffer.item.name,
+                        None,
+                        None,
+                        j.operation.buffer.location.name,
+                        None,
+                        j.demand.name
                         if j.demand
-                        else clean_value(j.owner.demand.name)
+                        else j.owner.demand.name
                         if j.owner and j.owner.demand
-                        else "\\N",
+                        else None,
                         j.demand.due
                         if j.demand
                         else j.owner.demand.due
                         if j.owner and j.owner.demand
-                        else "\\N",
+                        else None,
                         color,
-                        clean_value(j.reference),
+                        j.reference,
                     )
 
     @classmethod
-    def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, **kwargs):
+    def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, parents=None, **kwargs):
 
         # Set the timestamp for the export tasks in this thread
         cls.parent.timestamp = datetime.now()
@@ -654,12 +631,34 @@ class ExportOperationPlans(PlanTask):
             );
             """
         )
-        cursor.copy_from(
-            CopyFromGenerator(cls.getData(cls.parent.timestamp, cluster=cluster)),
-            table="tmp_operationplan",
-            size=1024,
-            sep="\v",
-        )
+        CopyEncoder(
+            "tmp_operationplan",
+            (
+                ("name", "varchar"),
+                ("type", "varchar"),
+                ("status", "varchar"),
+                ("quantity", "numeric"),
+                ("startdate", "timestamptz"),
+                ("enddate", "timestamptz"),
+                ("criticality", "numeric"),
+                ("delay", "numeric"),
+                ("plan", "json"),
+                ("source", "varchar"),
+                ("lastmodified", "timestamptz"),
+                ("operation_id", "varchar"),
+                ("owner_id", "varchar"),
+                ("item_id", "varchar"),
+                ("destination_id", "varchar"),
+                ("origin_id", "varchar"),
+                ("location_id", "varchar"),
+                ("supplier_id", "varchar"),
+                ("demand_id", "varchar"),
+                ("due", "timestamptz"),
+                ("color", "numeric"),
+                ("reference", "varchar"),
+            ),
+            binary=useBinaryCopy(database),
+        ).copy(cursor, cls.getData(cls.parent.timestamp, cluster=cluster))
 
         # Merge temp table into the actual table
         cursor.execute(
@@ -768,8 +767,16 @@ class ExportOperationPlans(PlanTask):
               select 1
               from operationplan
               where operationplan.reference = tmp_operationplan.reference
-              );
+              )
+            %s
             """
+            # A delta scenario doesn't copy the locked orders of its parents:
+            # its locked orders are the ones changed in the delta scenario.
+            % (
+                "and coalesce(tmp_operationplan.status, 'proposed') = 'proposed'"
+                if parents
+                else ""
+            )
         )
 
         # update demand table specific fields
@@ -843,12 +850,12 @@ class ExportOperationPlanMaterials(PlanTask):
                         )
                     )
                 else:
-                    yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                        clean_value(j.operationplan.id),
-                        clean_value(j.buffer.item.name),
-                        clean_value(j.buffer.location.name),
+                    yield (
+                        j.operationplan.id,
+                        j.buffer.item.name,
+                        j.buffer.location.name,
                         round(j.quantity, 8),
-                        str(j.date),
+                        j.date,
                         round(j.onhand, 8),
                         round(j.minimum, 8),
                         round(j.period_of_cover, 8),
@@ -860,26 +867,22 @@ class ExportOperationPlanMaterials(PlanTask):
     def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, **kwargs):
         cursor = connections[database].cursor()
         updates = []
-        cursor.copy_from(
-            CopyFromGenerator(
-                cls.getData(timestamp=cls.parent.timestamp, cluster=cluster)
-            ),
+        CopyEncoder(
             "operationplanmaterial",
-            columns=(
-                "operationplan_id",
-                "item_id",
-                "location_id",
-                "quantity",
-                "flowdate",
-                "onhand",
-                "minimum",
-                "periodofcover",
-                "status",
-                "lastmodified",
+            (
+                ("operationplan_id", "varchar"),
+                ("item_id", "varchar"),
+                ("location_id", "varchar"),
+                ("quantity", "numeric"),
+                ("flowdate", "timestamptz"),
+                ("onhand", "numeric"),
+                ("minimum", "numeric"),
+                ("periodofcover", "numeric"),
+                ("status", "varchar"),
+                ("lastmodified", "timestamptz"),
             ),
-            size=1024,
-            sep="\v",
-        )
+            binary=useBinaryCopy(database),
+        ).copy(cursor, cls.getData(timestamp=cls.parent.timestamp, cluster=cluster))
         if len(updates) > 0:
             cursor.execute("\n".join(updates))
 
@@ -918,13 +921,13 @@ class ExportOperationPlanResources(PlanTask):
                         )
                     )
                 else:
-                    yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                        clean_value(j.operationplan.reference),
-                        clean_value(j.resource.name),
+                    yield (
+                        j.operationplan.reference,
+                        j.resource.name,
                         round(-j.quantity, 8),
-                        str(j.startdate),
-                        str(j.enddate),
-                        clean_value(j.setup),
+                        j.startdate,
+                        j.enddate,
+                        j.setup,
                         j.status,
                         timestamp,
                     )
@@ -932,24 +935,20 @@ class ExportOperationPlanResources(PlanTask):
     @classmethod
     def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, **kwargs):
         cursor = connections[database].cursor()
-        cursor.copy_from(
-            CopyFromGenerator(
-                cls.getData(timestamp=cls.parent.timestamp, cluster=cluster)
-            ),
+        CopyEncoder(
             "operationplanresource",
-            columns=(
-                "operationplan_id",
-                "resource_id",
-                "quantity",
-                "startdate",
-                "enddate",
-                "setup",
-                "status",
-                "lastmodified",
+            (
+                ("operationplan_id", "varchar"),
+                ("resource_id", "varchar"),
+                ("quantity", "numeric"),
+                ("startdate", "timestamptz"),
+                ("enddate", "timestamptz"),
+                ("setup", "varchar"),
+                ("status", "varchar"),
+                ("lastmodified", "timestamptz"),
             ),
-            size=1024,
-            sep="\v",
-        )
+            binary=useBinaryCopy(database),
+        ).copy(cursor, cls.getData(timestamp=cls.parent.timestamp, cluster=cluster))
 
 
 @PlanTaskRegistry.register
@@ -1012,9 +1011,9 @@ class ExportResourcePlans(PlanTask):
             # Loop over all reporting buckets of all resources
             for i in frepple.resources():
                 for j in i.plan(buckets):
-                    yield "%s\v%s\v%s\v%s\v%s\v%s\v%s\n" % (
-                        clean_value(i.name),
-                        str(j["start"]),
+                    yield (
+                        i.name,
+                        j["start"],
                         round(j["available"], 8),
                         round(j["unavailable"], 8),
                         round(j["setup"], 8),
@@ -1022,20 +1021,312 @@ class ExportResourcePlans(PlanTask):
                         round(j["free"], 8),
                     )
 
-        cursor.copy_from(
-            CopyFromGenerator(getData()),
+        CopyEncoder(
             "out_resourceplan",
-            columns=(
-                "resource",
-                "startdate",
-                "available",
-                "unavailable",
-                "setup",
-                "load",
-                "free",
+            (
+                ("resource", "varchar"),
+                ("startdate", "timestamptz"),
+                ("available", "numeric"),
+                ("unavailable", "numeric"),
+                ("setup", "numeric"),
+                ("load", "numeric"),
+                ("free", "numeric"),
+            ),
+            binary=useBinaryCopy(database),
+        ).copy(cursor, getData())
+
+
+@PlanTaskRegistry.register
+class ExportInventoryPlans(PlanTask):
+    """
+    Exports a summary of the inventory profile of all buffers, for the
+    time buckets of all bucket levels in the reporting horizon.
+    The inventory report reads this table, rather than aggregating the
+    operationplanmaterial records for every cell of the report.
+    """
+
+    description = ("Export plan", "Exporting inventory plans")
+    sequence = (401, "export2", 4)
+
+    # Period of cover of a buffer without future demand
+    infiniteCover = 86313600
+
+    @classmethod
+    def getWeight(cls, **kwargs):
+        if "supply" in os.environ:
+            return 1
+        else:
+            return -1
+
+    @staticmethod
+    def getHorizon(cluster=-1):
+        """
+        Returns the start and end date of the reporting horizon: from 30 days
+        before the first flowplan till 30 days after the last flowplan.
+        """
+        import frepple
+
+        startdate = datetime.max
+        enddate = datetime.min
+        for i in frepple.buffers():
+            if cluster != -1 and cluster != i.cluster:
+                continue
+            for j in i.flowplans:
+                if j.date < startdate:
+                    startdate = j.date
+                if j.date > enddate:
+                    enddate = j.date
+        current = frepple.settings.current
+        startdate = (min(startdate, current) - timedelta(days=30)).date()
+        enddate = (max(enddate, current) + timedelta(days=30)).date()
+        if enddate > date(2030, 12, 30):  # This is the max frePPLe can represent.
+            enddate = date(2030, 12, 30)
+        return startdate, enddate
+
+    @staticmethod
+    def getBuckets(cursor, startdate, enddate):
+        """
+        Returns a list of (bucket, list of start dates, list of end dates)
+        tuples, with the buckets of each level in the horizon.
+        """
+        cursor.execute(
+            """
+            select bucket_id, startdate, enddate
+            from common_bucketdetail
+            where enddate > %s and startdate < %s
+            order by bucket_id, startdate
+            """,
+            (startdate, enddate),
+        )
+        buckets = []
+        for bucket, start, end in cursor.fetchall():
+            if not buckets or buckets[-1][0] != bucket:
+                buckets.append((bucket, [], []))
+            buckets[-1][1].append(start)
+            buckets[-1][2].append(end)
+        return buckets
+
+    @staticmethod
+    def getSafetyStock(cursor):
+        """
+        Returns a function that returns for a buffer a function to look up
+        its safety stock at a certain date.
+
+        The safety stock is the value of the calendar "SS for <buffer>",
+        or the value of the minimum calendar of the buffer, or the minimum
+        field of the buffer.
+        Calendar buckets are matched on their start and end date only, and
+        the bucket with the lowest priority value is used.
+        """
+        cursor.execute(
+            "select item_id, location_id, minimum, minimum_calendar_id from buffer"
+        )
+        buffers = {(i[0], i[1]): (i[2], i[3]) for i in cursor.fetchall()}
+
+        cursor.execute(
+            """
+            select calendar.name, calendar.defaultvalue,
+              calendarbucket.startdate, calendarbucket.enddate, calendarbucket.value
+            from calendar
+            left outer join calendarbucket
+              on calendarbucket.calendar_id = calendar.name
+            where calendar.name like 'SS for %'
+              or calendar.name in (select minimum_calendar_id from buffer)
+            order by calendar.name, calendarbucket.priority, calendarbucket.startdate
+            """
+        )
+        calendarbuckets = {}
+        for name, default, start, end, value in cursor.fetchall():
+            if name not in calendarbuckets:
+                calendarbuckets[name] = (default, [])
+            if value is not None:
+                calendarbuckets[name][1].append(
+                    (start or datetime.min, end or datetime.max, value)
+                )
+
+        # Convert each calendar into a step function: a sorted list of dates
+        # and the value valid from each of these dates
+        calendars = {}
+        for name, (default, cal_buckets) in calendarbuckets.items():
+            dates = sorted(
+                set(i[0] for i in cal_buckets) | set(i[1] for i in cal_buckets)
+            )
+            values = []
+            for d in dates:
+                for start, end, value in cal_buckets:
+                    if start <= d < end:
+                        values.append(value)
+                        break
+                else:
+                    values.append(default)
+            calendars[name] = (default, dates, values)
+
+        def getFunction(item, location):
+            minimum, minimum_calendar = buffers.get((item, location), (None, None))
+            cals = [
+                calendars[c]
+                for c in ("SS for %s @ %s" % (item, location), minimum_calendar)
+                if c in calendars
+            ]
+
+            def safetystock(d):
+                for default, dates, values in cals:
+                    idx = bisect_right(dates, d) - 1
+                    value = values[idx] if idx >= 0 else default
+                    if value is not None:
+                        return value
+                return minimum
+
+            return safetystock
+
+        return getFunction
+
+    @classmethod
+    def getData(cls, buckets, safetystock, cluster=-1):
+        import frepple
+
+        for i in frepple.buffers():
+            if cluster != -1 and cluster != i.cluster:
+                continue
+            flows = [
+                (
+                    j.date,
+                    j.quantity,
+                    j.onhand,
+                    j.period_of_cover,
+                    j.operationplan.ordertype,
+                    j.operationplan.start,
+                    j.operationplan.end,
+                )
+                for j in i.flowplans
+                if j.operationplan.reference
+            ]
+            if not flows:
+                continue
+            item = i.item.name
+            location = i.location.name
+            ss = safetystock(item, location)
+            nflows = len(flows)
+
+            for bucket, starts, ends in buckets:
+                # Quantity in progress at the end of each bucket
+                in_progress = {}
+                for f in flows:
+                    if f[1] <= 0:
+                        continue
+                    for k in range(bisect_right(ends, f[5]), bisect_right(ends, f[6])):
+                        if k not in in_progress:
+                            in_progress[k] = [0, 0, 0, 0]
+                        in_progress[k][0] += f[1]
+                        if f[4] == "MO":
+                            in_progress[k][1] += f[1]
+                        elif f[4] == "PO":
+                            in_progress[k][2] += f[1]
+                        elif f[4] == "DO":
+                            in_progress[k][3] += f[1]
+
+                # Sweep over the buckets and the flowplans
+                idx = 0
+                last = None
+                for k in range(len(starts)):
+                    start = starts[k]
+                    end = ends[k]
+                    while idx < nflows and flows[idx][0] < start:
+                        last = flows[idx]
+                        idx += 1
+                    startoh = last[2] if last else 0
+                    if startoh <= 0:
+                        startohdoc = 0
+                    elif not last[3] or last[3] == cls.infiniteCover:
+                        startohdoc = 999
+                    else:
+                        startohdoc = max(
+                            0, (last[0] + timedelta(seconds=last[3]) - start).days
+                        )
+                    # consumed, MO, DO, SO, produced, MO, DO, PO
+                    qty = [0, 0, 0, 0, 0, 0, 0, 0]
+                    j = idx
+                    while j < nflows and flows[j][0] < end:
+                        f = flows[j]
+                        j += 1
+                        if f[1] < 0:
+                            qty[0] -= f[1]
+                            if f[4] == "MO":
+                                qty[1] -= f[1]
+                            elif f[4] == "DO":
+                                qty[2] -= f[1]
+                            elif f[4] == "DLVR":
+                                qty[3] -= f[1]
+                        elif f[1] > 0:
+                            qty[4] += f[1]
+                            if f[4] == "MO":
+                                qty[5] += f[1]
+                            elif f[4] == "DO":
+                                qty[6] += f[1]
+                            elif f[4] == "PO":
+                                qty[7] += f[1]
+                    progress = in_progress.get(k, (0, 0, 0, 0))
+                    yield (
+                        item,
+                        location,
+                        bucket,
+                        start,
+                        end,
+                        round(startoh, 8),
+                        startohdoc,
+                        ss(start),
+                        round(qty[0], 8),
+                        round(qty[1], 8),
+                        round(qty[2], 8),
+                        round(qty[3], 8),
+                        round(qty[4], 8),
+                        round(qty[5], 8),
+                        round(qty[6], 8),
+                        round(qty[7], 8),
+                        round(startoh + qty[4] - qty[0], 8),
+                        round(progress[0], 8),
+                        round(progress[1], 8),
+                        round(progress[2], 8),
+                        round(progress[3], 8),
+                    )
+
+    @classmethod
+    def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, **kwargs):
+        cursor = connections[database].cursor()
+        startdate, enddate = cls.getHorizon(cluster=cluster)
+        CopyEncoder(
+            "out_inventoryplan",
+            (
+                ("item", "varchar"),
+                ("location", "varchar"),
+                ("bucket", "varchar"),
+                ("startdate", "timestamptz"),
+                ("enddate", "timestamptz"),
+                ("startoh", "numeric"),
+                ("startohdoc", "int4"),
+                ("safetystock", "numeric"),
+                ("consumed", "numeric"),
+                ("consumedmo", "numeric"),
+                ("consumeddo", "numeric"),
+                ("consumedso", "numeric"),
+                ("produced", "numeric"),
+                ("producedmo", "numeric"),
+                ("produceddo", "numeric"),
+                ("producedpo", "numeric"),
+                ("endoh", "numeric"),
+                ("total_in_progress", "numeric"),
+                ("work_in_progress_mo", "numeric"),
+                ("on_order_po", "numeric"),
+                ("in_transit_do", "numeric"),
+            ),
+            binary=useBinaryCopy(database),
+        ).copy(
+            cursor,
+            cls.getData(
+                cls.getBuckets(cursor, startdate, enddate),
+                cls.getSafetyStock(cursor),
+                cluster=cluster,
             ),
-            size=1024,
-            sep="\v",
         )
 
 
@@ -1053,7 +1344,7 @@ class ExportPegging(PlanTask):
             return -1
 
     @staticmethod
-    def getDemandPlan(cluster=-1):
+    def getData(cluster=-1):
         import frepple
 
         for i in frepple.demands():
@@ -1061,27 +1352,27 @@ class ExportPegging(PlanTask):
                 continue
             if i.hidden or not isinstance(i, frepple.demand_default):
                 continue
-            peg = []
             for j in i.pegging:
-                peg.append(
-                    {
-                        "level": j.level,
-                        "opplan": j.operationplan.reference,
-                        "quantity": j.quantity,
-                    }
+                yield (
+                    i.name,
+                    j.operationplan.reference,
+                    j.level,
+                    round(j.quantity, 8),
                 )
-            yield (json.dumps({"pegging": peg}), i.name)
 
     @classmethod
     def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, **kwargs):
-        with transaction.atomic(using=database, savepoint=False):
-            cursor = connections[database].cursor()
-            execute_batch(
-                cursor,
-                "update demand set plan=%s where name=%s",
-                cls.getDemandPlan(cluster=cluster),
-                page_size=200,
-            )
+        cursor = connections[database].cursor()
+        CopyEncoder(
+            "out_pegging",
+            (
+                ("demand", "varchar"),
+                ("operationplan", "varchar"),
+                ("level", "int4"),
+                ("quantity", "numeric"),
+            ),
+            binary=useBinaryCopy(database),
+        ).copy(cursor, cls.getData(cluster=cluster))
 
 
 @PlanTaskRegistry.register
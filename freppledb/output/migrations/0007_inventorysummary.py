@@ -0,0 +1,193 @@
+#
+# Copyright (C) 2019 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("output", "0006_squashed_60")]
+
+    operations = [
+        migrations.CreateModel(
+            name="InventorySummary",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("item", models.CharField(max_length=300, verbose_name="item")),
+                ("location", models.CharField(max_length=300, verbose_name="location")),
+                ("bucket", models.CharField(max_length=300, verbose_name="bucket")),
+                ("startdate", models.DateTimeField(verbose_name="startdate")),
+                ("enddate", models.DateTimeField(verbose_name="enddate")),
+                (
+                    "startoh",
+                    models.DecimalField(
+                        decimal_places=8,
+                        max_digits=20,
+                        null=True,
+                        verbose_name="start inventory",
+                    ),
+                ),
+                (
+                    "startohdoc",
+                    models.IntegerField(
+                        null=True, verbose_name="start inventory days of cover"
+                    ),
+                ),
+                (
+                    "safetystock",
+                    models.DecimalField(
+                        decimal_places=8,
+                        max_digits=20,
+                        null=True,
+                        verbose_name="safety stock",
+                    ),
+                ),
+                (
+                    "consumed",
+                    models.DecimalField(
+                        decimal_places=8,
+                        max_digits=20,
+                        null=True,
+                        verbose_name="total consumed",
+                    ),
+                ),
+                (
+                    "consumedmo",
+                    models.DecimalField(
+                        decimal_places=8,
+                        max_digits=20,
+                        null=True,
+                        verbose_name="consumed by MO",
+                    ),
+                ),
+                (
+                    "consumeddo",
+                    models.DecimalField(
+                        decimal_places=8,
+                        max_digits=20,
+                        null=True,
+                        verbose_name="consumed by DO",
+                    ),
+                ),
+                (
+                    "consumedso",
+                    models.DecimalField(
+                        decimal_places=8,
+                        max_digits=20,
+                        null=True,
+                        verbose_name="consumed by SO",
+                    ),
+                ),
+                (
+                    "produced",
+                    models.DecimalField(
+                        decimal_places=8,
+                        max_digits=20,
+                        null=True,
+                        verbose_name="total produced",
+                    ),
+                ),
+                (
+                    "producedmo",
+                    models.DecimalField(
+                        decimal_places=8,
+                        max_digits=20,
+                        null=True,
+                        verbose_name="produced by MO",
+                    ),
+                ),
+                (
+                    "produceddo",
+                    models.DecimalField(
+                        decimal_places=8,
+                        max_digits=20,
+                        null=True,
+                        verbose_name="produced by DO",
+                    ),
+                ),
+                (
+                    "producedpo",
+                    models.DecimalField(
+                        decimal_places=8,
+                        max_digits=20,
+                        null=True,
+                        verbose_name="produced by PO",
+                    ),
+                ),
+                (
+                    "endoh",
+                    models.DecimalField(
+                        decimal_places=8,
+                        max_digits=20,
+                        null=True,
+                        verbose_name="end inventory",
+                    ),
+                ),
+                (
+                    "total_in_progress",
+                    models.DecimalField(
+                        decimal_places=8,
+                        max_digits=20,
+                        null=True,
+                        verbose_name="total in progress",
+                    ),
+                ),
+                (
+                    "work_in_progress_mo",
+                    models.DecimalField(
+                        decimal_places=8,
+                        max_digits=20,
+                        null=True,
+                        verbose_name="work in progress MO",
+                    ),
+                ),
+                (
+                    "on_order_po",
+                    models.DecimalField(
+                        decimal_places=8,
+                        max_digits=20,
+                        null=True,
+                        verbose_name="on order PO",
+                    ),
+                ),
+                (
+                    "in_transit_do",
+                    models.DecimalField(
+                        decimal_places=8,
+                        max_digits=20,
+                        null=True,
+                        verbose_name="in transit DO",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "inventory summary",
+                "verbose_name_plural": "inventory summaries",
+                "db_table": "out_inventoryplan",
+                "ordering": ["item", "location", "bucket", "startdate"],
+                "unique_together": {("bucket", "item", "location", "startdate")},
+            },
+        )
+    ]
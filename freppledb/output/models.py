@@ -62,6 +62,23 @@ class Constraint(models.Model):
         verbose_name_plural = _("constraints")
 
 
+class Pegging(models.Model):
+    # Database fields
+    demand = models.CharField(_("demand"), max_length=300, db_index=True)
+    operationplan = models.CharField(_("reference"), max_length=300, db_index=True)
+    level = models.IntegerField(_("level"))
+    quantity = models.DecimalField(_("quantity"), max_digits=20, decimal_places=8)
+
+    def __str__(self):
+        return "%s - %s" % (self.demand, self.operationplan)
+
+    class Meta:
+        db_table = "out_pegging"
+        ordering = ["demand", "id"]
+        verbose_name = _("pegging")
+        verbose_name_plural = _("pegging")
+
+
 class ResourceSummary(models.Model):
     resource = models.CharField(_("resource"), max_length=300)
     startdate = models.DateTimeField(_("startdate"))
@@ -83,3 +100,65 @@ class ResourceSummary(models.Model):
             "resource summary"
         )  # No need to translate these since only used internally
         verbose_name_plural = "resource summaries"
+
+
+class InventorySummary(models.Model):
+    item = models.CharField(_("item"), max_length=300)
+    location = models.CharField(_("location"), max_length=300)
+    bucket = models.CharField(_("bucket"), max_length=300)
+    startdate = models.DateTimeField(_("startdate"))
+    enddate = models.DateTimeField(_("enddate"))
+    startoh = models.DecimalField(
+        _("start inventory"), max_digits=20, decimal_places=8, null=True
+    )
+    startohdoc = models.IntegerField(_("start inventory days of cover"), null=True)
+    safetystock = models.DecimalField(
+        _("safety stock"), max_digits=20, decimal_places=8, null=True
+    )
+    consumed = models.DecimalField(
+        _("total consumed"), max_digits=20, decimal_places=8, null=True
+    )
+    consumedmo = models.DecimalField(
+        _("consumed by MO"), max_digits=20, decimal_places=8, null=True
+    )
+    consumeddo = models.DecimalField(
+        _("consumed by DO"), max_digits=20, decimal_places=8, null=True
+    )
+    consumedso = models.DecimalField(
+        _("consumed by SO"), max_digits=20, decimal_places=8, null=True
+    )
+    produced = models.DecimalField(
+        _("total produced"), max_digits=20, decimal_places=8, null=True
+    )
+    producedmo = models.DecimalField(
+        _("produced by MO"), max_digits=20, decimal_places=8, null=True
+    )
+    produceddo = models.DecimalField(
+        _("produced by DO"), max_digits=20, decimal_places=8, null=True
+    )
+    producedpo = models.DecimalField(
+        _("produced by PO"), max_digits=20, decimal_places=8, null=True
+    )
+    endoh = models.DecimalField(
+        _("end inventory"), max_digits=20, decimal_places=8, null=True
+    )
+    total_in_progress = models.DecimalField(
+        _("total in progress"), max_digits=20, decimal_places=8, null=True
+    )
+    work_in_progress_mo = models.DecimalField(
+        _("work in progress MO"), max_digits=20, decimal_places=8, null=True
+    )
+    on_order_po = models.DecimalField(
+        _("on order PO"), max_digits=20, decimal_places=8, null=True
+    )
+    in_transit_do = models.DecimalField(
+        _("in transit DO"), max_digits=20, decimal_places=8, null=True
+    )
+
+    class Meta:
+        db_table = "out_inventoryplan"
+        ordering = ["item", "location", "bucket", "startdate"]
+        unique_together = (("bucket", "item", "location", "startdate"),)
+        # No need to translate these since only used internally
+        verbose_name = "inventory summary"
+        verbose_name_plural = "inventory summaries"
@@ -14,7 +14,6 @@
 # You should have received a copy of the GNU Affero General Public
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
-from datetime import timedelta, datetime
 
 from django.db import connections
 from django.db.models.expressions import RawSQL
@@ -39,6 +38,7 @@ class OverviewReport(GridPivot):
 
     template = "output/buffer.html"
     title = _("Inventory report")
+    tables = ("common_bucketdetail", "item", "location")
 
     @classmethod
     def basequeryset(reportclass, request, *args, **kwargs):
@@ -202,6 +202,26 @@ class OverviewReport(GridPivot):
         ("in_transit_do", {"title": _("in transit DO")}),
     )
 
+    # Fields read from the out_inventoryplan table
+    inventory_fields = (
+        "startoh",
+        "startohdoc",
+        "safetystock",
+        "consumed",
+        "consumedMO",
+        "consumedDO",
+        "consumedSO",
+        "produced",
+        "producedMO",
+        "producedDO",
+        "producedPO",
+        "endoh",
+        "total_in_progress",
+        "work_in_progress_mo",
+        "on_order_po",
+        "in_transit_do",
+    )
+
     @classmethod
     def initialize(reportclass, request):
         if reportclass._attributes_added != 2:
@@ -244,12 +264,14 @@ class OverviewReport(GridPivot):
 
     @classmethod
     def query(reportclass, request, basequery, sortsql="1 asc"):
-        cursor = connections[request.database].cursor()
         basesql, baseparams = basequery.query.get_compiler(basequery.db).as_sql(
             with_col_aliases=False
         )
 
-        # Execute the actual query
+        # Execute the actual query.
+        # The inventory profile is precomputed in the out_inventoryplan table
+        # during the plan export. Buckets outside the horizon of the export
+        # continue the inventory of the last bucket.
         query = """
        select item.name||' @ '||location.name,
        item.name item_id,
@@ -269,79 +291,47 @@ class OverviewReport(GridPivot):
        location.source,
        location.lastmodified,
        %s
-       (select jsonb_build_object('onhand', onhand, 'flowdate', to_char(flowdate,'YYYY-MM-DD HH24:MI:SS'), 'periodofcover', periodofcover) 
-       from operationplanmaterial where item_id = item.name and
-       location_id = location.name and flowdate < greatest(d.startdate,%%s)
-       order by flowdate desc, id desc limit 1) startoh,
        d.bucket,
        d.startdate,
        d.enddate,
-       (select safetystock from
-        (
-        select 1 as priority, coalesce((select value from calendarbucket 
-        where calendar_id = 'SS for '||item.name||' @ '||location.name
-        and greatest(d.startdate,%%s) >= startdate and greatest(d.startdate,%%s) < enddate
-        order by priority limit 1), (select defaultvalue from calendar where name = 'SS for '||item.name||' @ '||location.name)) as safetystock
-        union all
-        select 2 as priority, coalesce((select value from calendarbucket 
-        where calendar_id = (select minimum_calendar_id from buffer where item_id = item.name and location_id = location.name)
-        and greatest(d.startdate,%%s) >= startdate and greatest(d.startdate,%%s) < enddate
-        order by priority limit 1), (select defaultvalue from calendar where name = (select minimum_calendar_id from buffer where name = item.name||' @ '||location.name))) as safetystock
-        union all
-        select 3 as priority, minimum as safetystock from buffer where item_id = item.name and location_id = location.name
-        ) t
-        where t.safetystock is not null
-        order by priority
-        limit 1) safetystock,
-       (select jsonb_build_object(
-      'work_in_progress_mo', sum(case when (startdate < d.enddate and enddate >= d.enddate) and opm.quantity > 0 and operationplan.type = 'MO' then opm.quantity else 0 end),
-      'on_order_po', sum(case when (startdate < d.enddate and enddate >= d.enddate) and opm.quantity > 0 and operationplan.type = 'PO' then opm.quantity else 0 end),
-      'in_transit_do', sum(case when (startdate < d.enddate and enddate >= d.enddate) and opm.quantity > 0 and operationplan.type = 'DO' then opm.quantity else 0 end),
-      'total_in_progress', sum(case when (startdate < d.enddate and enddate >= d.enddate) and opm.quantity > 0 then opm.quantity else 0 end),
-      'consumed', sum(case when (opm.flowdate >= greatest(d.startdate,%%s) and opm.flowdate < d.enddate) and opm.quantity < 0 then -opm.quantity else 0 end),
-      'consumedMO', sum(case when operationplan.type = 'MO' and (opm.flowdate >= greatest(d.startdate,%%s) and opm.flowdate < d.enddate) and opm.quantity < 0 then -opm.quantity else 0 end),
-      'consumedDO', sum(case when operationplan.type = 'DO' and (opm.flowdate >= greatest(d.startdate,%%s) and opm.flowdate < d.enddate) and opm.quantity < 0 then -opm.quantity else 0 end),
-      'consumedSO', sum(case when operationplan.type = 'DLVR' and (opm.flowdate >= greatest(d.startdate,%%s) and opm.flowdate < d.enddate) and opm.quantity < 0 then -opm.quantity else 0 end),
-      'produced', sum(case when (opm.flowdate >= greatest(d.startdate,%%s) and opm.flowdate < d.enddate) and opm.quantity > 0 then opm.quantity else 0 end),
-      'producedMO', sum(case when operationplan.type = 'MO' and (opm.flowdate >= greatest(d.startdate,%%s) and opm.flowdate < d.enddate) and opm.quantity > 0 then opm.quantity else 0 end),
-      'producedDO', sum(case when operationplan.type = 'DO' and (opm.flowdate >= greatest(d.startdate,%%s) and opm.flowdate < d.enddate) and opm.quantity > 0 then opm.quantity else 0 end),
-      'producedPO', sum(case when operationplan.type = 'PO' and (opm.flowdate >= greatest(d.startdate,%%s) and opm.flowdate < d.enddate) and opm.quantity > 0 then opm.quantity else 0 end)
-      )
-      from operationplanmaterial opm
-      inner join operationplan on operationplan.reference = opm.operationplan_id 
-      and ((startdate < d.enddate and enddate >= d.enddate) 
-            or (opm.flowdate >= greatest(d.startdate,%%s) and opm.flowdate < d.enddate))
-      where opm.item_id = item.name and opm.location_id = location.name) ongoing
+       inv.startoh,
+       inv.startohdoc,
+       inv.safetystock,
+       inv.consumed,
+       inv.consumedmo,
+       inv.consumeddo,
+       inv.consumedso,
+       inv.produced,
+       inv.producedmo,
+       inv.produceddo,
+       inv.producedpo,
+       inv.endoh,
+       inv.total_in_progress,
+       inv.work_in_progress_mo,
+       inv.on_order_po,
+       inv.in_transit_do,
+       case when inv.id is null then (
+         select jsonb_build_object('endoh', prev.endoh, 'safetystock', prev.safetystock)
+         from out_inventoryplan prev
+         where prev.bucket = %%s and prev.item = item.name
+         and prev.location = location.name and prev.startdate < d.startdate
+         order by prev.startdate desc
+         limit 1
+         ) end
        from
        (%s) opplanmat
        inner join item on item.name = opplanmat.item_id
        inner join location on location.name = opplanmat.location_id
        -- Multiply with buckets
-      cross join (
+       cross join (
          select name as bucket, startdate, enddate
          from common_bucketdetail
          where bucket_id = %%s and enddate > %%s and startdate < %%s
          ) d
-      group by
-       item.name,
-       location.name,
-       item.description, 
-       item.category, 
-       item.subcategory,
-       item.cost,
-       item.owner_id,
-       item.source, 
-       item.lastmodified, 
-       location.description, 
-       location.category,
-       location.subcategory, 
-       location.available_id, 
-       location.owner_id,
-       location.source, 
-       location.lastmodified,
-       d.bucket,
-       d.startdate,
-       d.enddate
+       -- Inventory plan
+       left outer join out_inventoryplan inv
+         on inv.bucket = %%s and inv.item = item.name
+         and inv.location = location.name and inv.startdate = d.startdate
        order by %s, d.startdate
     """ % (
             reportclass.attr_sql,
@@ -353,20 +343,14 @@ class OverviewReport(GridPivot):
         with connections[request.database].chunked_cursor() as cursor_chunked:
             cursor_chunked.execute(
                 query,
-                (
-                    request.report_startdate,  # startoh
-                    request.report_startdate,
-                    request.report_startdate,
-                    request.report_startdate,
-                    request.report_startdate,  # safetystock
-                )
-                + (request.report_startdate,) * 9
-                + baseparams  # ongoing
-                + (  # opplanmat
+                (request.report_bucket,)  # previous bucket
+                + baseparams  # opplanmat
+                + (
                     request.report_bucket,
                     request.report_startdate,
                     request.report_enddate,
-                ),  # bucket d
+                )  # bucket d
+                + (request.report_bucket,),  # inventory plan
             )
             for row in cursor_chunked:
                 numfields = len(row)
@@ -387,51 +371,25 @@ class OverviewReport(GridPivot):
                     "location__owner_id": row[14],
                     "location__source": row[15],
                     "location__lastmodified": row[16],
-                    "startoh": row[numfields - 6]["onhand"]
-                    if row[numfields - 6]
-                    else 0,
-                    "startohdoc": max(
-                        0,
-                        0
-                        if (row[numfields - 6]["onhand"] if row[numfields - 6] else 0)
-                        <= 0
-                        else (
-                            999
-                            if row[numfields - 6]["periodofcover"] == 86313600
-                            else (
-                                datetime.strptime(
-                                    row[numfields - 6]["flowdate"], "%Y-%m-%d %H:%M:%S"
-                                )
-                                + timedelta(seconds=row[numfields - 6]["periodofcover"])
-                                - row[numfields - 4]
-                            ).days
-                            if row[numfields - 6]["periodofcover"]
-                            else 999
-                        ),
-                    ),
-                    "bucket": row[numfields - 5],
-                    "startdate": row[numfields - 4].date(),
-                    "enddate": row[numfields - 3].date(),
-                    "safetystock": row[numfields - 2] or 0,
-                    "consumed": row[numfields - 1]["consumed"] or 0,
-                    "consumedMO": row[numfields - 1]["consumedMO"] or 0,
-                    "consumedDO": row[numfields - 1]["consumedDO"] or 0,
-                    "consumedSO": row[numfields - 1]["consumedSO"] or 0,
-                    "produced": row[numfields - 1]["produced"] or 0,
-                    "producedMO": row[numfields - 1]["producedMO"] or 0,
-                    "producedDO": row[numfields - 1]["producedDO"] or 0,
-                    "producedPO": row[numfields - 1]["producedPO"] or 0,
-                    "total_in_progress": row[numfields - 1]["total_in_progress"] or 0,
-                    "work_in_progress_mo": row[numfields - 1]["work_in_progress_mo"]
-                    or 0,
-                    "on_order_po": row[numfields - 1]["on_order_po"] or 0,
-                    "in_transit_do": row[numfields - 1]["in_transit_do"] or 0,
-                    "endoh": float(
-                        row[numfields - 6]["onhand"] if row[numfields - 6] else 0
-                    )
-                    + float(row[numfields - 1]["produced"] or 0)
-                    - float(row[numfields - 1]["consumed"] or 0),
+                    "bucket": row[numfields - 20],
+                    "startdate": row[numfields - 19].date(),
+                    "enddate": row[numfields - 18].date(),
                 }
+                if row[numfields - 17] is not None:
+                    # Precomputed bucket
+                    res.update(
+                        zip(
+                            reportclass.inventory_fields,
+                            (i or 0 for i in row[numfields - 17 : numfields - 1]),
+                        )
+                    )
+                else:
+                    # Bucket outside the horizon of the export
+                    previous = row[numfields - 1] or {}
+                    res.update((f, 0) for f in reportclass.inventory_fields)
+                    res["startoh"] = res["endoh"] = previous.get("endoh", None) or 0
+                    res["startohdoc"] = 999 if res["startoh"] > 0 else 0
+                    res["safetystock"] = previous.get("safetystock", None) or 0
                 # Add attribute fields
                 idx = 17
                 for f in getAttributeFields(Item, related_name_prefix="item"):
@@ -25,10 +25,11 @@ from django.utils.translation import gettext_lazy as _
 from django.utils.encoding import force_text
 
 from freppledb.boot import getAttributeFields
-from freppledb.input.models import Demand, Item
+from freppledb.input.models import Item
 from freppledb.input.models import ManufacturingOrder, PurchaseOrder, DistributionOrder
 from freppledb.common.report import GridPivot, GridFieldText
 from freppledb.common.report import GridFieldCurrency, GridFieldLastModified
+from freppledb.output.models import Pegging
 
 
 class OverviewReport(GridPivot):
@@ -42,6 +43,13 @@ class OverviewReport(GridPivot):
     basequeryset = Item.objects.all()
     model = Item
     permissions = (("view_demand_report", "Can view demand report"),)
+    tables = (
+        "common_bucketdetail",
+        "item",
+        "demand",
+        "operationplan",
+        "operationplanmaterial",
+    )
     rows = (
         GridFieldText(
             "item",
@@ -102,8 +110,8 @@ class OverviewReport(GridPivot):
             with_col_aliases=False
         )
 
-        # Assure the item hierarchy is up to date
-        Item.rebuildHierarchy(database=basequery.db)
+        # Update the item hierarchy in the background when needed
+        Item.updateHierarchy(database=basequery.db)
 
         # Execute a query to get the backlog at the start of the horizon
         startbacklogdict = {}
@@ -231,12 +239,12 @@ def OperationPlans(request):
     so_list = request.GET.getlist("demand")
 
     # Collect operationplans associated with the sales order(s)
-    id_list = []
-    for dm in (
-        Demand.objects.all().using(request.database).filter(pk__in=so_list).only("plan")
-    ):
-        for op in dm.plan["pegging"]:
-            id_list.append(op["opplan"])
+    id_list = (
+        Pegging.objects.all()
+        .using(request.database)
+        .filter(demand__in=so_list)
+        .values_list("operationplan", flat=True)
+    )
 
     # Collect details on the operationplans
     result = []
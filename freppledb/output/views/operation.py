@@ -39,6 +39,13 @@ class OverviewReport(GridPivot):
     template = "output/operation.html"
     title = _("Manufacturing order summary")
     model = Operation
+    tables = (
+        "common_bucketdetail",
+        "operation",
+        "item",
+        "location",
+        "operationplan",
+    )
     permissions = (("view_operation_report", "Can view operation report"),)
     help_url = (
         "user-guide/user-interface/plan-analysis/manufacturing-order-summary.html"
@@ -407,6 +414,13 @@ class PurchaseReport(GridPivot):
     title = _("Purchase order summary")
     model = PurchaseOrder
     permissions = (("view_purchaseorder", "Can view purchase order"),)
+    tables = (
+        "common_bucketdetail",
+        "operationplan",
+        "item",
+        "location",
+        "supplier",
+    )
     help_url = "user-guide/user-interface/plan-analysis/purchase-order-summary.html"
 
     rows = (
@@ -765,6 +779,7 @@ class DistributionReport(GridPivot):
     title = _("Distribution order summary")
     model = DistributionOrder
     permissions = (("view_distributionorder", "Can view distribution order"),)
+    tables = ("common_bucketdetail", "operationplan", "item", "location")
     help_url = "user-guide/user-interface/plan-analysis/distribution-order-summary.html"
 
     rows = (
@@ -112,9 +112,11 @@ class ReportByDemand(GridReport):
             with dmd as (
                 select
                   due,
-                  cast(jsonb_array_elements(plan->'pegging')->>'opplan' as varchar) opplan
+                  out_pegging.operationplan opplan
                 from demand
-                where name = %s
+                inner join out_pegging
+                on out_pegging.demand = demand.name
+                where demand.name = %s
                 )
             select min(dmd.due), min(startdate), max(enddate)
             from dmd
@@ -184,16 +186,16 @@ class ReportByDemand(GridReport):
               quantity as required_quantity,
               sum(quantity) as quantity
             from (select
-              row_number() over () as rownum, opplan, due, lvl, quantity
-            from (select
-              due,
-              cast(jsonb_array_elements(plan->'pegging')->>'opplan' as varchar) as opplan,
-              cast(jsonb_array_elements(plan->'pegging')->>'level' as integer) as lvl,
-              cast(jsonb_array_elements(plan->'pegging')->>'quantity' as numeric) as quantity
+              row_number() over (order by out_pegging.id) as rownum,
+              out_pegging.operationplan as opplan,
+              demand.due,
+              out_pegging.level as lvl,
+              out_pegging.quantity
               from demand
-              where name = %s
+              inner join out_pegging
+              on out_pegging.demand = demand.name
+              where demand.name = %s
               ) d1
-              ) d2
             group by opplan, quantity
             )
           select
@@ -38,6 +38,7 @@ class OverviewReport(GridPivot):
     basequeryset = Resource.objects.all()
     model = Resource
     permissions = (("view_resource_report", "Can view resource report"),)
+    tables = ("common_bucketdetail", "resource", "location")
     editable = False
     help_url = "user-guide/user-interface/plan-analysis/resource-report.html"
 
@@ -267,6 +268,10 @@ class OverviewReport(GridPivot):
         except Exception:
             return (24, _("days"))
 
+    @classmethod
+    def getCacheParameters(reportclass, request):
+        return reportclass.getUnits(request)[:1]
+
     @classmethod
     def query(reportclass, request, basequery, sortsql="1 asc"):
         basesql, baseparams = basequery.query.get_compiler(basequery.db).as_sql(
@@ -276,8 +281,8 @@ class OverviewReport(GridPivot):
         # Get the time units
         units = OverviewReport.getUnits(request)
 
-        # Assure the item hierarchy is up to date
-        Resource.rebuildHierarchy(database=basequery.db)
+        # Update the resource hierarchy in the background when needed
+        Resource.updateHierarchy(database=basequery.db)
 
         # Execute the query
         query = """
@@ -44,6 +44,7 @@ class LateOrdersWidget(Widget):
     tooltip = _("Shows orders that will be delivered after their due date")
     permissions = (("view_problem_report", "Can view problem report"),)
     asynchronous = True
+    cacheable = True
     url = "/problem/?noautofilter&entity=demand&name=late&sord=asc&sidx=startdate"
     exporturl = True
     limit = 20
@@ -122,6 +123,7 @@ class ShortOrdersWidget(Widget):
     tooltip = _("Shows orders that are not planned completely")
     permissions = (("view_problem_report", "Can view problem report"),)
     asynchronous = True
+    cacheable = True
     # Note the gte filter lets pass "short" and "unplanned", and filters out
     # "late" and "early".
     url = "/problem/?noautofilter&entity=demand&name__gte=short&sord=asc&sidx=startdate"
@@ -198,6 +200,8 @@ class ManufacturingOrderWidget(Widget):
     tooltip = _("Shows manufacturing orders by start date")
     permissions = (("view_problem_report", "Can view problem report"),)
     asynchronous = True
+    cacheable = True
+    tables = ("common_bucketdetail", "operationplan")
     url = "/data/input/manufacturingorder/?noautofilter&sord=asc&sidx=startdate&status__in=proposed,confirmed,approved"
     exporturl = True
     fence1 = 7
@@ -470,6 +474,8 @@ class DistributionOrderWidget(Widget):
     tooltip = _("Shows distribution orders by start date")
     permissions = (("view_problem_report", "Can view problem report"),)
     asynchronous = True
+    cacheable = True
+    tables = ("common_bucketdetail", "operationplan")
     url = "/data/input/distributionorder/?noautofilter&sord=asc&sidx=startdate&status__in=proposed,confirmed"
     exporturl = True
     fence1 = 7
@@ -739,6 +745,8 @@ class PurchaseOrderWidget(Widget):
     tooltip = _("Shows purchase orders by ordering date")
     permissions = (("view_problem_report", "Can view problem report"),)
     asynchronous = True
+    cacheable = True
+    tables = ("common_bucketdetail", "operationplan")
     url = "/data/input/purchaseorder/?sord=asc&sidx=startdate&status__in=proposed,confirmed"
     exporturl = True
     fence1 = 7
@@ -1056,6 +1064,8 @@ class PurchaseQueueWidget(Widget):
     tooltip = _("Display a list of new purchase orders")
     permissions = (("view_purchaseorder", "Can view purchase orders"),)
     asynchronous = True
+    cacheable = True
+    tables = ("operationplan",)
     url = "/data/input/purchaseorder/?noautofilter&status=proposed&sidx=startdate&sord=asc"
     exporturl = True
     limit = 20
@@ -1112,6 +1122,8 @@ class DistributionQueueWidget(Widget):
     tooltip = _("Display a list of new distribution orders")
     permissions = (("view_distributionorder", "Can view distribution order"),)
     asynchronous = True
+    cacheable = True
+    tables = ("operationplan",)
     url = "/data/input/distributionorder/?noautofilter&status=proposed&sidx=startdate&sord=asc"
     exporturl = True
     limit = 20
@@ -1170,6 +1182,8 @@ class ShippingQueueWidget(Widget):
     tooltip = _("Display a list of new distribution orders")
     permissions = (("view_distributionorder", "Can view distribution order"),)
     asynchronous = True
+    cacheable = True
+    tables = ("operationplan",)
     url = "/data/input/distributionorder/?noautofilter&sidx=plandate&sord=asc"
     exporturl = True
     limit = 20
@@ -1228,6 +1242,8 @@ class ResourceQueueWidget(Widget):
     tooltip = _("Display planned activities for the resources")
     permissions = (("view_resource_report", "Can view resource report"),)
     asynchronous = True
+    cacheable = True
+    tables = ("operationplan", "operationplanresource")
     url = "/loadplan/?sidx=startdate&sord=asc"
     exporturl = True
     limit = 20
@@ -1292,6 +1308,8 @@ class PurchaseAnalysisWidget(Widget):
     tooltip = _("Analyse the urgency of existing purchase orders")
     permissions = (("view_purchaseorder", "Can view purchase orders"),)
     asynchronous = True
+    cacheable = True
+    tables = ("operationplan",)
     url = "/data/input/purchaseorder/?noautofilter&status=confirmed&sidx=color&sord=asc"
     limit = 20
 
@@ -1345,6 +1363,7 @@ class AlertsWidget(Widget):
     tooltip = _("Overview of all alerts in the plan")
     permissions = (("view_problem_report", "Can view problem report"),)
     asynchronous = True
+    cacheable = True
     url = "/problem/"
     entities = "material,capacity,demand,operation"
 
@@ -1431,6 +1450,7 @@ class ResourceLoadWidget(Widget):
     tooltip = _("Shows the resources with the highest utilization")
     permissions = (("view_resource_report", "Can view resource report"),)
     asynchronous = True
+    cacheable = True
     url = "/resource/"
     exporturl = True
     limit = 5
@@ -1490,6 +1510,15 @@ class ResourceLoadWidget(Widget):
       .attr("class","bold");
     """
 
+    @classmethod
+    def getCacheKey(cls, request):
+        # The horizon of the widget is a user preference
+        GridReport.getBuckets(request)
+        return super().getCacheKey(request) + (
+            request.report_startdate,
+            request.report_enddate,
+        )
+
     @classmethod
     def render(cls, request=None):
         limit = int(request.GET.get("limit", cls.limit))
@@ -1537,6 +1566,7 @@ class InventoryByLocationWidget(Widget):
     title = _("inventory by location")
     tooltip = _("Display the locations with the highest inventory value")
     asynchronous = True
+    cacheable = True
     limit = 5
 
     def args(self):
@@ -1628,6 +1658,7 @@ class InventoryByItemWidget(Widget):
     title = _("inventory by item")
     tooltip = _("Display the items with the highest inventory value")
     asynchronous = True
+    cacheable = True
     limit = 20
 
     def args(self):
@@ -1718,6 +1749,7 @@ class DeliveryPerformanceWidget(Widget):
         "Shows the percentage of demands that are planned to be shipped completely on time"
     )
     asynchronous = True
+    cacheable = True
     green = 90
     yellow = 80
 
@@ -251,6 +251,22 @@ DEFAULT_THEME = "earth"
 # The default number of records to pull from the server as a page
 DEFAULT_PAGESIZE = 100
 
+# Record counts of grids above this number of records are cached until
+# the next task finishes, rather than being recomputed for every page
+GRID_COUNT_CACHE_THRESHOLD = 10000
+
+# Maximum number of matches counted for each type of object in the global
+# search box
+GLOBAL_SEARCH_LIMIT = 100
+
+# Number of parallel jobs used to dump and restore the database when copying
+# a scenario
+SCENARIO_COPY_JOBS = 4
+
+# Number of seconds the response of a dashboard widget with plan data is
+# cached. The cache is also refreshed when a task finishes.
+DASHBOARD_CACHE_TIMEOUT = 600
+
 # Configuration of the default dashboard
 DEFAULT_DASHBOARD = [
     {
@@ -356,6 +372,10 @@ MAXCPUTIME = None  # limit in seconds, use None for unlimited
 # Max total log files size in MB, if the limit is reached deletes the oldest.
 MAXTOTALLOGFILESIZE = 200
 
+# Maximum memory used by a web server process to cache the results of the
+# plan reports. The cache is refreshed when a task finishes.
+MAXREPORTCACHESIZE = 200  # limit in MB, use 0 to disable the cache
+
 # Adress and port number for the runwebserver command, the Windows system tray
 # executable and the Windows service
 ADDRESS = "0.0.0.0"